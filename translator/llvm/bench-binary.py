@@ -0,0 +1,88 @@
+import argparse
+import imp
+import os
+import os.path
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import workloads
+
+here = os.path.dirname(os.path.abspath(__file__))
+compiler = imp.load_source('compile_dcpu', os.path.join(here, 'compile-dcpu.py'))
+
+def best_time(f, repeat):
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    f()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+def translate(path):
+  # The whole command, as a build would run it: start-up, mapping the
+  # image, decoding, linking and writing the IR.
+  f = open(path, 'rb')
+  try:
+    subprocess.check_call([sys.executable, os.path.join(here, 'compile-dcpu.py'), '--binary', 'big'],
+                          stdin=f, stdout=open(os.devnull, 'w'))
+  finally:
+    f.close()
+
+def main(argv):
+  arg_parser = argparse.ArgumentParser(
+    description='Time compile-dcpu.py --binary on assembled images of generated programs, up to a whole '
+    '128 KB address space.')
+  arg_parser.add_argument('files', nargs='*', help='big-endian images to translate (default: generated programs)')
+  arg_parser.add_argument('--sizes', default='10000,20000,40000', help='generated program sizes, in lines')
+  arg_parser.add_argument('--repeat', type=int, default=3)
+  arg_parser.add_argument('--target', type=float, default=1.0,
+                          help='seconds the whole translation of each image should take (default: %(default)s)')
+  args = arg_parser.parse_args(argv)
+
+  work_dir = tempfile.mkdtemp(prefix='dcpu-bench-binary-')
+  inputs = [(f, f) for f in args.files]
+  if not args.files:
+    for lines in map(int, args.sizes.split(',')):
+      image = compiler.Parser().parse(workloads.mixed(lines)).assemble()
+      path = os.path.join(work_dir, 'mixed-%d.bin' % lines)
+      f = open(path, 'wb')
+      f.write(struct.pack('>%dH' % len(image), *image))
+      f.close()
+      inputs.append(('mixed-%d' % lines, path))
+
+  missed = 0
+  try:
+    print '%-16s %8s %8s %8s %8s %8s %8s' % ('input', 'KB', 'insns', 'decode', 'emit', 'total', 'target')
+    for name, path in inputs:
+      f = open(path, 'rb')
+      image = f.read()
+      f.close()
+      program = compiler.Decoder('big').decode(image)
+      decode = best_time(lambda: compiler.Decoder('big').decode(image), args.repeat)
+      def emit():
+        out = compiler.LLVM_Out(open(os.devnull, 'w'))
+        program.to_llvm(out)
+        out.flush()
+      emit = best_time(emit, args.repeat)
+      total = best_time(lambda: translate(path), args.repeat)
+      met = total <= args.target
+      if not met:
+        missed += 1
+      print '%-16s %8.1f %8d %7.3fs %7.3fs %7.3fs %8s' % (name, len(image) / 1024.0, len(program.instructions()),
+                                                          decode, emit, total, met and 'met' or 'MISSED')
+  finally:
+    for name in os.listdir(work_dir):
+      os.remove(os.path.join(work_dir, name))
+    os.rmdir(work_dir)
+
+  if missed:
+    print '%d of %d images took longer than %.2fs' % (missed, len(inputs), args.target)
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,37 @@
+import argparse
+import os.path
+import shutil
+import sys
+import tempfile
+
+import pipeline
+import workloads
+
+def main(argv):
+  arg_parser = argparse.ArgumentParser(description='Time a memory-bound program under each --memory-tracking mode.')
+  arg_parser.add_argument('--words', type=int, default=8192)
+  arg_parser.add_argument('--passes', type=int, default=20000)
+  arg_parser.add_argument('--repeat', type=int, default=3)
+  args = arg_parser.parse_args(argv)
+
+  work_dir = tempfile.mkdtemp()
+  try:
+    das = os.path.join(work_dir, 'memcopy.das')
+    with open(das, 'w') as f:
+      f.write(workloads.memcopy(args.words, args.passes))
+
+    print 'memcopy: %d words x %d passes' % (args.words, args.passes)
+    print '%-8s %10s %9s' % ('mode', 'seconds', 'speedup')
+    reference = None
+    for mode in ('call', 'inline', 'off'):
+      executable = os.path.join(work_dir, 'memcopy-' + mode)
+      pipeline.build(das, executable, ['--memory-tracking', mode])
+      best = min([pipeline.run(executable)[1] for i in range(args.repeat)])
+      if reference is None:
+        reference = best
+      print '%-8s %10.3f %8.1fx' % (mode, best, reference / best)
+  finally:
+    shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
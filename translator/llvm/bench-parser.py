@@ -0,0 +1,51 @@
+import argparse
+import imp
+import os.path
+import sys
+import time
+
+import workloads
+
+compiler = imp.load_source('compile_dcpu', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compile-dcpu.py'))
+
+def best_time(f, repeat):
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    f()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+def main(argv):
+  arg_parser = argparse.ArgumentParser(description='Compare Parser against the pyparsing grammar.')
+  arg_parser.add_argument('files', nargs='*', help='.das files to parse (default: generated programs)')
+  arg_parser.add_argument('--sizes', default='1000,10000,50000', help='generated program sizes, in lines')
+  arg_parser.add_argument('--repeat', type=int, default=3)
+  args = arg_parser.parse_args(argv)
+
+  if args.files:
+    inputs = [(f, open(f).read()) for f in args.files]
+  else:
+    inputs = [('mixed-%d' % n, workloads.mixed(n)) for n in map(int, args.sizes.split(','))]
+
+  have_pyparsing = compiler.pyparsing is not None
+  if have_pyparsing:
+    compiler.pyparsing_grammar()
+  else:
+    print 'pyparsing is not installed; timing Parser only.'
+
+  print '%-16s %8s %14s %14s %8s' % ('input', 'lines', 'Parser l/s', 'pyparsing l/s', 'speedup')
+  for name, source in inputs:
+    lines = source.count('\n')
+    hand = best_time(lambda: compiler.Parser().parse(source), args.repeat)
+    if have_pyparsing:
+      grammar = compiler.pyparsing_grammar()
+      old = best_time(lambda: grammar.parseString(source), args.repeat)
+      print '%-16s %8d %14.0f %14.0f %7.1fx' % (name, lines, lines / hand, lines / old, old / hand)
+    else:
+      print '%-16s %8d %14.0f %14s %8s' % (name, lines, lines / hand, '-', '-')
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
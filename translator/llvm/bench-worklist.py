@@ -0,0 +1,45 @@
+import argparse
+import imp
+import os.path
+import sys
+import time
+
+import workloads
+
+def load_compiler(path, name):
+  return imp.load_source(name, path)
+
+def time_translation(compiler, source):
+  program = compiler.Parser().parse(source)
+  start = time.time()
+  out = compiler.LLVM_Out()
+  program.to_llvm(out)
+  return time.time() - start, out.getvalue()
+
+def main(argv):
+  here = os.path.dirname(os.path.abspath(__file__))
+  arg_parser = argparse.ArgumentParser(description='Time block scheduling in Program.to_llvm as the number of labels grows.')
+  arg_parser.add_argument('--labels', default='100,1000,10000,100000', help='label counts to generate')
+  arg_parser.add_argument('--baseline', help='another compile-dcpu.py to time and compare output against')
+  arg_parser.add_argument('--baseline-max-labels', type=int, default=10000,
+                          help='skip the baseline above this many labels')
+  args = arg_parser.parse_args(argv)
+
+  compiler = load_compiler(os.path.join(here, 'compile-dcpu.py'), 'compile_dcpu')
+  baseline = args.baseline and load_compiler(args.baseline, 'compile_dcpu_baseline')
+
+  print '%8s %10s %12s %12s' % ('labels', 'seconds', 'labels/s', 'baseline s')
+  for labels in map(int, args.labels.split(',')):
+    source = workloads.loops(labels)
+    elapsed, ir = time_translation(compiler, source)
+    baseline_column = '-'
+    if baseline and labels <= args.baseline_max_labels:
+      baseline_elapsed, baseline_ir = time_translation(baseline, source)
+      if baseline_ir != ir:
+        print >>sys.stderr, 'output differs from baseline at %d labels' % labels
+        sys.exit(1)
+      baseline_column = '%.3f' % baseline_elapsed
+    print '%8d %10.3f %12.0f %12s' % (labels, elapsed, labels / elapsed, baseline_column)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,67 @@
+"""Block execution profiles, as code translated with --profile-blocks writes them.
+
+A profile is a text file with one line per counter:
+
+  <count> <pc in hex> <source line number>: <instruction>
+
+Each counter belongs to the instruction at pc: the start of a block, or an
+instruction an IF guards. A run adds its counts to the ones already in the
+file, so a profile can sum any number of runs of the same program.
+Counters are matched on pc and instruction; the line number is only there
+to read, so moving code to other lines keeps its counts. emulator.c writes
+the same format.
+"""
+
+import os
+import re
+
+HEADER = '# count pc source\n'
+
+def default_path():
+  return os.environ.get('DCPU_PROFILE', 'dcpu-profile.txt')
+
+_LINE_NUMBER = re.compile(r'\d+: ')
+
+def text(source):
+  """The instruction in source, without its line number."""
+  match = _LINE_NUMBER.match(source)
+  if match:
+    return source[match.end():]
+  return source
+
+def _entries(path):
+  for line in open(path):
+    if line.startswith('#') or not line.strip():
+      continue
+    count, pc, source = line.rstrip('\n').split(' ', 2)
+    yield int(pc, 16), source, int(count)
+
+def read(path):
+  """Maps (pc, text) of each counter in the profile at path to its count.
+
+  Keeping the instruction lets a translation use only the counters of code
+  that is still what was profiled; see Program.executions in compile-dcpu.py.
+  """
+  counts = {}
+  for pc, source, count in _entries(path):
+    key = pc, text(source)
+    counts[key] = counts.get(key, 0) + count
+  return counts
+
+def merge(path, counters):
+  """Adds counters, a list of (pc, source, count), to the profile at path.
+
+  Counters the file has for other code are dropped, so a profile only ever
+  describes the program that last wrote it.
+  """
+  previous = {}
+  if os.path.exists(path):
+    for pc, source, count in _entries(path):
+      previous[pc, text(source)] = count
+  temporary = path + '.tmp'
+  f = open(temporary, 'w')
+  f.write(HEADER)
+  for pc, source, count in counters:
+    f.write('%d %04x %s\n' % (count + previous.get((pc, text(source)), 0), pc, source))
+  f.close()
+  os.rename(temporary, path)
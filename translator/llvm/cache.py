@@ -0,0 +1,160 @@
+"""A content-addressed cache for build products (.ll, .bc, .s and objects).
+
+Entries are named by a hash of everything that went into them, so they never
+need invalidating: a changed source file, translator, flag or tool simply
+produces a different key. The cache is kept under a size limit by evicting
+the least recently used entries. A running total of the entries' sizes is
+kept in the directory's .size file, so the entries are only listed when the
+total goes over the limit.
+
+The directory comes from DCPU_CACHE_DIR and the limit, in megabytes, from
+DCPU_CACHE_MB (default 256).
+"""
+
+import fcntl
+import hashlib
+import os
+import os.path
+import subprocess
+import tempfile
+
+DEFAULT_MAX_MB = 256
+SIZE_FILE = '.size'
+# Eviction goes down to this fraction of the limit, so that the next puts
+# don't each have to list the cache again.
+EVICT_TO = 0.75
+
+def digest(*parts):
+  """A hex key for parts, a sequence of strings."""
+  h = hashlib.sha1()
+  for part in parts:
+    # Length-prefixed so ('ab', 'c') and ('a', 'bc') differ.
+    h.update('%d:' % len(part))
+    h.update(part)
+  return h.hexdigest()
+
+_file_digests = {}
+
+def file_digest(path):
+  path = os.path.abspath(path)
+  if path not in _file_digests:
+    f = open(path, 'rb')
+    _file_digests[path] = digest(f.read())
+    f.close()
+  return _file_digests[path]
+
+_tool_versions = {}
+
+def tool_version(tool):
+  """The output of `tool --version`, so upgrading a tool changes keys."""
+  if tool not in _tool_versions:
+    try:
+      _tool_versions[tool] = subprocess.check_output([tool, '--version'], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError), e:
+      _tool_versions[tool] = 'unknown: %s' % e
+  return _tool_versions[tool]
+
+def default_directory():
+  return os.environ.get('DCPU_CACHE_DIR')
+
+class Cache(object):
+  def __init__(self, directory, max_bytes=None):
+    if max_bytes is None:
+      max_bytes = int(os.environ.get('DCPU_CACHE_MB', DEFAULT_MAX_MB)) * 1024 * 1024
+    self._directory = directory
+    self._max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+
+  def _path(self, key):
+    return os.path.join(self._directory, key[:2], key[2:])
+
+  def get(self, key):
+    """The data stored under key, or None."""
+    path = self._path(key)
+    try:
+      f = open(path, 'rb')
+      data = f.read()
+      f.close()
+      # The modification time doubles as the last-used time for eviction.
+      os.utime(path, None)
+    except (IOError, OSError):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return data
+
+  def put(self, key, data):
+    path = self._path(key)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # Another process made it first.
+        pass
+    # Write then rename, so concurrent readers never see a partial entry.
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.')
+    f = os.fdopen(fd, 'wb')
+    f.write(data)
+    f.close()
+    try:
+      replaced = os.path.getsize(path)
+    except OSError:
+      replaced = 0
+    os.rename(temp, path)
+    self._grow(len(data) - replaced)
+
+  def _grow(self, size):
+    """Adds size bytes to the running total, evicting if it is over the limit."""
+    # Opened without truncating; the lock makes the read and write atomic
+    # across processes sharing the cache.
+    fd = os.open(os.path.join(self._directory, SIZE_FILE), os.O_RDWR | os.O_CREAT, 0666)
+    f = os.fdopen(fd, 'r+')
+    try:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        total = int(f.read()) + size
+      except ValueError:
+        # New, or written by a process that died; count from scratch.
+        total = None
+      if total is None or total > self._max_bytes:
+        total = self.evict()
+      f.seek(0)
+      f.truncate()
+      f.write('%d\n' % total)
+    finally:
+      f.close()
+
+  def evict(self):
+    """Removes least recently used entries until the cache is EVICT_TO of its
+    limit or less; returns the size of what is left."""
+    entries = []
+    total = 0
+    for directory, _, files in os.walk(self._directory):
+      for name in files:
+        if name.startswith('.'):
+          # Being written by put(), or the running total.
+          continue
+        path = os.path.join(directory, name)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    if total <= self._max_bytes:
+      return total
+    entries.sort()
+    for _, size, path in entries:
+      if total <= self._max_bytes * EVICT_TO:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      total -= size
+    return total
+
+  def stats(self):
+    return 'cache: %d hits, %d misses' % (self.hits, self.misses)
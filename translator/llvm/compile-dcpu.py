@@ -1,5 +1,24 @@
+import argparse
+import array
+import cStringIO
+import gc
+import heapq
+import itertools
+import mmap
+import multiprocessing
+import os
+import os.path
+import re
+import struct
 import sys
-from pyparsing import *
+
+try:
+  import pyparsing
+except ImportError:
+  pyparsing = None
+
+import blockprofile
+import cache
 
 class Opcode(object):
   def __init__(self, opcode):
@@ -40,6 +59,7 @@ class DBGOpcode(Opcode):
 
   def to_llvm(self, out, arguments):
     out.dump_regs(True)
+    out.store_registers_to_state()
     out.write_line('call void @debug(%struct.VMState* %state)')
 
 class ADDOpcode(Opcode):
@@ -63,11 +83,12 @@ class ADDOpcode(Opcode):
     arguments[0].to_llvm_store(out, tmp4)
 
     # overflow
-    tmp5 = out.temp_variable()
-    tmp6 = out.temp_variable()
-    out.write_line('%s = lshr i32 %s, 16' % (tmp5, tmp3))
-    out.write_line('%s = trunc i32 %s to i16' % (tmp6, tmp5))
-    out.set_reg('O', tmp6)
+    if out.overflow_needed:
+      tmp5 = out.temp_variable()
+      tmp6 = out.temp_variable()
+      out.write_line('%s = lshr i32 %s, 16' % (tmp5, tmp3))
+      out.write_line('%s = trunc i32 %s to i16' % (tmp6, tmp5))
+      out.set_reg('O', tmp6)
 
 class MULOpcode(Opcode):
   def __init__(self):
@@ -90,11 +111,12 @@ class MULOpcode(Opcode):
     arguments[0].to_llvm_store(out, tmp4)
 
     # overflow
-    tmp5 = out.temp_variable()
-    tmp6 = out.temp_variable()
-    out.write_line('%s = lshr i32 %s, 16' % (tmp5, tmp3))
-    out.write_line('%s = trunc i32 %s to i16' % (tmp6, tmp5))
-    out.set_reg('O', tmp6)
+    if out.overflow_needed:
+      tmp5 = out.temp_variable()
+      tmp6 = out.temp_variable()
+      out.write_line('%s = lshr i32 %s, 16' % (tmp5, tmp3))
+      out.write_line('%s = trunc i32 %s to i16' % (tmp6, tmp5))
+      out.set_reg('O', tmp6)
 
 class DIVOpcode(Opcode):
   def __init__(self):
@@ -122,7 +144,6 @@ class DIVOpcode(Opcode):
     tmp5 = out.temp_variable()
     tmp6 = out.temp_variable()
     tmp7 = out.temp_variable()
-    tmp8 = out.temp_variable()
     out.write_line('%s:' % label2)
     out.write_line('%s = zext i16 %s to i32' % (tmp2, arg0))
     out.write_line('%s = zext i16 %s to i32' % (tmp3, arg1))
@@ -130,17 +151,21 @@ class DIVOpcode(Opcode):
     out.write_line('%s = udiv i32 %s, %s' % (tmp5, tmp4, tmp3))
     out.write_line('%s = lshr i32 %s, 16' % (tmp6, tmp5))
     out.write_line('%s = trunc i32 %s to i16' % (tmp7, tmp6))
-    out.write_line('%s = trunc i32 %s to i16' % (tmp8, tmp5))
+    if out.overflow_needed:
+      tmp8 = out.temp_variable()
+      out.write_line('%s = trunc i32 %s to i16' % (tmp8, tmp5))
     out.write_line('br label %%%s' % label3)
 
     # done
     tmp9 = out.temp_variable()
-    tmp10 = out.temp_variable()
     out.write_line('%s:' % label3)
     out.write_line('%s = phi i16 [0, %%%s], [%s, %%%s]' % (tmp9, label1, tmp7, label2))
-    out.write_line('%s = phi i16 [0, %%%s], [%s, %%%s]' % (tmp10, label1, tmp8, label2))
+    if out.overflow_needed:
+      tmp10 = out.temp_variable()
+      out.write_line('%s = phi i16 [0, %%%s], [%s, %%%s]' % (tmp10, label1, tmp8, label2))
     arguments[0].to_llvm_store(out, tmp9)
-    out.set_reg('O', tmp10)
+    if out.overflow_needed:
+      out.set_reg('O', tmp10)
 
 class MODOpcode(Opcode):
   def __init__(self):
@@ -173,7 +198,8 @@ class MODOpcode(Opcode):
     out.write_line('%s:' % label3)
     out.write_line('%s = phi i16 [0, %%%s], [%s, %%%s]' % (tmp3, label1, tmp2, label2))
     arguments[0].to_llvm_store(out, tmp3)
-    out.set_reg('O', 0)
+    if out.overflow_needed:
+      out.set_reg('O', 0)
 
 class SUBOpcode(Opcode):
   def __init__(self):
@@ -196,11 +222,12 @@ class SUBOpcode(Opcode):
     arguments[0].to_llvm_store(out, tmp4)
 
     # underflow
-    tmp5 = out.temp_variable()
-    tmp6 = out.temp_variable()
-    out.write_line('%s = lshr i32 %s, 16' % (tmp5, tmp3))
-    out.write_line('%s = trunc i32 %s to i16' % (tmp6, tmp5))
-    out.set_reg('O', tmp6)
+    if out.overflow_needed:
+      tmp5 = out.temp_variable()
+      tmp6 = out.temp_variable()
+      out.write_line('%s = lshr i32 %s, 16' % (tmp5, tmp3))
+      out.write_line('%s = trunc i32 %s to i16' % (tmp6, tmp5))
+      out.set_reg('O', tmp6)
 
 class JSROpcode(Opcode):
   def __init__(self):
@@ -210,9 +237,18 @@ class JSROpcode(Opcode):
     return 'JSROpcode()'
 
   def to_llvm(self, out, arguments):
-    out.dump_regs()
+    # As on hardware, the address of the next instruction goes on the stack,
+    # though the call itself returns natively; PC reads as the JSR's own.
+    next_pc = int(out.reg('PC')) + 1 + arguments[0].extra_length()
+    Push.resolve(out).to_llvm_store(out, str(next_pc))
+    # A leaf callee only sees the registers in its summary, so only those
+    # need to be in VMState, and only the ones it writes need reloading.
+    passed, written = out.leaf_registers.get(arguments[0].label(), (None, None))
+    out.dump_regs(names=passed)
+    out.store_registers_to_state(passed)
     out.write_line('call void @%s(%%struct.VMState* %%state)' % arguments[0].label())
-    out.reset_regs()
+    out.load_registers_from_state(written)
+    out.reset_regs(written)
 
 class IFEOpcode(Opcode):
   def __init__(self):
@@ -228,11 +264,15 @@ class IFEOpcode(Opcode):
     out.write_line('%s = icmp eq i16 %s, %s' % (tmp1, arg1, arg2))
     label1 = out.label()
     label2 = out.label()
-    out.write_line('br i1 %s, label %%%s, label %%%s' % (tmp1, label1, label2))
+    out.dump_regs()
+    out.write_line('br i1 %s, label %%%s, label %%%s%s' % (tmp1, label1, label2, out.branch_weights))
     out.write_line('%s:' % label1)
     def post_condition():
+      # Registers set by the guarded instruction don't dominate the join.
+      out.dump_regs()
       out.write_line('br label %%%s' % label2)
       out.write_line('%s:' % label2)
+      out.reset_regs()
     return post_condition
 
 class IFNOpcode(Opcode):
@@ -249,11 +289,15 @@ class IFNOpcode(Opcode):
     out.write_line('%s = icmp ne i16 %s, %s' % (tmp1, arg1, arg2))
     label1 = out.label()
     label2 = out.label()
-    out.write_line('br i1 %s, label %%%s, label %%%s' % (tmp1, label1, label2))
+    out.dump_regs()
+    out.write_line('br i1 %s, label %%%s, label %%%s%s' % (tmp1, label1, label2, out.branch_weights))
     out.write_line('%s:' % label1)
     def post_condition():
+      # Registers set by the guarded instruction don't dominate the join.
+      out.dump_regs()
       out.write_line('br label %%%s' % label2)
       out.write_line('%s:' % label2)
+      out.reset_regs()
     return post_condition
 
 class IFGOpcode(Opcode):
@@ -270,11 +314,15 @@ class IFGOpcode(Opcode):
     out.write_line('%s = icmp ugt i16 %s, %s' % (tmp1, arg1, arg2))
     label1 = out.label()
     label2 = out.label()
-    out.write_line('br i1 %s, label %%%s, label %%%s' % (tmp1, label1, label2))
+    out.dump_regs()
+    out.write_line('br i1 %s, label %%%s, label %%%s%s' % (tmp1, label1, label2, out.branch_weights))
     out.write_line('%s:' % label1)
     def post_condition():
+      # Registers set by the guarded instruction don't dominate the join.
+      out.dump_regs()
       out.write_line('br label %%%s' % label2)
       out.write_line('%s:' % label2)
+      out.reset_regs()
     return post_condition
 
 class IFBOpcode(Opcode):
@@ -293,11 +341,15 @@ class IFBOpcode(Opcode):
     out.write_line('%s = icmp ne i16 %s, 0' % (tmp2, tmp1))
     label1 = out.label()
     label2 = out.label()
-    out.write_line('br i1 %s, label %%%s, label %%%s' % (tmp2, label1, label2))
+    out.dump_regs()
+    out.write_line('br i1 %s, label %%%s, label %%%s%s' % (tmp2, label1, label2, out.branch_weights))
     out.write_line('%s:' % label1)
     def post_condition():
+      # Registers set by the guarded instruction don't dominate the join.
+      out.dump_regs()
       out.write_line('br label %%%s' % label2)
       out.write_line('%s:' % label2)
+      out.reset_regs()
     return post_condition
 
 class SHLOpcode(Opcode):
@@ -321,11 +373,12 @@ class SHLOpcode(Opcode):
     arguments[0].to_llvm_store(out, tmp4)
 
     # overflow
-    tmp5 = out.temp_variable()
-    tmp6 = out.temp_variable()
-    out.write_line('%s = lshr i32 %s, 16' % (tmp5, tmp3))
-    out.write_line('%s = trunc i32 %s to i16' % (tmp6, tmp5))
-    out.set_reg('O', tmp6)
+    if out.overflow_needed:
+      tmp5 = out.temp_variable()
+      tmp6 = out.temp_variable()
+      out.write_line('%s = lshr i32 %s, 16' % (tmp5, tmp3))
+      out.write_line('%s = trunc i32 %s to i16' % (tmp6, tmp5))
+      out.set_reg('O', tmp6)
 
 class SHROpcode(Opcode):
   def __init__(self):
@@ -352,9 +405,10 @@ class SHROpcode(Opcode):
     arguments[0].to_llvm_store(out, tmp6)
 
     # overflow
-    tmp7 = out.temp_variable()
-    out.write_line('%s = trunc i32 %s to i16' % (tmp7, tmp4))
-    out.set_reg('O', tmp7)
+    if out.overflow_needed:
+      tmp7 = out.temp_variable()
+      out.write_line('%s = trunc i32 %s to i16' % (tmp7, tmp4))
+      out.set_reg('O', tmp7)
 
 class ANDOpcode(Opcode):
   def __init__(self):
@@ -412,12 +466,20 @@ class Register(object):
   def offset(self):
     return self._offset
 
+  def registers(self):
+    return [self._register]
+
   def extra_length(self):
     return 0
 
   def to_das(self):
     return self._register
 
+  def encode(self, addresses):
+    if self._register in SPECIAL_REGISTER_CODES:
+      return SPECIAL_REGISTER_CODES[self._register], []
+    return self._offset, []
+
   def to_llvm(self, out):
     return out.reg(self._register)
 
@@ -434,28 +496,63 @@ class Number(object):
   def __repr__(self):
     return 'Number(' + repr(self._num) + ')'
 
+  def value(self):
+    return self._num
+
+  def registers(self):
+    return []
+
   def extra_length(self):
-    return 0
+    # 0x00-0x1f fit in the argument itself.
+    if 0 <= self._num <= 0x1f:
+      return 0
+    return 1
 
   def to_das(self):
     return str(self._num)
 
+  def encode(self, addresses):
+    if self.extra_length() == 0:
+      return 0x20 + self._num, []
+    return 0x1f, [self._num & 0xffff]
+
   def to_llvm(self, out):
     return str(self._num)
 
 class Label(object):
   def __init__(self, label):
     self._label = label
+    self._short = True
+    self._pc = None
 
   def __repr__(self):
     return 'Label(' + repr(self._label) + ')'
 
+  def registers(self):
+    return []
+
   def extra_length(self):
-    return 0
+    return not self._short and 1 or 0
+
+  def set_short(self, short):
+    """Whether the label's address is encoded as a short literal; see Program._link."""
+    self._short = short
+
+  def set_pc(self, pc):
+    """The address the label resolved to; see Program._link."""
+    self._pc = pc
 
   def to_das(self):
     return self._label
 
+  def to_llvm(self, out):
+    return str(self._pc)
+
+  def encode(self, addresses):
+    if self._short:
+      return 0x20 + addresses[self._label], []
+    return 0x1f, [addresses[self._label]]
+
   def label(self):
     return self._label
 
@@ -467,12 +564,26 @@ class Addition(object):
   def __repr__(self):
     return 'Addition(' + repr(self._number) + ', ' + repr(self._register) + ')'
 
+  def number(self):
+    return self._number
+
+  def register(self):
+    return self._register
+
+  def registers(self):
+    return self._register.registers()
+
   def extra_length(self):
     return 1
 
   def to_das(self):
     return self._number.to_das() + '+' + self._register.to_das()
 
+  def encode(self, addresses):
+    if self._register.register() in SPECIAL_REGISTER_CODES:
+      raise AssembleError('cannot address [%s]' % self.to_das())
+    return 0x10 + self._register.offset(), [self._number.value() & 0xffff]
+
   def to_llvm(self, out):
     arg1 = self._number.to_llvm(out)
     arg2 = self._register.to_llvm(out)
@@ -487,37 +598,67 @@ class Dereference(object):
   def __repr__(self):
     return 'Dereference(' + repr(self._argument) + ')'
 
+  def argument(self):
+    return self._argument
+
+  def registers(self):
+    return self._argument.registers()
+
   def extra_length(self):
+    if isinstance(self._argument, Number):
+      # [next word] has no short form.
+      return 1
     return self._argument.extra_length()
 
   def to_das(self):
     return '[' + self._argument.to_das() + ']'
 
+  def encode(self, addresses):
+    argument = self._argument
+    if isinstance(argument, Number):
+      return 0x1e, [argument.value() & 0xffff]
+    if isinstance(argument, Register) and argument.register() not in SPECIAL_REGISTER_CODES:
+      return 0x08 + argument.offset(), []
+    if isinstance(argument, Addition):
+      return argument.encode(addresses)
+    raise AssembleError('cannot address %s' % self.to_das())
+
   def to_llvm(self, out):
     arg0 = self._argument.to_llvm(out)
-    tmp1 = out.temp_variable()
+    tmp1 = out.memory_pointer(arg0)
     tmp2 = out.temp_variable()
-    out.write_line('%s = getelementptr i16* %%memory, i16 %s' % (tmp1, arg0))
-    out.write_line('%s = load i16* %s' % (tmp2, tmp1))
-    out.write_line('call void @memory_referenced(%%struct.VMState* %%state, i16 %s)' % arg0)
+    out.write_line('%s = load i16* %s%s' % (tmp2, tmp1, out.tbaa('memory')))
+    out.memory_referenced(arg0)
     return tmp2
 
   def to_llvm_store(self, out, value):
     arg0 = self._argument.to_llvm(out)
-    tmp = out.temp_variable()
-    out.write_line('%s = getelementptr i16* %%memory, i16 %s' % (tmp, arg0))
-    out.write_line('store i16 %s, i16* %s' % (value, tmp))
-    out.write_line('call void @memory_referenced(%%struct.VMState* %%state, i16 %s)' % arg0)
+    tmp = out.memory_pointer(arg0)
+    out.write_line('store i16 %s, i16* %s%s' % (value, tmp, out.tbaa('memory')))
+    out.memory_referenced(arg0)
 
   def dump_reg(self, out):
     pass
 
 class Instruction(object):
-  def __init__(self, label, opcode, arguments):
+  def __init__(self, label, opcode, arguments, address=None):
     self._label = label
     self._opcode = opcode
     self._arguments = arguments
+    self._address = address
     self._pc = 0
+    self._cycles = None
+    self._line = None
+    self._text = None
+    # Opcode and arguments never change, so what kind of SET PC this is, if
+    # any, is worked out once rather than on every question about it.
+    set_pc = isinstance(opcode, SETOpcode) and isinstance(arguments[0], Register) and \
+      arguments[0].register() == 'PC'
+    self._jump_label = set_pc and isinstance(arguments[1], Label) and arguments[1].label() or None
+    self._is_return = set_pc and arguments[1] == Pop
+    self._is_computed_jump = set_pc and self._jump_label is None and not self._is_return
+    self._uses_stack = Pop in arguments or Peek in arguments or Push in arguments
+    self._is_condition = isinstance(opcode, (IFEOpcode, IFNOpcode, IFGOpcode, IFBOpcode))
 
   def __repr__(self):
     args = []
@@ -536,6 +677,10 @@ class Instruction(object):
   def label(self):
     return self._label
 
+  def address(self):
+    """Where a decoded instruction was in its image, or None."""
+    return self._address
+
   def pc(self):
     return self._pc
 
@@ -543,46 +688,170 @@ class Instruction(object):
     self._pc = pc
 
   def length(self):
-    if self.is_vm_instruction():
-      return 0
     return 1 + sum([x.extra_length() for x in self._arguments])
 
+  def cycles(self):
+    """Cycles taken per the DCPU-16 1.1 spec: a cost per opcode plus one per
+    extra word. A failing IF takes one more."""
+    if self._cycles is not None:
+      return self._cycles
+    return CYCLES[self._opcode.to_das()] + self.length() - 1
+
+  def set_cycles(self, cycles):
+    """Charges cycles instead, for an instruction that stands in for
+    another; see Program.inline."""
+    self._cycles = cycles
+
+  def line(self):
+    """The number of the source line the instruction came from, or None."""
+    return self._line
+
+  def set_line(self, line):
+    self._line = line
+
+  def stand_in(self, label, opcode, arguments):
+    """An instruction at this one's address, with its cycles and source,
+    that does something else; see Program.inline."""
+    result = Instruction(label, opcode, arguments, self._pc)
+    result._cycles = self.cycles()
+    result._line = self._line
+    result._text = self.text()
+    return result
+
+  def text(self):
+    """The instruction's label, if any, and assembly, which profile
+    counters are matched on. A stand-in has the text of the instruction it
+    stands in for."""
+    if self._text is not None:
+      return self._text
+    return (self._label and ':%s ' % self._label or '') + self.to_das()
+
+  def describe(self):
+    """The source line number, if known, and text, as profiles show them.
+    The line number is only there for people reading the profile."""
+    if self._line is None:
+      return self.text()
+    return '%d: %s' % (self._line, self.text())
+
+  def encode(self, addresses):
+    """The instruction's machine words; addresses maps labels to PCs."""
+    opcode = self._opcode.to_das()
+    codes = []
+    extra = []
+    for argument in self._arguments:
+      code, words = argument.encode(addresses)
+      codes.append(code)
+      extra += words
+    if opcode in BASIC_OPCODES:
+      return [BASIC_OPCODES.index(opcode) | codes[0] << 4 | codes[1] << 10] + extra
+    if not codes:
+      # DBG's argument is ignored.
+      codes = [0x20]
+    return [EXTENDED_CODES[opcode] << 4 | codes[0] << 10] + extra
+
   def jump_label(self):
-    if self._is_set_PC() and not self.is_return():
-      return self._arguments[1].label()
-    return None
+    return self._jump_label
 
   def is_return(self):
-    return self._is_set_PC() and self._arguments[1] == Pop
+    return self._is_return
+
+  def is_terminator(self):
+    return self._jump_label is not None or self._is_return or self._is_computed_jump
+
+  def is_condition(self):
+    return self._is_condition
+
+  def sets_overflow(self):
+    return isinstance(self._opcode, (ADDOpcode, SUBOpcode, MULOpcode, DIVOpcode, MODOpcode,
+                                     SHLOpcode, SHROpcode))
+
+  def registers_read(self):
+    """Registers whose value this instruction can observe."""
+    if isinstance(self._opcode, (DBGOpcode, JSROpcode)):
+      return set(registers.keys())
+    arguments = self._arguments
+    if isinstance(self._opcode, SETOpcode) and isinstance(arguments[0], Register):
+      arguments = arguments[1:]
+    result = set()
+    for argument in arguments:
+      result.update(argument.registers())
+    return result
 
-  def _is_set_PC(self):
-    return isinstance(self._opcode, SETOpcode) and isinstance(self._arguments[0], Register) and \
-      self._arguments[0].register() == 'PC'
+  def registers_written(self):
+    """Registers other than PC whose value this instruction can change."""
+    if isinstance(self._opcode, JSROpcode):
+      return set(registers.keys()) - set(['PC'])
+    result = set()
+    arguments = self._arguments
+    if arguments and isinstance(arguments[0], Register) and not self.is_condition() and \
+        not isinstance(self._opcode, OUTOpcode):
+      result.add(arguments[0].register())
+    if Pop in arguments or Push in arguments:
+      result.add('SP')
+    if self.sets_overflow():
+      result.add('O')
+    result.discard('PC')
+    return result
+
+  def is_computed_jump(self):
+    """Whether this is a SET PC to anything but a label or POP."""
+    return self._is_computed_jump
 
   def is_vm_instruction(self):
     return isinstance(self._opcode, DBGOpcode) or isinstance(self._opcode, OUTOpcode)
 
   def to_llvm(self, out):
     out.write_line('')
-    out.write_line('; %s' % self.to_das())
+    out.write_line('; ' + self.to_das())
     if self._label is not None:
       out.write_line('br label %%%s' % self._label)
       out.write_line('%s:' % self._label)
+    if out.cycles_due:
+      out.add_cycles(out.cycles_due)
+    if out.profile_slot is not None:
+      out.count_execution(out.profile_slot)
     out.set_reg('PC', self._pc)
-    if self.jump_label() is not None:
+    if self._jump_label is not None:
       out.dump_regs()
-      out.write_line('br label %%%s' % self.jump_label())
-      return True, self.jump_label(), None
-    elif self.is_return():
+      out.write_line('br label %%%s' % self._jump_label)
+      return True, self._jump_label, None
+    elif self._is_return:
+      # The return address JSR pushed is dropped; the return itself is native.
+      Pop.resolve(out)
       out.dump_regs()
-      out.write_line('ret void')
+      out.write_return()
+      return True, None, None
+    elif self._is_computed_jump:
+      target = self._arguments[1]
+      if target in (Pop, Peek, Push):
+        target = target.resolve(out)
+      out.computed_jump(target.to_llvm(out))
       return True, None, None
+    elif self._uses_stack:
+      # PUSH, POP and PEEK move SP once, in argument order, however many
+      # times the opcode then reads or writes them.
+      arguments = [x in (Pop, Peek, Push) and x.resolve(out) or x for x in self._arguments]
+      return False, None, self._opcode.to_llvm(out, arguments)
     else:
       return False, None, self._opcode.to_llvm(out, self._arguments)
 
   def to_das(self):
     return self._opcode.to_das() + ' ' + ', '.join([x.to_das() for x in self._arguments])
 
+class Value(object):
+  """An i16 the IR has already computed, such as a stack operand's address."""
+  def __init__(self, var):
+    self._var = var
+
+  def __repr__(self):
+    return 'Value(' + repr(self._var) + ')'
+
+  def registers(self):
+    return []
+
+  def to_llvm(self, out):
+    return self._var
+
 class Pop(object):
   def __repr__(self):
     return 'Pop()'
@@ -590,8 +859,22 @@ class Pop(object):
   def to_das(self):
     return 'POP'
 
+  def registers(self):
+    return ['SP']
+
   def extra_length(self):
     return 0
+
+  def encode(self, addresses):
+    return 0x18, []
+
+  def resolve(self, out):
+    # [SP++]
+    sp = out.reg('SP')
+    tmp = out.temp_variable()
+    out.write_line('%s = add i16 %s, 1' % (tmp, sp))
+    out.set_reg('SP', tmp)
+    return Dereference(Value(sp))
 Pop = Pop()
 
 class Peek(object):
@@ -601,8 +884,18 @@ class Peek(object):
   def to_das(self):
     return 'PEEK'
 
+  def registers(self):
+    return ['SP']
+
   def extra_length(self):
     return 0
+
+  def encode(self, addresses):
+    return 0x19, []
+
+  def resolve(self, out):
+    # [SP]
+    return Dereference(Value(out.reg('SP')))
 Peek = Peek()
 
 class Push(object):
@@ -612,47 +905,589 @@ class Push(object):
   def to_das(self):
     return 'PUSH'
 
+  def registers(self):
+    return ['SP']
+
   def extra_length(self):
     return 0
+
+  def encode(self, addresses):
+    return 0x1a, []
+
+  def resolve(self, out):
+    # [--SP]
+    tmp = out.temp_variable()
+    out.write_line('%s = sub i16 %s, 1' % (tmp, out.reg('SP')))
+    out.set_reg('SP', tmp)
+    return Dereference(Value(tmp))
 Push = Push()
 
+class BasicBlock(object):
+  """A run of instructions [start, end) that is only entered at its start.
+
+  IF instructions and the jumps they guard stay inside a block; a block ends
+  before a label or after an unconditional jump or return.
+  """
+  def __init__(self, start, end, label, terminated):
+    self._start = start
+    self._end = end
+    self._label = label
+    self._terminated = terminated
+    self._successors = []
+    self._predecessors = []
+    self._functions = []
+
+  def __repr__(self):
+    return 'BasicBlock(%d, %d, %r)' % (self._start, self._end, self._label)
+
+  def name(self):
+    return self._label or '@%d' % self._start
+
+  def start(self):
+    return self._start
+
+  def end(self):
+    return self._end
+
+  def label(self):
+    return self._label
+
+  def falls_through(self):
+    return not self._terminated
+
+  def successors(self):
+    return self._successors
+
+  def predecessors(self):
+    return self._predecessors
+
+  def functions(self):
+    return self._functions
+
 class Program(object):
-  def __init__(self, instructions):
+  def __init__(self, instructions, memory_image=None):
     self._instructions = instructions
+    self._memory_image = memory_image
     self._link()
 
   def __repr__(self):
     return 'Program([\n' + ',\n'.join([repr(x) for x in self._instructions]) + '])'
 
+  def instructions(self):
+    return self._instructions
+
+  def memory_image(self):
+    """Words loaded into memory from address 0 before running, or None."""
+    return self._memory_image
+
+  def label_index(self, label):
+    return self._label_map[label]
+
+  def skip_end(self, index):
+    """Where execution resumes when the IF at index fails."""
+    return self._skip_ends[index]
+
   def _make_label_map(self):
     return dict([(x[1].label(), x[0]) for x in enumerate(self._instructions) if x[1].label() is not None])
 
-  def _identify_function_labels(self):
-    return set([x.arguments()[0].label() for x in self._instructions if isinstance(x.opcode(), JSROpcode)])
+  def jump_targets(self):
+    """(pc, label) for each place a computed SET PC can go, by PC."""
+    targets = {}
+    for label in self._address_taken:
+      targets.setdefault(self._instructions[self._label_map[label]].pc(), label)
+    return sorted(targets.items())
 
   def _link(self):
-    pc = 0
-    for instruction in self._instructions:
-      instruction.set_pc(pc)
-      pc += instruction.length()
     self._label_map = self._make_label_map()
-    self._function_starts = self._identify_function_labels()
-    function_labels = {}
 
-  def _to_llvm_block(self, index, out):
+    # Label references start out as short literals. Any whose address turns
+    # out not to fit grows a word, which can only push later addresses up,
+    # so repeating until nothing grows terminates. Only the lengths of
+    # instructions whose references grew change from one pass to the next.
+    #
+    # The same pass over the references finds the labels JSR calls, which
+    # start functions, and the labels used as values rather than as jump or
+    # JSR targets, whose addresses can end up in PC through a register or
+    # memory.
+    instructions = self._instructions
+    references = []
+    self._function_starts = set()
+    self._address_taken = set()
+    for index, instruction in enumerate(instructions):
+      for x in instruction.arguments():
+        if isinstance(x, Label):
+          x.set_short(True)
+          references.append((index, x, self._label_map[x.label()]))
+          if isinstance(instruction.opcode(), JSROpcode):
+            self._function_starts.add(x.label())
+          elif instruction.jump_label() is None:
+            self._address_taken.add(x.label())
+    # A decoded instruction keeps the address it had in its image, so only
+    # the length of one followed by an instruction without an address counts.
+    addresses = [x.address() for x in instructions]
+    lengths = [0] * len(instructions)
+    for index in xrange(len(instructions) - 1):
+      if addresses[index + 1] is None:
+        lengths[index] = instructions[index].length()
+    growing = True
+    while growing:
+      pcs = []
+      pc = 0
+      for address, length in itertools.izip(addresses, lengths):
+        if address is not None:
+          pc = address
+        pcs.append(pc)
+        pc += length
+      growing = False
+      for index, reference, target in references:
+        if reference.extra_length() == 0 and pcs[target] > 0x1f:
+          reference.set_short(False)
+          if lengths[index]:
+            lengths[index] = instructions[index].length()
+          growing = True
+    for instruction, pc in itertools.izip(instructions, pcs):
+      instruction.set_pc(pc)
+    for index, reference, target in references:
+      reference.set_pc(pcs[target])
+
+    self._functions = [('runMachine', 0)] + \
+      sorted([(x, self._label_map[x]) for x in self._function_starts], key=lambda x: x[1])
+    self._build_cfg()
+
+  def _build_cfg(self):
+    instructions = self._instructions
+    count = len(instructions)
+    # Each of these costs a few isinstance calls; ask once per instruction.
+    conditions = [x.is_condition() for x in instructions]
+    terminators = [x.is_terminator() for x in instructions]
+    jump_labels = [x.jump_label() for x in instructions]
+    computed_jumps = [x.is_computed_jump() for x in instructions]
+    jump_targets = [self._label_map[label] for pc, label in self.jump_targets()]
+
+    # skip_ends[i] is where execution resumes when the IF at i fails: past the
+    # whole chain of IFs that follows it and the instruction they guard.
+    self._skip_ends = {}
+    resume = count
+    for index in xrange(count - 1, -1, -1):
+      if conditions[index]:
+        self._skip_ends[index] = resume
+      else:
+        resume = min(index + 1, count)
+
+    leaders = set(self._label_map.values())
+    if count > 0:
+      leaders.add(0)
+    for index in xrange(count):
+      guarded = index > 0 and conditions[index - 1] and index not in leaders
+      if terminators[index] and not guarded and index + 1 < count:
+        leaders.add(index + 1)
+
+    self._blocks = []
+    self._block_map = {}
+    # segment_heads[i] is where the straight-line run that always runs
+    # instruction i starts: the start of its block, or the instruction after
+    # a guarded jump or return. It is None if i only runs when the IF before
+    # it passes.
+    self._segment_heads = [None] * count
+    starts = sorted(leaders)
+    for start, end in zip(starts, starts[1:] + [count]):
+      head = start
+      for index in xrange(start, end):
+        if index > start and conditions[index - 1]:
+          if terminators[index]:
+            head = index + 1
+        else:
+          self._segment_heads[index] = head
+      last = end - 1
+      terminated = terminators[last] and not (last > start and conditions[last - 1])
+      block = BasicBlock(start, end, instructions[start].label(), terminated)
+      self._blocks.append(block)
+      self._block_map[start] = block
+
+    for block in self._blocks:
+      for index in xrange(block.start(), block.end()):
+        target = jump_labels[index]
+        if target is not None:
+          block.successors().append(self._block_map[self._label_map[target]])
+        elif computed_jumps[index]:
+          block.successors().extend([self._block_map[x] for x in jump_targets])
+      if block.falls_through() and block.end() < count:
+        block.successors().append(self._block_map[block.end()])
+      for successor in block.successors():
+        successor.predecessors().append(block)
+
+    self._function_blocks = {}
+    for name, start in self._functions:
+      reached = []
+      if start in self._block_map:
+        pending = [self._block_map[start]]
+        seen = set(pending)
+        while pending:
+          block = pending.pop()
+          reached.append(block)
+          block.functions().append(name)
+          for successor in block.successors():
+            if successor not in seen:
+              seen.add(successor)
+              pending.append(successor)
+      self._function_blocks[name] = sorted(reached, key=lambda x: x.start())
+
+  def _function_instructions(self, name):
+    for block in self._function_blocks[name]:
+      for index in xrange(block.start(), block.end()):
+        yield index, self._instructions[index]
+
+  def _call_graph(self):
+    """Maps each function to the set of functions it JSRs to."""
+    calls = {}
+    for name, start in self._functions:
+      calls[name] = set([x.arguments()[0].label() for index, x in self._function_instructions(name)
+                         if isinstance(x.opcode(), JSROpcode)])
+    return calls
+
+  def leaf_registers(self):
+    """Register-usage summaries of the leaf functions.
+
+    A leaf is a subroutine that neither makes a JSR nor runs DBG, so the
+    only registers it can see are the ones its instructions name. Maps each
+    leaf to (passed, written): the registers it reads or writes, which must
+    be in VMState when it is called, and the ones it can change.
+    """
+    result = {}
+    for name, start in self._functions[1:]:
+      read = set()
+      written = set()
+      leaf = True
+      for index, instruction in self._function_instructions(name):
+        if isinstance(instruction.opcode(), (JSROpcode, DBGOpcode)):
+          leaf = False
+          break
+        read.update(instruction.registers_read())
+        written.update(instruction.registers_written())
+      if leaf:
+        read.discard('PC')
+        result[name] = (read | written, written)
+    return result
+
+  def inline(self, limit, profile=None):
+    """Inlines subroutines at the DCPU level.
+
+    Every JSR to a subroutine of at most limit instructions, or with a single
+    call site, becomes a jump to a private copy of the subroutine's blocks,
+    whose returns jump back to the instruction after the JSR, pushing and
+    popping the return address as the call and return would. The copies are
+    appended past the end of the program and keep their original addresses,
+    so PC reads and DBG output don't change, and the jumps that stand in for
+    JSRs and returns charge their cycles. Code that can no longer run is
+    dropped along the way. Callees are inlined before their callers, a round
+    at a time, until no call qualifies; recursive subroutines never do, so
+    this terminates.
+
+    With a profile (as blockprofile.read() returns; see executions()),
+    calls that never ran are left alone and ones that ran at least a tenth as
+    often as the hottest code inline subroutines of up to 4 * limit
+    instructions.
+
+    Returns the new Program and the number of calls inlined.
+    """
+    program = self
+    serial = [0]
+    inlined = 0
+    while True:
+      program, sites = program._inline_calls(limit, serial, profile)
+      if not sites:
+        return program, inlined
+      inlined += sites
+
+  def _inline_calls(self, limit, serial, profile):
+    instructions = self._instructions
+    count = len(instructions)
+    calls = self._call_graph()
+
+    def reachable(name):
+      seen = set()
+      pending = list(calls[name])
+      while pending:
+        callee = pending.pop()
+        if callee not in seen:
+          seen.add(callee)
+          pending.extend(calls[callee])
+      return seen
+
+    # Only calls that can run matter; a subroutine whose every caller has
+    # been inlined is dead code and no longer counts as a call site.
+    live = reachable('runMachine') | set(['runMachine'])
+    sites = {}
+    for block in set([x for name in live for x in self._function_blocks[name]]):
+      for index in xrange(block.start(), block.end()):
+        if isinstance(instructions[index].opcode(), JSROpcode):
+          sites.setdefault(instructions[index].arguments()[0].label(), []).append(index)
+
+    hottest = profile and max([0] + [self.executions(x, profile) or 0 for x in xrange(count)]) or 0
+    def worth_inlining(site, size):
+      if profile is None:
+        return size <= limit
+      runs = self.executions(site, profile)
+      if not runs:
+        return False
+      return size <= (runs * 10 >= hottest and 4 * limit or limit)
+
+    chosen = {}
+    for name, indexes in sites.items():
+      if name in reachable(name) or \
+          any([x.is_computed_jump() for index, x in self._function_instructions(name)]):
+        continue
+      size = sum([x.end() - x.start() for x in self._function_blocks[name]])
+      chosen_sites = [x for x in indexes if len(indexes) == 1 or worth_inlining(x, size)]
+      if chosen_sites:
+        chosen[name] = chosen_sites
+    candidates = set(chosen)
+
+    replaced = {}
+    continuations = {}
+    copies = []
+    end = instructions[-1].pc() + instructions[-1].length()
+    for name in sorted(candidates):
+      # Bottom up: a subroutine is copied once its own calls are inlined,
+      # and its size is judged with them in it.
+      if calls[name] & candidates:
+        continue
+      blocks = self._function_blocks[name]
+      for site in sorted(chosen[name]):
+        if site + 1 >= count:
+          continue
+        serial[0] += 1
+        suffix = '.%d' % serial[0]
+        following = instructions[site + 1]
+        resume = following.label() or continuations.setdefault(site + 1, 'after' + suffix)
+        replaced[site] = name + suffix + '.call'
+        # The JSR's push and the returns' pop go on the way into and out of
+        # the copy, where no IF can guard them, and past the end of the
+        # program, where no profile counter is. SET PEEK, POP only moves SP:
+        # it writes the word it pops back where it was.
+        jsr = instructions[site]
+        copies.append(Instruction(name + suffix + '.call', opcodes['SET'],
+                                  [Push, Number(jsr.pc() + jsr.length())], end))
+        copies.append(Instruction(None, opcodes['SET'], [registers['PC'], Label(name + suffix)], end))
+        copies.append(Instruction(name + suffix + '.return', opcodes['SET'], [Peek, Pop], end))
+        copies.append(Instruction(None, opcodes['SET'], [registers['PC'], Label(resume)], end))
+        for x in copies[-4:]:
+          x.set_cycles(0)
+        for block in blocks:
+          for index in xrange(block.start(), block.end()):
+            instruction = instructions[index]
+            label = instruction.label() and instruction.label() + suffix
+            if instruction.is_return():
+              arguments = [registers['PC'], Label(name + suffix + '.return')]
+            elif instruction.jump_label() is not None:
+              arguments = [registers['PC'], Label(instruction.jump_label() + suffix)]
+            else:
+              arguments = [isinstance(x, Label) and Label(x.label()) or x for x in instruction.arguments()]
+            copies.append(instruction.stand_in(label, instruction.opcode(), arguments))
+          if block.falls_through() and block.end() == count:
+            # Running off the end of the program returns.
+            copies.append(Instruction(None, opcodes['SET'], [registers['PC'], Label(resume)], end))
+            copies[-1].set_cycles(0)
+    if not replaced:
+      return self, 0
+
+    # Code no live function reaches is dropped, so everything that is kept
+    # pins its address.
+    result = []
+    for block in self._blocks:
+      if not live.intersection(block.functions()) and block.label() not in self._address_taken:
+        continue
+      for index in xrange(block.start(), block.end()):
+        instruction = instructions[index]
+        label = instruction.label() or continuations.get(index)
+        if index in replaced:
+          opcode, arguments = opcodes['SET'], [registers['PC'], Label(replaced[index])]
+        else:
+          opcode, arguments = instruction.opcode(), instruction.arguments()
+        result.append(instruction.stand_in(label, opcode, arguments))
+    # The copies must not be reached by running off the end of the program,
+    # which returns without popping anything, so the end moves past them.
+    serial[0] += 1
+    exit_label = 'end.%d' % serial[0]
+    result.append(Instruction(None, opcodes['SET'], [registers['PC'], Label(exit_label)], end))
+    result[-1].set_cycles(0)
+    copies.append(Instruction(exit_label, opcodes['SET'], [registers['A'], registers['A']], end))
+    copies[-1].set_cycles(0)
+    return Program(result + copies, self._memory_image), len(replaced)
+
+  def _cycle_charges(self):
+    """What to add to the cycle counter as each instruction starts.
+
+    The instructions a block always runs are charged together at its start,
+    with an IF that heads a chain charged as failing. The pass edge of each
+    IF then charges what it guards, less the cycle a failing IF takes. A
+    guarded jump or return may leave the block, so whatever follows it is
+    charged separately, where the IF's failure rejoins.
+    """
+    charges = [0] * len(self._instructions)
+    for index, instruction in enumerate(self._instructions):
+      cost = instruction.cycles() + (instruction.is_condition() and 1 or 0)
+      head = self._segment_heads[index]
+      if head is None:
+        charges[index] = cost - 1
+      else:
+        charges[head] += cost
+    return charges
+
+  def _count_points(self):
+    """Where --profile-blocks counts: every segment head and every
+    instruction an IF guards, which between them say how often each
+    instruction ran; see executions()."""
+    heads = self._segment_heads
+    return sorted(set([x for x in heads if x is not None] +
+                      [index for index, head in enumerate(heads) if head is None]))
+
+  def executions(self, index, profile):
+    """How many times instruction index ran according to profile, a map
+    from (pc, text) to count, or None if the profile doesn't say.
+
+    A counter only counts if the instruction at its PC is still the one it
+    describes, so a profile of an older revision or of another program
+    says nothing about code that changed. Line numbers don't matter: adding
+    a comment keeps the profile.
+    """
+    point = self._segment_heads[index]
+    if point is None:
+      point = index
+    instruction = self._instructions[point]
+    return profile.get((instruction.pc(), instruction.text()))
+
+  def _branch_weights(self, profile):
+    # (passed, failed) for each IF the profile covers.
+    instructions = self._instructions
+    weights = {}
+    for index in xrange(len(instructions) - 1):
+      if instructions[index].is_condition() and self._segment_heads[index + 1] is None:
+        runs = self.executions(index, profile)
+        passed = self.executions(index + 1, profile)
+        if runs is not None and passed is not None:
+          weights[index] = (passed, max(runs - passed, 0))
+    return weights
+
+  def _guarded(self, index):
+    # Whether the instruction at index only runs if the IF before it passes.
+    return index > 0 and self._instructions[index - 1].is_condition() and \
+      index not in self._block_map
+
+  def _analyze_overflow(self):
+    """Backward liveness of O.
+
+    Sets self._overflow_needed[i] to whether the O written by instruction i
+    can be observed: read by a later instruction, printed by DBG, seen by a
+    JSR callee, or left in VMState when the function returns.
+    """
+    instructions = self._instructions
+    count = len(instructions)
+    self._overflow_needed = [True] * count
+    live_in = dict([(block, False) for block in self._blocks])
+
+    changed = True
+    while changed:
+      changed = False
+      for block in reversed(self._blocks):
+        if not block.falls_through():
+          live = False
+        elif block.end() < count:
+          live = live_in[self._block_map[block.end()]]
+        else:
+          live = True
+        for index in xrange(block.end() - 1, block.start() - 1, -1):
+          instruction = instructions[index]
+          guarded = self._guarded(index)
+          if instruction.is_return() or instruction.is_computed_jump():
+            # A computed jump can also end up in the fallback handler.
+            after = True
+          elif instruction.jump_label() is not None:
+            after = live_in[self._block_map[self._label_map[instruction.jump_label()]]]
+          else:
+            after = False
+          live = after or (guarded and live) or \
+            (not instruction.is_return() and instruction.jump_label() is None and live)
+          self._overflow_needed[index] = live
+          if instruction.sets_overflow() and not guarded:
+            live = False
+          if 'O' in instruction.registers_read():
+            live = True
+        if live != live_in[block]:
+          live_in[block] = live
+          changed = True
+
+    candidates = [i for i in xrange(count) if instructions[i].sets_overflow()]
+    removed = len([i for i in candidates if not self._overflow_needed[i]])
+    return removed, len(candidates)
+
+  def dump_cfg(self, f):
+    for name, start in self._functions:
+      print >>f, 'function %s: %s' % (name, ' '.join([x.name() for x in self._function_blocks[name]]))
+    for block in self._blocks:
+      print >>f, ''
+      print >>f, 'block %s [%d, %d) pc %d functions: %s' % (
+        block.name(), block.start(), block.end(), self._instructions[block.start()].pc(),
+        ' '.join(block.functions()) or '(unreachable)')
+      print >>f, '  successors: %s' % ' '.join([x.name() for x in block.successors()])
+      print >>f, '  predecessors: %s' % ' '.join([x.name() for x in block.predecessors()])
+      if not block.falls_through():
+        print >>f, '  ends with: %s' % self._instructions[block.end() - 1].to_das()
+      for index in xrange(block.start(), block.end()):
+        if index in self._skip_ends:
+          print >>f, '  if at %d skips to %d' % (index, self._skip_ends[index])
+
+  def _addresses(self):
+    return dict([(label, self._instructions[index].pc()) for label, index in self._label_map.items()])
+
+  def assemble(self):
+    """The program as a list of machine words, loaded at address 0.
+
+    Raises AssembleError if it does not fit in the 0x10000 words of memory.
+    """
+    addresses = self._addresses()
+    for label, address in sorted(addresses.items()):
+      if address > 0xffff:
+        raise AssembleError('label %s is at 0x%x, past the end of memory' % (label, address))
+    image = list(self._memory_image or [])
+    for instruction in self._instructions:
+      words = instruction.encode(addresses)
+      pc = instruction.pc()
+      if pc + len(words) > 0x10000:
+        raise AssembleError('%s at 0x%x runs past the end of memory' % (instruction.to_das(), pc))
+      if len(image) < pc + len(words):
+        image.extend([0] * (pc + len(words) - len(image)))
+      image[pc:pc + len(words)] = words
+    if len(image) > 0x10000:
+      raise AssembleError('the image is %d words; memory holds 0x10000' % len(image))
+    return image
+
+  def dump_listing(self, f):
+    addresses = self._addresses()
+    total_words = 0
+    for instruction in self._instructions:
+      words = instruction.encode(addresses)
+      total_words += len(words)
+      cycles = str(instruction.cycles())
+      if instruction.is_condition():
+        cycles += '+1'
+      label = instruction.label() and ':' + instruction.label() or ''
+      print >>f, '%04x  %-14s  %4s  %-12s %s' % (instruction.pc(), ' '.join(['%04x' % x for x in words]),
+                                                 cycles, label, instruction.to_das())
+    print >>f, ''
+    print >>f, '%d instructions, %d words; a failing IF takes the +1 cycle' % (len(self._instructions), total_words)
+
+  def _to_llvm_block(self, block, out):
     block_out = LLVM_Block_Out(out)
     block_out.reset_regs()
 
-    referenced_labels = set()
     post_conditions = []
-    first = True
-    for instruction in self._instructions[index:]:
-      if not first and instruction.label() is not None:
-        referenced_labels.add(instruction.label())
-        break
-
-      stop, label, post_condition = instruction.to_llvm(block_out)
-      done = stop and len(post_conditions) == 0
+    for index in xrange(block.start(), block.end()):
+      block_out.overflow_needed = self._overflow_needed[index]
+      block_out.cycles_due = self._cycles_due[index]
+      block_out.profile_slot = self._profile_slots[index]
+      block_out.branch_weights = self._branch_metadata.get(index, '')
+      stop, label, post_condition = self._instructions[index].to_llvm(block_out)
 
       if post_condition is None:
         for post_condition in post_conditions:
@@ -661,68 +1496,310 @@ class Program(object):
       else:
         post_conditions = [post_condition] + post_conditions
 
-      if label is not None:
-        referenced_labels.add(label)
-
-      if done:
-        break
-
-      first = False
-
     block_out.dump_regs()
 
-    return referenced_labels
-
-  def _to_llvm_function(self, name, index, out):
-    rendered_labels = set()
-    pending_labels = set([index])
-
-    start_label = self._instructions[index].label()
-    if start_label is not None:
-      rendered_labels.add(start_label)
-
-    out.write_line('define void @%s (%%struct.VMState* nocapture %%state) nounwind {' % name)
+  def _fall_through(self, block, next_block, out):
+    # Blocks are not always rendered in source order, so a block that runs off
+    # its end needs an explicit branch unless its successor comes next.
+    if block.end() < len(self._instructions):
+      successor = self._block_map[block.end()]
+      if successor is not next_block:
+        out.write_line('br label %%%s' % successor.label())
+    elif next_block is not None:
+      out.write_return()
+
+  def _to_llvm_function(self, name, index, out, leaf_registers, jump_targets):
+    # Blocks are rendered in source order of the ones reached so far, or
+    # hottest first given a profile; the worklist is a heap of (priority,
+    # instruction index), each index pushed at most once.
+    profile = out.options.profile
+    def priority(start):
+      if profile is None:
+        return start, start
+      return -(self.executions(start, profile) or 0), start
+    worklist = [priority(index)] if index in self._block_map else []
+    queued = set([index])
+
+    out.write_line('define void @%s (%%struct.VMState* %snocapture %%state) nounwind {' %
+                   (name, out.options.alias_metadata and 'noalias ' or ''))
     out.indent()
+    local = out.options.registers == 'local'
     for register in registers.values():
-      out.write_line('%%%s = getelementptr %%struct.VMState* %%state, i32 0, i32 0, i32 %s' % (register.register(), register.offset()))
+      # With local registers, %A etc. are allocas that mem2reg turns into SSA
+      # values, and %A.state etc. are the VMState slots behind them.
+      out.write_line('%%%s%s = getelementptr %%struct.VMState* %%state, i32 0, i32 0, i32 %s' %
+                     (register.register(), local and '.state' or '', register.offset()))
+      if local:
+        out.write_line('%%%s = alloca i16' % register.register())
     out.write_line('%memory = getelementptr %struct.VMState* %state, i32 0, i32 1, i32 0')
+    if name == 'runMachine' and self._memory_image:
+      size = len(self._memory_image)
+      out.write_line('%image = bitcast i16* %memory to i8*')
+      out.write_line('call void @llvm.memcpy.p0i8.p0i8.i32(i8* %%image, i8* bitcast ([%d x i16]* @image to i8*), '
+                     'i32 %d, i32 2, i1 false)' % (size, size * 2))
 
     func_out = LLVM_Function_Out(out)
-
-    while len(pending_labels) > 0:
-      sorted_labels = list(pending_labels)
-      sorted_labels.sort(key=lambda (x): (isinstance(x, int) and -1) or self._label_map[x])
-      label = sorted_labels[0]
-      rendered_labels.add(label)
-      if isinstance(label, basestring):
-        index = self._label_map[label]
-      else:
-        index = label
-      pending_labels = pending_labels.union(self._to_llvm_block(index, func_out))
-      pending_labels = pending_labels.difference(rendered_labels)
+    func_out.leaf_registers = leaf_registers
+    func_out.jump_targets = jump_targets
+    if name in leaf_registers:
+      passed, func_out.saved_registers = leaf_registers[name]
+      func_out.load_registers_from_state(passed)
+    else:
+      func_out.load_registers_from_state()
+
+    previous = None
+    while worklist:
+      block = self._block_map[heapq.heappop(worklist)[1]]
+      if previous is not None:
+        self._fall_through(previous, block, func_out)
+      self._to_llvm_block(block, func_out)
+      previous = block if block.falls_through() else None
+      for successor in block.successors():
+        if successor.start() not in queued:
+          queued.add(successor.start())
+          heapq.heappush(worklist, priority(successor.start()))
+    if previous is not None:
+      self._fall_through(previous, None, func_out)
 
     out.write_line('')
-    out.write_line('ret void')
+    func_out.write_return()
     out.dedent()
     out.write_line('}')
 
-  def to_llvm(self, out):
-    out.write_line('%struct.VMState = type { [11 x i16], [65536 x i16], [1024 x i8] }')
+  def to_llvm(self, out, function_out=None):
+    """Writes the program's module to out. With function_out, each
+    function goes to the LLVM_Out function_out(name) returns instead, and
+    out only gets the declarations and globals they share."""
+    if out.options.inline_limit is None:
+      self._write_llvm(out, function_out)
+    else:
+      program, inlined = self.inline(out.options.inline_limit, out.options.profile)
+      program._write_llvm(out, function_out)
+      self.stats = program.stats
+      self.stats['calls_inlined'] = inlined
+
+  def _write_llvm(self, out, function_out=None):
+    self.stats = {}
+    if out.options.lazy_overflow:
+      self.stats['overflow_removed'], self.stats['overflow_total'] = self._analyze_overflow()
+    else:
+      self._overflow_needed = [True] * len(self._instructions)
+    points = out.options.profile_blocks and self._count_points() or []
+    slot_pcs = sorted(set([self._instructions[x].pc() for x in points]))
+    extra = ''
+    if out.options.count_cycles or slot_pcs:
+      extra += ', i64'
+    if slot_pcs:
+      extra += ', [%d x i64]' % len(slot_pcs)
+    out.write_line('%%struct.VMState = type { [11 x i16], [65536 x i16], [1024 x i8]%s }' % extra)
     out.write_line('declare void @output(i16) nounwind')
     out.write_line('declare void @debug(%struct.VMState* nocapture) nounwind')
     out.write_line('declare void @memory_referenced(%struct.VMState* nocapture, i16) nounwind')
-    self._to_llvm_function('runMachine', 0, out)
-    for label in self._function_starts:
-      self._to_llvm_function(label, self._label_map[label], out)
+    if any([x.is_computed_jump() for x in self._instructions]):
+      out.write_line('declare void @unknown_jump(%struct.VMState* nocapture, i16) noreturn nounwind')
+    if self._memory_image:
+      out.write_line('declare void @llvm.memcpy.p0i8.p0i8.i32(i8* nocapture, i8* nocapture, i32, i32, i1) nounwind')
+      out.write_line('@image = internal constant [%d x i16] [i16 %s]' % (
+        len(self._memory_image), ', i16 '.join(map(str, self._memory_image))))
+    if out.options.alias_metadata:
+      out.write_line('!0 = metadata !{metadata !"dcpu16"}')
+      for kind, node in sorted(TBAA_NODES.items(), key=lambda x: x[1]):
+        out.write_line('!%d = metadata !{metadata !"%s", metadata !0}' % (node, kind))
+
+    # What each instruction adds to the cycle counter and which profile
+    # counter it bumps as it starts, and the !prof suffix of each IF's branch.
+    if out.options.count_cycles:
+      self._cycles_due = self._cycle_charges()
+    else:
+      self._cycles_due = [0] * len(self._instructions)
+    self._profile_slots = [None] * len(self._instructions)
+    if slot_pcs:
+      slots = dict([(pc, slot) for slot, pc in enumerate(slot_pcs)])
+      sources = {}
+      for index in points:
+        pc = self._instructions[index].pc()
+        self._profile_slots[index] = slots[pc]
+        sources.setdefault(pc, self._instructions[index].describe())
+      # emulator.c and jit.py find the counters' PCs and source lines here.
+      source = ''.join([sources[pc] + '\n' for pc in slot_pcs])
+      out.write_line('@profile_slots = constant i32 %d' % len(slot_pcs))
+      out.write_line('@profile_pcs = constant [%d x i16] [%s]' % (
+        len(slot_pcs), ', '.join(['i16 %d' % x for x in slot_pcs])))
+      out.write_line('@profile_source = constant [%d x i8] c"%s\\00"' % (len(source) + 1, llvm_string(source)))
+    self._branch_metadata = {}
+    if out.options.profile is not None:
+      nodes = {}
+      for index, weights in sorted(self._branch_weights(out.options.profile).items()):
+        # Weights are i32s.
+        scale = max(1, max(weights) / 0x7fffffff + 1)
+        weights = tuple([x / scale for x in weights])
+        if weights not in nodes:
+          nodes[weights] = len(TBAA_NODES) + 1 + len(nodes)
+          out.write_line('!%d = metadata !{metadata !"branch_weights", i32 %d, i32 %d}' % ((nodes[weights],) + weights))
+        self._branch_metadata[index] = ', !prof !%d' % nodes[weights]
+
+    leaf_registers = out.options.leaf_registers and self.leaf_registers() or {}
+    jump_targets = self.jump_targets()
+    for name, index in self._functions:
+      f_out = function_out and function_out(name) or out
+      self._to_llvm_function(name, index, f_out, leaf_registers, jump_targets)
+      f_out.flush()
+
+  def to_llvm_string(self):
+    out = LLVM_Out()
+    self.to_llvm(out)
+    return out.getvalue()
+
+  def to_llvm_modules(self, options):
+    """The program as one module per function, a list of (name, IR) with
+    runMachine first, to compile apart and link.
+
+    Each module declares only the callbacks and functions it calls and
+    numbers its own branch weights, and the globals go with runMachine, so
+    a function's module only changes when its own code does. That includes
+    its PCs, if it reads PC or runs DBG, and the registers its leaf callees
+    use, with --leaf-registers.
+    """
+    header = LLVM_Out(options=options)
+    functions = []
+    def function_out(name):
+      functions.append((name, LLVM_Out(options=options)))
+      return functions[-1][1]
+    self.to_llvm(header, function_out)
+    header_lines = header.getvalue().split('\n')
+    names = set([name for name, _ in functions])
+
+    modules = []
+    for name, f_out in functions:
+      body = f_out.getvalue()
+      referenced = set(SYMBOL_RE.findall(body))
+      nodes = {}
+      for number in METADATA_RE.findall(body):
+        number = int(number)
+        if number > len(TBAA_NODES) and number not in nodes:
+          nodes[number] = len(TBAA_NODES) + 1 + len(nodes)
+      def renumber(m):
+        return '!%d' % nodes.get(int(m.group(1)), int(m.group(1)))
+      lines = []
+      for line in header_lines:
+        if line.startswith('declare '):
+          if SYMBOL_RE.search(line).group(1) in referenced:
+            lines.append(line)
+        elif line.startswith('!'):
+          number = int(METADATA_RE.match(line).group(1))
+          if number <= len(TBAA_NODES) or number in nodes:
+            lines.append(METADATA_RE.sub(renumber, line, 1))
+        elif line and (not line.startswith('@') or name == 'runMachine'):
+          lines.append(line)
+      for callee in sorted(referenced & names - set([name])):
+        lines.append('declare void @%s(%%struct.VMState* nocapture) nounwind' % callee)
+      modules.append((name, '\n'.join(lines) + '\n' + METADATA_RE.sub(renumber, body)))
+    return modules
+
+class Options(object):
+  """Code generation choices. The defaults reproduce the original output.
+
+  memory_tracking: how loads and stores mark their page in pages_accessed:
+    'call'   -- call @memory_referenced (the emulator's implementation)
+    'inline' -- set the bit directly in the IR
+    'off'    -- don't track pages at all
+
+  registers: where DCPU registers live inside a function:
+    'state' -- in VMState; loaded and stored at every block boundary
+    'local' -- in allocas that LLVM promotes to SSA values; VMState is only
+               written before JSR and DBG and when the function returns
+
+  alias_metadata: tag register, memory and page-bitmap accesses with
+    distinct TBAA types and mark %state noalias, so LLVM knows a store to
+    DCPU memory never changes a register.
+
+  lazy_overflow: only compute O where a liveness analysis says it can be
+    observed.
+
+  inline_limit: if not None, inline subroutines of at most this many
+    instructions, and any called from one place; see Program.inline.
+
+  leaf_registers: have JSRs to leaf subroutines pass and reload only the
+    registers the subroutine uses; see Program.leaf_registers.
+
+  count_cycles: keep a running total of DCPU cycles in the i64 that then
+    ends VMState, added to once per block; see Program._cycle_charges.
+
+  profile_blocks: count how often each block and each IF's guarded
+    instruction runs, in i64s after the cycle counter. emulator.c and jit.py
+    merge the counts into a profile; see blockprofile.py.
+
+  profile: a profile to translate with, as blockprofile.read() returns, or
+    None. It orders blocks hottest first, picks calls to inline, and weights
+    the branches of IFs.
+  """
+  def __init__(self, memory_tracking='call', registers='state', alias_metadata=False,
+               lazy_overflow=False, inline_limit=None, leaf_registers=False, count_cycles=False,
+               profile_blocks=False, profile=None):
+    if memory_tracking not in MEMORY_TRACKING_MODES:
+      raise ValueError('unknown memory tracking mode %r' % memory_tracking)
+    if registers not in REGISTER_MODES:
+      raise ValueError('unknown register mode %r' % registers)
+    self.memory_tracking = memory_tracking
+    self.registers = registers
+    self.alias_metadata = alias_metadata
+    self.lazy_overflow = lazy_overflow
+    self.inline_limit = inline_limit
+    self.leaf_registers = leaf_registers
+    self.count_cycles = count_cycles
+    self.profile_blocks = profile_blocks
+    self.profile = profile
+
+  def key(self):
+    """A string that differs whenever the generated code would."""
+    return repr(sorted([(name, isinstance(value, dict) and sorted(value.items()) or value)
+                        for name, value in vars(self).items()]))
+
+MEMORY_TRACKING_MODES = ('call', 'inline', 'off')
+REGISTER_MODES = ('state', 'local')
+
+# Metadata node numbers of the TBAA types; see Program.to_llvm.
+TBAA_NODES = {
+  'register': 1,
+  'memory': 2,
+  'pages': 3,
+  'cycles': 4,
+  'profile': 5,
+}
+
+SYMBOL_RE = re.compile(r'@([-\w$.]+)')
+METADATA_RE = re.compile(r'!(\d+)')
+
+def llvm_string(text):
+  """text as the inside of an LLVM c"..." constant."""
+  return ''.join([(' ' <= x <= '~' and x not in '"\\') and x or '\\%02X' % ord(x) for x in text])
 
 class LLVM_Out(object):
-  def __init__(self, f):
-    self._f = f;
+  """Collects IR lines in memory and writes them out a whole function at a time.
+
+  With no file, the IR is kept in an in-memory buffer; see getvalue().
+  """
+  def __init__(self, f=None, options=None):
+    if f is None:
+      f = cStringIO.StringIO()
+    self._f = f
+    self.options = options or Options()
+    self._lines = []
     self._func_counter = 0
     self._indent = ''
 
   def write_line(self, s):
-    print >>self._f, self._indent + s
+    self._lines.append(self._indent + s)
+
+  def flush(self):
+    if self._lines:
+      self._lines.append('')
+      self._f.write('\n'.join(self._lines))
+      self._lines = []
+
+  def getvalue(self):
+    self.flush()
+    return self._f.getvalue()
 
   def indent(self):
     self._indent += '  '
@@ -740,9 +1817,15 @@ class LLVM_Function_Out(object):
     self._out = out;
     self._temp_counter = 0
     self._label_counter = 0
-
-  def write_line(self, s):
-    self._out.write_line(s)
+    self.options = out.options
+    # Bind straight to the underlying writer so each line costs one call.
+    self.write_line = out.write_line
+    # (passed, written) register names for each leaf callee, and the
+    # registers this function leaves in VMState, or None for all of them.
+    self.leaf_registers = {}
+    self.saved_registers = None
+    # (pc, label) for each target of a computed jump; see Program.jump_targets.
+    self.jump_targets = []
 
   def indent(self):
     self._out.indent()
@@ -760,16 +1843,63 @@ class LLVM_Function_Out(object):
     self._label_counter += 1
     return result
 
+  def tbaa(self, kind):
+    if self.options.alias_metadata:
+      return ', !tbaa !%d' % TBAA_NODES[kind]
+    return ''
+
+  def store_registers_to_state(self, names=None):
+    # Only needed when registers live in allocas: before calls that can see
+    # VMState, and on the way out of the function.
+    if self.options.registers == 'local':
+      for register in registers.keys():
+        if names is not None and register not in names:
+          continue
+        tmp = self.temp_variable()
+        self.write_line('%s = load i16* %%%s' % (tmp, register))
+        self.write_line('store i16 %s, i16* %%%s.state%s' % (tmp, register, self.tbaa('register')))
+
+  def load_registers_from_state(self, names=None):
+    if self.options.registers == 'local':
+      for register in registers.keys():
+        if names is not None and register not in names:
+          continue
+        tmp = self.temp_variable()
+        self.write_line('%s = load i16* %%%s.state%s' % (tmp, register, self.tbaa('register')))
+        self.write_line('store i16 %s, i16* %%%s' % (tmp, register))
+
+  def write_return(self):
+    self.store_registers_to_state(self.saved_registers)
+    self.write_line('ret void')
+
 class LLVM_Block_Out(object):
   def __init__(self, out):
     self._out = out;
+    self.options = out.options
+    self.write_line = out.write_line
+    self.temp_variable = out.temp_variable
+    self.store_registers_to_state = out.store_registers_to_state
+    self.load_registers_from_state = out.load_registers_from_state
+    self.write_return = out.write_return
+    self.tbaa = out.tbaa
+    self.leaf_registers = out.leaf_registers
+    self.jump_targets = out.jump_targets
+    self.overflow_needed = True
+    self.cycles_due = 0
+    self.profile_slot = None
+    self.branch_weights = ''
+    self._register_tbaa = out.tbaa('register')
     self.reset_regs()
 
-  def reset_regs(self):
-    self._reg_vars = dict([(x, (False, '%%%s' % x)) for x in registers.keys()])
-
-  def write_line(self, s):
-    self._out.write_line(s)
+  def reset_regs(self, names=None):
+    if names is None:
+      self._reg_vars = dict(INITIAL_REG_VARS)
+      # Registers whose value differs from what their slot holds.
+      self._changed = set()
+    else:
+      for x in names:
+        self._reg_vars[x] = (False, '%%%s' % x)
+        self._changed.discard(x)
 
   def indent(self):
     self._out.indent()
@@ -777,9 +1907,6 @@ class LLVM_Block_Out(object):
   def dedent(self):
     self._out.dedent()
 
-  def temp_variable(self):
-    return self._out.temp_variable()
-
   def label(self):
     return self._out.label()
 
@@ -787,19 +1914,94 @@ class LLVM_Block_Out(object):
     is_temp_var, var = self._reg_vars[register]
     if not is_temp_var:
       tmp = self.temp_variable()
-      self.write_line('%s = load i16* %s' % (tmp, var))
+      self.write_line('%s = load i16* %s%s' % (tmp, var, self._register_tbaa))
       var = tmp
       self._reg_vars[register] = (True, var)
     return var
 
   def set_reg(self, register, value):
     self._reg_vars[register] = (True, value)
-
-  def dump_regs(self, include_PC = False):
+    self._changed.add(register)
+
+  def memory_pointer(self, address):
+    # Addresses are unsigned; an i16 GEP index would be sign-extended and
+    # send 0x8000-0xFFFF below the start of memory.
+    if not address.isdigit():
+      index = self.temp_variable()
+      self.write_line('%s = zext i16 %s to i32' % (index, address))
+      address = index
+    tmp = self.temp_variable()
+    self.write_line('%s = getelementptr i16* %%memory, i32 %s' % (tmp, address))
+    return tmp
+
+  def memory_referenced(self, address):
+    mode = self.options.memory_tracking
+    if mode == 'call':
+      self.write_line('call void @memory_referenced(%%struct.VMState* %%state, i16 %s)' % address)
+    elif mode == 'inline':
+      # pages_accessed has one bit per 8-word page: byte address / 64, bit (address / 8) % 8.
+      ptr = self.temp_variable()
+      if address.isdigit():
+        index = str(int(address) >> 6)
+        mask = str(1 << ((int(address) >> 3) & 7))
+      else:
+        byte = self.temp_variable()
+        index = self.temp_variable()
+        page = self.temp_variable()
+        page8 = self.temp_variable()
+        bit = self.temp_variable()
+        mask = self.temp_variable()
+        self.write_line('%s = lshr i16 %s, 6' % (byte, address))
+        self.write_line('%s = zext i16 %s to i32' % (index, byte))
+        self.write_line('%s = lshr i16 %s, 3' % (page, address))
+        self.write_line('%s = trunc i16 %s to i8' % (page8, page))
+        self.write_line('%s = and i8 %s, 7' % (bit, page8))
+        self.write_line('%s = shl i8 1, %s' % (mask, bit))
+      old = self.temp_variable()
+      new = self.temp_variable()
+      self.write_line('%s = getelementptr %%struct.VMState* %%state, i32 0, i32 2, i32 %s' % (ptr, index))
+      self.write_line('%s = load i8* %s%s' % (old, ptr, self.tbaa('pages')))
+      self.write_line('%s = or i8 %s, %s' % (new, old, mask))
+      self.write_line('store i8 %s, i8* %s%s' % (new, ptr, self.tbaa('pages')))
+
+  def add_cycles(self, cycles):
+    ptr = self.temp_variable()
+    old = self.temp_variable()
+    new = self.temp_variable()
+    self.write_line('%s = getelementptr %%struct.VMState* %%state, i32 0, i32 3' % ptr)
+    self.write_line('%s = load i64* %s%s' % (old, ptr, self.tbaa('cycles')))
+    self.write_line('%s = add i64 %s, %d' % (new, old, cycles))
+    self.write_line('store i64 %s, i64* %s%s' % (new, ptr, self.tbaa('cycles')))
+
+  def count_execution(self, slot):
+    ptr = self.temp_variable()
+    old = self.temp_variable()
+    new = self.temp_variable()
+    self.write_line('%s = getelementptr %%struct.VMState* %%state, i32 0, i32 4, i32 %d' % (ptr, slot))
+    self.write_line('%s = load i64* %s%s' % (old, ptr, self.tbaa('profile')))
+    self.write_line('%s = add i64 %s, 1' % (new, old))
+    self.write_line('store i64 %s, i64* %s%s' % (new, ptr, self.tbaa('profile')))
+
+  def computed_jump(self, target):
+    # Known targets are dispatched by PC. Anything else goes to the runtime's
+    # @unknown_jump with VMState up to date and PC at the jump.
+    self.dump_regs()
+    fallback = self.label()
+    self.write_line('switch i16 %s, label %%%s [%s]' % (
+      target, fallback, ' '.join(['i16 %d, label %%%s' % x for x in self.jump_targets])))
+    self.write_line('%s:' % fallback)
+    self.dump_regs(True, names=['PC'])
+    self.store_registers_to_state()
+    self.write_line('call void @unknown_jump(%%struct.VMState* %%state, i16 %s) noreturn nounwind' % target)
+    self.write_line('unreachable')
+
+  def dump_regs(self, include_PC = False, names=None):
+    # A register that was only loaded, or was stored since it last changed,
+    # already has its value in its slot.
     for register, (is_temp_var, var) in self._reg_vars.items():
-      if register != 'PC' or include_PC:
-        if is_temp_var:
-          self.write_line('store i16 %s, i16* %%%s' % (var, register))
+      if register in self._changed and (register != 'PC' or include_PC) and (names is None or register in names):
+        self.write_line('store i16 %s, i16* %%%s%s' % (var, register, self._register_tbaa))
+        self._changed.discard(register)
 
 opcodes = {
   'SET': SETOpcode(),
@@ -835,64 +2037,769 @@ registers = {
   'PC': Register('PC', 9),
   'O': Register('O', 10),
 }
+# What LLVM_Block_Out starts each block with: every register still in its
+# slot. A list, so each block's dict is built in the same order and dumps
+# its registers in the same order.
+INITIAL_REG_VARS = [(x, (False, '%%%s' % x)) for x in registers.keys()]
+
+class ParseError(Exception):
+  def __init__(self, message, line_number, line):
+    super(ParseError, self).__init__('line %d: %s: %r' % (line_number, message, line))
+    self.line_number = line_number
+    self.line = line
+
+TOKEN_RE = re.compile(r'[ \t\r]*(?:(?P<label>:[A-Za-z]+)|0x(?P<hex>[0-9A-Fa-f]+)|(?P<dec>[0-9]+)|'
+                      r'(?P<word>[A-Za-z]+)|(?P<punct>[\[\]+,])|(?P<comment>;.*)|(?P<end>$))')
+
+stack_arguments = {
+  'POP': Pop,
+  'PEEK': Peek,
+  'PUSH': Push,
+}
 
-ParserElement.setDefaultWhitespaceChars(' \t')
+class Parser(object):
+  """Single-pass recursive-descent parser for DCPU-16 assembly.
+
+  Accepts the same language as the pyparsing grammar and builds the same
+  Instruction/argument objects, but scans each line exactly once instead of
+  trying every alternative of an Or and keeping the longest match.
+  """
+
+  def parse(self, source):
+    instructions = []
+    for line_number, line in enumerate(source.split('\n'), 1):
+      self._tokenize(line, line_number)
+      instruction = self._instruction()
+      if instruction is not None:
+        instructions.append(instruction)
+    return Program(instructions)
+
+  def parse_file(self, f):
+    return self.parse(f.read())
+
+  def _tokenize(self, line, line_number):
+    self._line = line
+    self._line_number = line_number
+    self._tokens = tokens = []
+    self._pos = 0
+    match = TOKEN_RE.match
+    pos = 0
+    while True:
+      m = match(line, pos)
+      if m is None:
+        self._error('unexpected character')
+      kind = m.lastgroup
+      if kind == 'end' or kind == 'comment':
+        break
+      tokens.append((kind, m.group(kind)))
+      pos = m.end()
+    tokens.append(('end', None))
+
+  def _error(self, message):
+    raise ParseError(message, self._line_number, self._line)
+
+  def _next(self):
+    token = self._tokens[self._pos]
+    self._pos += 1
+    return token
+
+  def _peek(self):
+    return self._tokens[self._pos]
+
+  def _expect(self, text):
+    if self._next() != ('punct', text):
+      self._error('expected %r' % text)
+
+  def _instruction(self):
+    kind, value = self._next()
+    label = None
+    if kind == 'label':
+      label = value[1:]
+      kind, value = self._next()
+    if kind == 'end':
+      if label is not None:
+        self._error('label without instruction')
+      return None
+    if kind != 'word' or value not in opcodes:
+      self._error('expected opcode')
+
+    arguments = []
+    if self._peek()[0] != 'end':
+      arguments.append(self._argument())
+      while self._peek()[0] != 'end':
+        self._expect(',')
+        arguments.append(self._argument())
+    instruction = Instruction(label, opcodes[value], arguments)
+    instruction.set_line(self._line_number)
+    return instruction
+
+  def _argument(self):
+    kind, value = self._peek()
+    if kind == 'punct' and value == '[':
+      self._next()
+      argument = self._basic_argument()
+      self._expect(']')
+      return Dereference(argument)
+    if kind == 'word' and value not in registers:
+      self._next()
+      if value in stack_arguments:
+        return stack_arguments[value]
+      return Label(value)
+    return self._basic_argument()
+
+  def _basic_argument(self):
+    kind, value = self._next()
+    if kind == 'word' and value in registers:
+      return registers[value]
+    if kind == 'hex':
+      number = Number(int(value, 16))
+    elif kind == 'dec':
+      number = Number(int(value))
+    else:
+      self._error('expected register or number')
+    if self._peek() == ('punct', '+'):
+      self._next()
+      kind, value = self._next()
+      if kind != 'word' or value not in registers:
+        self._error('expected register')
+      return Addition(number, registers[value])
+    return number
+
+class DecodeError(Exception):
+  pass
+
+class AssembleError(Exception):
+  pass
+
+BASIC_OPCODES = [None, 'SET', 'ADD', 'SUB', 'MUL', 'DIV', 'MOD', 'SHL', 'SHR', 'AND', 'OR', 'XOR',
+                 'IFE', 'IFN', 'IFG', 'IFB']
+
+# 0x3e and 0x3f are reserved in the DCPU-16 1.1 spec; we use them for the
+# emulator's OUT and DBG. DBG ignores its argument.
+EXTENDED_OPCODES = {
+  0x01: 'JSR',
+  0x3e: 'OUT',
+  0x3f: 'DBG',
+}
 
-OPCODE = Or([Literal(x) for x in opcodes.keys()])
-OPCODE.setParseAction(lambda s,l,t: opcodes[t[0]])
+EXTENDED_CODES = dict([(x[1], x[0]) for x in EXTENDED_OPCODES.items()])
 
-REGISTER = Or([Literal(x) for x in registers.keys()])
+REGISTER_CODES = ['A', 'B', 'C', 'X', 'Y', 'Z', 'I', 'J']
 
-COMMENT = Suppress(';' + CharsNotIn('\n')*(0,1))
+SPECIAL_REGISTER_CODES = {
+  'SP': 0x1b,
+  'PC': 0x1c,
+  'O': 0x1d,
+}
 
-REGISTER_ARGUMENT = REGISTER
-REGISTER_ARGUMENT.setParseAction(lambda s,l,t: registers[t[0]])
+# Base cycle counts from the DCPU-16 1.1 spec. OUT and DBG aren't in the spec;
+# count them like SET.
+CYCLES = {
+  'SET': 1, 'AND': 1, 'OR': 1, 'XOR': 1,
+  'ADD': 2, 'SUB': 2, 'MUL': 2, 'SHR': 2, 'SHL': 2,
+  'DIV': 3, 'MOD': 3,
+  'IFE': 2, 'IFN': 2, 'IFG': 2, 'IFB': 2,
+  'JSR': 2,
+  'OUT': 1, 'DBG': 1,
+}
 
-HEX_ARGUMENT = '0x' + Word('0123456789ABCDEF')
-HEX_ARGUMENT.setParseAction(lambda s,l,t: Number(int(t[1], 16)))
+def _short_arguments():
+  # Arguments that need no extra word are the same objects every time.
+  arguments = {}
+  for code, register in enumerate(REGISTER_CODES):
+    arguments[code] = registers[register]
+    arguments[code + 0x08] = Dereference(registers[register])
+  arguments.update({
+    0x18: Pop,
+    0x19: Peek,
+    0x1a: Push,
+  })
+  for register, code in SPECIAL_REGISTER_CODES.items():
+    arguments[code] = registers[register]
+  for code in xrange(0x20, 0x40):
+    arguments[code] = Number(code - 0x20)
+  return arguments
+SHORT_ARGUMENTS = _short_arguments()
+
+def address_label(address):
+  # Labels are letters only, so spell the address's hex digits as a-p.
+  return 'x' + ''.join([chr(ord('a') + int(x, 16)) for x in '%04x' % address])
+
+class Decoder(object):
+  """Decodes an assembled DCPU-16 image into a Program.
+
+  Only code reachable from address 0 is decoded, following fall-through,
+  IF skips, and jumps and JSRs to literal addresses, so data in the image is
+  never mistaken for instructions. Jump targets get labels from
+  address_label(), and the whole image is loaded into memory before
+  runMachine starts, as it would be on the hardware.
+  """
+  def __init__(self, byte_order='big'):
+    self._swap = (byte_order == 'big') != (sys.byteorder == 'big')
+
+  def decode(self, image):
+    """image is a buffer of 16-bit words, such as a string or mmap."""
+    # The words go straight from the buffer into an array, swapped in place
+    # if need be, which is then both what is decoded and the memory image.
+    self._words = words = array.array('H')
+    words.fromstring(buffer(image, 0, len(image) & ~1))
+    if self._swap:
+      words.byteswap()
+    self._decoded = decoded = {}
+
+    # Trailing zero words are padding, not code, and memory past the image
+    # reads as zero anyway.
+    end = len(words)
+    while end > 0 and words[end - 1] == 0:
+      end -= 1
+    del words[end:]
+
+    reached = set()
+    targets = set()
+    pending = end > 0 and [0] or []
+    instruction = self._instruction
+    while pending:
+      address = pending.pop()
+      # Follow straight-line code without going through pending.
+      while address < end and address not in reached:
+        reached.add(address)
+        opcode, arguments, length, target, falls_through = instruction(address)
+        if target is not None:
+          if target >= end:
+            raise DecodeError('0x%04x: jump to 0x%04x, past the end of the program' % (address, target))
+          targets.add(target)
+          pending.append(target)
+        if opcode in ('IFE', 'IFN', 'IFG', 'IFB') and address + length < end:
+          # Execution resumes after the guarded instruction when the IF fails.
+          pending.append(address + length + instruction(address + length)[2])
+        if not falls_through:
+          break
+        address += length
+
+    instructions = []
+    previous_end = 0
+    for address in sorted(reached):
+      if address < previous_end:
+        raise DecodeError('0x%04x: jump into the middle of an instruction' % address)
+      opcode, arguments, length, target, falls_through = decoded[address]
+      label = address in targets and address_label(address) or None
+      instructions.append(Instruction(label, opcodes[opcode], arguments, address))
+      previous_end = address + length
+
+    return Program(instructions, words)
+
+  def _word(self, address):
+    if address >= len(self._words):
+      return 0
+    return self._words[address]
+
+  def _instruction(self, address):
+    """Returns (opcode, arguments, length in words, jump target, falls through)."""
+    if address in self._decoded:
+      return self._decoded[address]
+    word = self._word(address)
+    basic = word & 0xf
+    a = (word >> 4) & 0x3f
+    b = (word >> 10) & 0x3f
+    if basic == 0:
+      opcode = EXTENDED_OPCODES.get(a)
+      if opcode is None:
+        raise DecodeError('0x%04x: invalid instruction %04x' % (address, word))
+      codes = opcode != 'DBG' and [b] or []
+    else:
+      opcode = BASIC_OPCODES[basic]
+      codes = [a, b]
+
+    length = 1
+    arguments = []
+    literals = []
+    for code in codes:
+      if code in SHORT_ARGUMENTS:
+        arguments.append(SHORT_ARGUMENTS[code])
+        if code >= 0x20:
+          literals.append(code - 0x20)
+        else:
+          literals.append(None)
+        continue
+      value = self._word(address + length)
+      length += 1
+      if code == 0x1f:
+        arguments.append(Number(value))
+        literals.append(value)
+        continue
+      if code == 0x1e:
+        arguments.append(Dereference(Number(value)))
+      else:
+        arguments.append(Dereference(Addition(Number(value), registers[REGISTER_CODES[code - 0x10]])))
+      literals.append(None)
+
+    target = None
+    falls_through = True
+    if opcode == 'SET' and a == 0x1c:
+      falls_through = False
+      target = literals[1]
+    elif opcode == 'JSR':
+      target = literals[0]
+    if target is not None:
+      arguments[-1] = Label(address_label(target))
+    result = self._decoded[address] = opcode, arguments, length, target, falls_through
+    return result
 
-DEC_ARGUMENT = Word(nums)
-DEC_ARGUMENT.setParseAction(lambda s,l,t: Number(int(t[0])))
+def read_image(f):
+  """The contents of f, mapped rather than copied when f is a regular file."""
+  try:
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  except (EnvironmentError, ValueError):
+    # A pipe, or an empty file.
+    return f.read()
 
-NUMERIC_ARGUMENT = HEX_ARGUMENT ^ DEC_ARGUMENT
+_pyparsing_program = None
 
-ADD_ARGUMENT = NUMERIC_ARGUMENT + '+' + REGISTER
-ADD_ARGUMENT.setParseAction(lambda s,l,t: Addition(t[0], t[2]))
+def pyparsing_grammar():
+  global _pyparsing_program
+  if _pyparsing_program is not None:
+    return _pyparsing_program
+  if pyparsing is None:
+    raise ImportError('pyparsing is not installed')
+  from pyparsing import ParserElement, Or, Literal, Suppress, CharsNotIn, Word, nums, alphas
 
-BASIC_ARGUMENT = ADD_ARGUMENT ^ REGISTER ^ NUMERIC_ARGUMENT
+  ParserElement.setDefaultWhitespaceChars(' \t')
 
-DEREFERENCED_ARGUMENT = '[' + BASIC_ARGUMENT + ']'
-DEREFERENCED_ARGUMENT.setParseAction(lambda s,l,t: Dereference(t[1]))
+  OPCODE = Or([Literal(x) for x in opcodes.keys()])
+  OPCODE.setParseAction(lambda s,l,t: opcodes[t[0]])
 
-LABEL_ARGUMENT = Word(alphas)
-LABEL_ARGUMENT.setParseAction(lambda s,l,t: Label(t[0]))
+  REGISTER = Or([Literal(x) for x in registers.keys()])
 
-POP_ARGUMENT = Literal('POP')
-POP_ARGUMENT.setParseAction(lambda s,l,t: Pop)
+  COMMENT = Suppress(';' + CharsNotIn('\n')*(0,1))
 
-PEEK_ARGUMENT = Literal('PEEK')
-PEEK_ARGUMENT.setParseAction(lambda s,l,t: Peek)
+  REGISTER_ARGUMENT = REGISTER
+  REGISTER_ARGUMENT.setParseAction(lambda s,l,t: registers[t[0]])
 
-PUSH_ARGUMENT = Literal('PUSH')
-PUSH_ARGUMENT.setParseAction(lambda s,l,t: Push)
+  HEX_ARGUMENT = '0x' + Word('0123456789ABCDEF')
+  HEX_ARGUMENT.setParseAction(lambda s,l,t: Number(int(t[1], 16)))
 
-ARGUMENT = DEREFERENCED_ARGUMENT ^ BASIC_ARGUMENT ^ \
-           POP_ARGUMENT ^ PEEK_ARGUMENT ^ PUSH_ARGUMENT ^ LABEL_ARGUMENT
+  DEC_ARGUMENT = Word(nums)
+  DEC_ARGUMENT.setParseAction(lambda s,l,t: Number(int(t[0])))
 
-LABEL = Word(':', alphas)
+  NUMERIC_ARGUMENT = HEX_ARGUMENT ^ DEC_ARGUMENT
 
-INSTRUCTION = LABEL*(0,1) + OPCODE + (ARGUMENT + (Suppress(',') + ARGUMENT)*(0,))*(0,1)
-def make_instruction(s,l,t):
-  if isinstance(t[0], basestring):
-    return Instruction(t[0][1:], t[1], t[2:])
-  else:
-    return Instruction(None, t[0], t[1:])
-INSTRUCTION.setParseAction(make_instruction)
+  ADD_ARGUMENT = NUMERIC_ARGUMENT + '+' + REGISTER
+  ADD_ARGUMENT.setParseAction(lambda s,l,t: Addition(t[0], t[2]))
+
+  BASIC_ARGUMENT = ADD_ARGUMENT ^ REGISTER ^ NUMERIC_ARGUMENT
+
+  DEREFERENCED_ARGUMENT = '[' + BASIC_ARGUMENT + ']'
+  DEREFERENCED_ARGUMENT.setParseAction(lambda s,l,t: Dereference(t[1]))
+
+  LABEL_ARGUMENT = Word(alphas)
+  LABEL_ARGUMENT.setParseAction(lambda s,l,t: Label(t[0]))
+
+  POP_ARGUMENT = Literal('POP')
+  POP_ARGUMENT.setParseAction(lambda s,l,t: Pop)
+
+  PEEK_ARGUMENT = Literal('PEEK')
+  PEEK_ARGUMENT.setParseAction(lambda s,l,t: Peek)
+
+  PUSH_ARGUMENT = Literal('PUSH')
+  PUSH_ARGUMENT.setParseAction(lambda s,l,t: Push)
+
+  ARGUMENT = DEREFERENCED_ARGUMENT ^ BASIC_ARGUMENT ^ \
+             POP_ARGUMENT ^ PEEK_ARGUMENT ^ PUSH_ARGUMENT ^ LABEL_ARGUMENT
 
-LINE = INSTRUCTION*(0,1) + COMMENT*(0,1) + Suppress(Literal('\n'))
+  LABEL = Word(':', alphas)
 
-PROGRAM = LINE*(0,)
-PROGRAM.setParseAction(lambda s,l,t: Program(t))
+  INSTRUCTION = LABEL*(0,1) + OPCODE + (ARGUMENT + (Suppress(',') + ARGUMENT)*(0,))*(0,1)
+  def make_instruction(s,l,t):
+    if isinstance(t[0], basestring):
+      return Instruction(t[0][1:], t[1], t[2:])
+    else:
+      return Instruction(None, t[0], t[1:])
+  INSTRUCTION.setParseAction(make_instruction)
+
+  LINE = INSTRUCTION*(0,1) + COMMENT*(0,1) + Suppress(Literal('\n'))
+
+  PROGRAM = LINE*(0,)
+  PROGRAM.setParseAction(lambda s,l,t: Program(t))
+
+  _pyparsing_program = PROGRAM
+  return PROGRAM
+
+def parse(source, use_pyparsing=False):
+  if use_pyparsing:
+    return pyparsing_grammar().parseString(source)[0]
+  return Parser().parse(source)
 
-program = PROGRAM.parseFile(sys.stdin)
-program[0].to_llvm(LLVM_Out(sys.stdout))
+def translate(source, options, source_format='das', use_pyparsing=False):
+  """The IR for source, assembly or (source_format 'big' or 'little') an
+  assembled image. Raises ParseError or DecodeError."""
+  if source_format == 'das':
+    program = parse(source, use_pyparsing)
+  else:
+    program = Decoder(source_format).decode(source)
+  out = LLVM_Out(options=options)
+  program.to_llvm(out)
+  return out.getvalue()
+
+def translation_key(source, options, source_format='das'):
+  """The cache key for translating source, in source_format, with options."""
+  return cache.digest('ll', cache.file_digest(__file__), options.key(), source_format, source)
+
+def batch_inputs(paths, extension='.das'):
+  """The (path, name) of each file to translate in a batch over paths.
+
+  A directory stands for every file under it that ends in extension, named by
+  its path relative to the directory; a file stands for itself, named by its
+  base name.
+  """
+  inputs = []
+  for path in paths:
+    if not os.path.isdir(path):
+      inputs.append((path, os.path.basename(path)))
+      continue
+    for directory, subdirectories, files in os.walk(path):
+      subdirectories.sort()
+      for name in sorted(files):
+        if name.endswith(extension):
+          full = os.path.join(directory, name)
+          inputs.append((full, os.path.relpath(full, path)))
+  return inputs
+
+_batch_args = None
+_batch_cache = None
+
+def _start_batch(args):
+  global _batch_args, _batch_cache
+  _batch_args = args
+  _batch_cache = args.cache_dir and cache.Cache(args.cache_dir) or None
+
+def _translate_batch_input(task):
+  """Translates one batch input; the worker's half of translate_batch().
+
+  Writes the IR to output if given, otherwise returns it. Returns
+  (path, ir, error message), catching everything so one bad input can't
+  stop the batch.
+  """
+  path, output = task
+  args = _batch_args
+  try:
+    f = open(path, 'rb')
+    source = f.read()
+    f.close()
+    options = options_from_args(args)
+    ir = None
+    if _batch_cache is not None:
+      key = translation_key(source, options, args.binary or 'das')
+      ir = _batch_cache.get(key)
+    if ir is None:
+      ir = translate(source, options, args.binary or 'das', args.pyparsing)
+      if _batch_cache is not None:
+        _batch_cache.put(key, ir)
+    if output is None:
+      return path, ir, None
+    directory = os.path.dirname(output)
+    if directory and not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # Another worker made it first.
+        pass
+    f = open(output, 'w')
+    f.write(ir)
+    f.close()
+    return path, None, None
+  except (ParseError, DecodeError, EnvironmentError), e:
+    return path, None, str(e)
+  except Exception, e:
+    return path, None, 'internal error: %s: %s' % (e.__class__.__name__, e)
+
+def translate_batch(args, inputs, jobs=None):
+  """Translates inputs, as batch_inputs() returns them, on a pool of jobs
+  processes (one per core by default).
+
+  Each input goes to a .ll file of the same name, under args.output_dir if
+  set and next to the input otherwise, or with args.link, into one module
+  linked by link_modules(). Yields (path, error message or None) in input
+  order as each input finishes.
+  """
+  tasks = []
+  for path, name in inputs:
+    output = None
+    if not args.link:
+      if args.output_dir:
+        output = os.path.join(args.output_dir, os.path.splitext(name)[0] + '.ll')
+      else:
+        output = os.path.splitext(path)[0] + '.ll'
+    tasks.append((path, output))
+  if args.pyparsing:
+    # Built once here, so forked workers start with it.
+    pyparsing_grammar()
+  if jobs == 1:
+    _start_batch(args)
+    results = (_translate_batch_input(x) for x in tasks)
+  else:
+    pool = multiprocessing.Pool(jobs, _start_batch, (args,))
+    results = pool.imap(_translate_batch_input, tasks, chunksize=8)
+  modules = []
+  prefixes = set()
+  for (path, name), (_, ir, error) in zip(inputs, results):
+    if ir is not None:
+      prefix = module_prefix(name, prefixes)
+      prefixes.add(prefix)
+      modules.append((prefix, ir))
+    yield path, error
+  if jobs != 1:
+    pool.close()
+    pool.join()
+  if args.link:
+    f = open(args.link, 'w')
+    link_modules(modules, f)
+    f.close()
+
+def module_prefix(name, taken):
+  """A symbol prefix for the module translated from name, not in taken."""
+  base = re.sub(r'[^A-Za-z0-9_]', '_', os.path.splitext(name)[0])
+  prefix = base
+  serial = 1
+  while prefix in taken:
+    serial += 1
+    prefix = '%s_%d' % (base, serial)
+  return prefix
+
+DEFINITION_RE = re.compile(r'^(?:define [^@]*@([-\w$.]+) |@([-\w$.]+) = )')
+
+def link_modules(modules, f):
+  """Writes the modules, a list of (prefix, IR) translated with the same
+  options, to f as one module.
+
+  Whatever a module defines, @runMachine included, becomes @<prefix>.<name>.
+  The VMState type, declarations and TBAA nodes are shared; other metadata
+  is renumbered after them.
+  """
+  header = []
+  seen = set()
+  bodies = []
+  next_node = len(TBAA_NODES) + 1
+  for prefix, ir in modules:
+    lines = ir.split('\n')
+    defined = set()
+    for line in lines:
+      m = DEFINITION_RE.match(line)
+      if m:
+        defined.add(m.group(1) or m.group(2))
+    symbol_re = re.compile(r'@(%s)(?![-\w$.])' % '|'.join([re.escape(x) for x in defined]))
+    nodes = {}
+    def node(m):
+      number = int(m.group(1))
+      if number <= len(TBAA_NODES):
+        return m.group(0)
+      return '!%d' % nodes[number]
+    for line in lines:
+      if not line:
+        continue
+      if line.startswith('%struct.VMState = ') or line.startswith('declare ') or \
+          re.match(r'!\d+ = ', line) and int(line[1:line.index(' ')]) <= len(TBAA_NODES):
+        if line not in seen:
+          seen.add(line)
+          header.append(line)
+        continue
+      if re.match(r'!\d+ = ', line):
+        nodes[int(line[1:line.index(' ')])] = next_node
+        next_node += 1
+      if defined:
+        line = symbol_re.sub(lambda m: '@%s.%s' % (prefix, m.group(1)), line)
+      bodies.append(METADATA_RE.sub(node, line))
+  for line in header + bodies:
+    print >>f, line
+
+def write_modules(modules, directory):
+  """Writes modules, as Program.to_llvm_modules() returns them, to
+  directory, with an index named modules."""
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  for name, ir in modules:
+    f = open(os.path.join(directory, name + '.ll'), 'w')
+    f.write(ir)
+    f.close()
+  f = open(os.path.join(directory, 'modules'), 'w')
+  for name, ir in modules:
+    print >>f, name
+  f.close()
+
+def read_profile(path):
+  try:
+    return blockprofile.read(path)
+  except (IOError, ValueError), e:
+    raise argparse.ArgumentTypeError('cannot read profile %s: %s' % (path, e))
+
+def arg_parser():
+  arg_parser = argparse.ArgumentParser(description='Translate DCPU-16 assembly on stdin to LLVM IR on stdout.')
+  arg_parser.add_argument('inputs', nargs='*', metavar='PATH',
+                          help='translate these files, and the .das (with --binary, .bin) files under these '
+                          'directories, to .ll files instead of stdin to stdout')
+  arg_parser.add_argument('-o', '--output-dir',
+                          help='with PATHs, write the .ll files here instead of next to their inputs')
+  arg_parser.add_argument('--link', metavar='FILE',
+                          help='with PATHs, link all translations into one module with prefixed symbols')
+  arg_parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                          help='with PATHs, translate this many files at once (default: %(default)s)')
+  arg_parser.add_argument('--pyparsing', action='store_true',
+                          help='parse with the original pyparsing grammar instead of Parser')
+  arg_parser.add_argument('--binary', choices=['big', 'little'],
+                          help='read an assembled image with this byte order instead of assembly')
+  arg_parser.add_argument('--dump-cfg', action='store_true',
+                          help='print the control-flow graph instead of translating')
+  arg_parser.add_argument('--assemble', choices=['big', 'little'],
+                          help='write the assembled image with this byte order instead of translating')
+  arg_parser.add_argument('--listing', action='store_true',
+                          help='print an assembly listing with addresses, encodings and cycle counts')
+  arg_parser.add_argument('--memory-tracking', choices=MEMORY_TRACKING_MODES, default='call',
+                          help='how memory accesses mark pages_accessed (default: call @memory_referenced)')
+  arg_parser.add_argument('--registers', choices=REGISTER_MODES, default='state',
+                          help='keep registers in VMState or in function-local SSA values (default: state)')
+  arg_parser.add_argument('--alias-metadata', action='store_true',
+                          help='emit TBAA metadata separating registers from memory')
+  arg_parser.add_argument('--lazy-overflow', action='store_true',
+                          help='skip computing O where nothing can observe it')
+  arg_parser.add_argument('--inline-limit', type=int, metavar='N',
+                          help='inline subroutines of at most N instructions and any called from one place')
+  arg_parser.add_argument('--leaf-registers', action='store_true',
+                          help='pass leaf subroutines only the registers they use')
+  arg_parser.add_argument('--count-cycles', action='store_true',
+                          help='count DCPU cycles in VMState; --run and --interpret report them on stderr')
+  arg_parser.add_argument('--profile-blocks', action='store_true',
+                          help='count block executions; runs merge them into $DCPU_PROFILE (default: dcpu-profile.txt)')
+  arg_parser.add_argument('--profile-use', metavar='FILE', type=read_profile,
+                          help='lay out blocks, pick calls to inline and weight IFs with this profile')
+  arg_parser.add_argument('--stats', action='store_true',
+                          help='report translation statistics on stderr')
+  arg_parser.add_argument('--run', action='store_true',
+                          help='JIT-compile with llvmlite and run the program instead of printing IR')
+  arg_parser.add_argument('--opt-level', type=int, choices=range(4), default=2,
+                          help='optimization level for --run (default: 2)')
+  arg_parser.add_argument('--interpret', action='store_true',
+                          help='run the program with the Python reference interpreter instead of printing IR')
+  arg_parser.add_argument('--split-dir', metavar='DIR',
+                          help='write one module per function, NAME.ll, into DIR, and their names in order to '
+                          'DIR/modules, instead of IR to stdout')
+  arg_parser.add_argument('--snapshot', metavar='FILE',
+                          help='after --run or --interpret, write the final machine state here; see snapshot.py')
+  arg_parser.add_argument('--cache-dir', default=cache.default_directory(),
+                          help='reuse translations stored here (default: $DCPU_CACHE_DIR; no caching if unset)')
+  return arg_parser
+
+def options_from_args(args):
+  return Options(memory_tracking=args.memory_tracking, registers=args.registers,
+                 alias_metadata=args.alias_metadata, lazy_overflow=args.lazy_overflow,
+                 inline_limit=args.inline_limit, leaf_registers=args.leaf_registers,
+                 count_cycles=args.count_cycles, profile_blocks=args.profile_blocks,
+                 profile=args.profile_use)
+
+def batch_main(parser, args):
+  if args.dump_cfg or args.assemble or args.listing or args.run or args.interpret or args.split_dir:
+    parser.error('PATHs only work when translating')
+  if args.link and args.profile_blocks:
+    parser.error('--link cannot be combined with --profile-blocks')
+  inputs = batch_inputs(args.inputs, args.binary and '.bin' or '.das')
+  failures = 0
+  for path, error in translate_batch(args, inputs, args.jobs):
+    if error is not None:
+      print >>sys.stderr, 'compile-dcpu.py: %s: %s' % (path, error)
+      failures += 1
+  if args.stats:
+    print >>sys.stderr, 'batch: %d of %d files translated' % (len(inputs) - failures, len(inputs))
+  if failures:
+    sys.exit(1)
+
+def main(argv):
+  parser = arg_parser()
+  args = parser.parse_args(argv)
+  if args.inputs:
+    batch_main(parser, args)
+    return
+  if args.split_dir and args.run:
+    parser.error('--split-dir cannot be combined with --run')
+  options = options_from_args(args)
+  if args.binary:
+    source = read_image(sys.stdin)
+  else:
+    source = sys.stdin.read()
+
+  ir_cache = None
+  ir = None
+  if args.cache_dir and not (args.dump_cfg or args.interpret or args.assemble or args.listing or args.split_dir):
+    ir_cache = cache.Cache(args.cache_dir)
+    key = translation_key(source, options, args.binary or 'das')
+    ir = ir_cache.get(key)
+
+  if ir is None:
+    # A big program is a few hundred thousand objects that live until its IR
+    # is written, and that the collector would otherwise scan again and again
+    # as they pile up. Collect far less often until the translation is done.
+    thresholds = gc.get_threshold()
+    gc.set_threshold(100000, *thresholds[1:])
+    try:
+      try:
+        if args.binary:
+          program = Decoder(args.binary).decode(source)
+        else:
+          program = parse(source, args.pyparsing)
+      except (ParseError, DecodeError), e:
+        print >>sys.stderr, 'compile-dcpu.py: %s' % e
+        sys.exit(1)
+      if args.dump_cfg:
+        program.dump_cfg(sys.stdout)
+        return
+      if args.assemble or args.listing:
+        try:
+          if args.listing:
+            program.dump_listing(sys.stdout)
+          else:
+            image = program.assemble()
+            sys.stdout.write(struct.pack((args.assemble == 'big' and '>%dH' or '<%dH') % len(image), *image))
+        except AssembleError, e:
+          print >>sys.stderr, 'compile-dcpu.py: %s' % e
+          sys.exit(1)
+        return
+      if args.interpret:
+        import interpreter
+        machine = interpreter.Interpreter(program, count_cycles=args.count_cycles)
+        machine.run()
+        if args.count_cycles:
+          print >>sys.stderr, 'cycles: %d' % machine.cycles
+        if args.snapshot:
+          import snapshot
+          snapshot.write(machine, args.snapshot)
+        return
+      if args.split_dir:
+        write_modules(program.to_llvm_modules(options), args.split_dir)
+      elif ir_cache is None and not args.run:
+        program.to_llvm(LLVM_Out(sys.stdout, options))
+      else:
+        out = LLVM_Out(options=options)
+        program.to_llvm(out)
+        ir = out.getvalue()
+        if ir_cache is not None:
+          ir_cache.put(key, ir)
+    finally:
+      gc.set_threshold(*thresholds)
+    if args.stats and 'overflow_total' in program.stats:
+      print >>sys.stderr, 'overflow: removed %d of %d computations' % (
+        program.stats['overflow_removed'], program.stats['overflow_total'])
+    if args.stats and 'calls_inlined' in program.stats:
+      print >>sys.stderr, 'inline: %d calls inlined' % program.stats['calls_inlined']
+  if args.stats and ir_cache is not None:
+    print >>sys.stderr, ir_cache.stats()
+
+  if args.run:
+    import jit
+    state = jit.Machine(ir, args.opt_level).run()
+    if args.count_cycles:
+      print >>sys.stderr, 'cycles: %d' % state.cycles
+    if args.snapshot:
+      import snapshot
+      snapshot.write(state, args.snapshot)
+  elif ir is not None:
+    sys.stdout.write(ir)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
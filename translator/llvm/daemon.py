@@ -0,0 +1,292 @@
+"""A long-running translator that serves compile-dcpu.py on a Unix socket.
+
+Starting Python and importing the translator (and, for --pyparsing, building
+its grammar) take far longer than translating a typical program. The daemon
+pays for them once and then serves requests, each on its own thread. It
+keeps recent translations in memory, and in the cache.Cache under
+--cache-dir if one is given. dcpu-client.py is its command-line client.
+
+Each connection carries one request and one reply, each a JSON object on
+one line:
+
+  {"args": [compile-dcpu.py arguments], "source": assembly text}
+  {"args": [...], "source_base64": assembly or, with --binary, an image}
+  {"args": [...], "path": file to translate}
+
+Adding "object": true asks for the path of an object file compiled with
+pipeline.py's tools instead of IR. Replies are {"ir": text},
+{"object": path} or {"error": message}.
+
+{"stats": true} returns {"stats": {kind: summary}}. kind is "ir" or
+"object". Each summary gives the number of requests and the 50th, 90th and
+99th percentile latencies, in milliseconds, of the most recent requests.
+"""
+
+import argparse
+import base64
+import collections
+import json
+import math
+import os
+import os.path
+import shutil
+import signal
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+
+import cache
+import pipeline
+
+PERCENTILES = [50, 90, 99]
+LATENCY_WINDOW = 10000
+
+# compile-dcpu.py arguments that ask for something other than a translation.
+NOT_TRANSLATING = ['inputs', 'dump_cfg', 'assemble', 'listing', 'run', 'interpret', 'split_dir']
+
+def default_socket():
+  return os.environ.get('DCPU_DAEMON_SOCKET',
+                        os.path.join(tempfile.gettempdir(), 'dcpu-translator-%d.sock' % os.getuid()))
+
+class DaemonError(Exception):
+  pass
+
+class Latencies(object):
+  """The latencies of the last LATENCY_WINDOW requests of each kind."""
+  def __init__(self, window=LATENCY_WINDOW):
+    self._window = window
+    self._samples = {}
+    self._lock = threading.Lock()
+
+  def add(self, kind, seconds):
+    with self._lock:
+      if kind not in self._samples:
+        self._samples[kind] = collections.deque(maxlen=self._window)
+      self._samples[kind].append(seconds)
+
+  def summary(self):
+    with self._lock:
+      samples = dict([(kind, sorted(x)) for kind, x in self._samples.items()])
+    summary = {}
+    for kind, values in samples.items():
+      summary[kind] = {'count': len(values)}
+      for p in PERCENTILES:
+        # Nearest rank.
+        rank = max(0, int(math.ceil(p / 100.0 * len(values))) - 1)
+        summary[kind]['p%d' % p] = values[rank] * 1000
+    return summary
+
+class MemoryCache(object):
+  """The IR of the last max_entries translations, by translation key."""
+  def __init__(self, max_entries):
+    self._max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      ir = self._entries.pop(key, None)
+      if ir is not None:
+        self._entries[key] = ir
+      return ir
+
+  def put(self, key, ir):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = ir
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+class Translator(object):
+  """Answers requests; safe to call from many threads at once.
+
+  Objects go in object_dir, named by the key pipeline.stage_keys() gives
+  them, so they are built once per source, translator and tool set.
+  """
+  def __init__(self, object_dir, disk_cache=None, max_entries=1024):
+    self._compile_dcpu = pipeline.translator()
+    self._arg_parser = self._compile_dcpu.arg_parser()
+    def error(message):
+      raise DaemonError('compile-dcpu.py: %s' % message)
+    self._arg_parser.error = error
+    self._object_dir = object_dir
+    self._disk_cache = disk_cache
+    self._memory_cache = MemoryCache(max_entries)
+    # pyparsing's parser isn't thread-safe.
+    self._pyparsing_lock = threading.Lock()
+    self.latencies = Latencies()
+    if self._compile_dcpu.pyparsing is not None:
+      self._compile_dcpu.pyparsing_grammar()
+
+  def handle(self, request):
+    """The reply to request, both dicts as the module docstring describes."""
+    if request.get('stats'):
+      return {'stats': self.latencies.summary()}
+    kind = request.get('object') and 'object' or 'ir'
+    compile_dcpu = self._compile_dcpu
+    start = time.time()
+    try:
+      reply = self._translate(request, kind)
+    except (DaemonError, compile_dcpu.ParseError, compile_dcpu.DecodeError,
+            pipeline.BuildError, EnvironmentError), e:
+      reply = {'error': str(e)}
+    except Exception, e:
+      # A translator bug must not take the request's thread down with it
+      # and leave the client with no reply.
+      reply = {'error': 'internal error: %s: %s' % (e.__class__.__name__, e)}
+    finally:
+      self.latencies.add(kind, time.time() - start)
+    return reply
+
+  def _translate(self, request, kind):
+    args = self._arguments(request.get('args', []))
+    if 'path' in request:
+      f = open(request['path'], 'rb')
+      source = f.read()
+      f.close()
+    elif 'source_base64' in request:
+      source = base64.b64decode(request['source_base64'])
+    elif 'source' in request:
+      source = request['source'].encode('utf-8')
+    else:
+      raise DaemonError('request has no source or path')
+
+    compile_dcpu = self._compile_dcpu
+    options = compile_dcpu.options_from_args(args)
+    key = compile_dcpu.translation_key(source, options, args.binary or 'das')
+    ir = self._memory_cache.get(key)
+    if ir is None and self._disk_cache is not None:
+      ir = self._disk_cache.get(key)
+    if ir is None:
+      if args.pyparsing and not args.binary:
+        with self._pyparsing_lock:
+          ir = compile_dcpu.translate(source, options, 'das', True)
+      else:
+        ir = compile_dcpu.translate(source, options, args.binary or 'das')
+      if self._disk_cache is not None:
+        self._disk_cache.put(key, ir)
+    self._memory_cache.put(key, ir)
+    if kind == 'ir':
+      return {'ir': ir}
+    return {'object': self._object(key, ir)}
+
+  def _arguments(self, argv):
+    try:
+      args = self._arg_parser.parse_args(argv)
+    except SystemExit:
+      # --help and the like.
+      raise DaemonError('compile-dcpu.py arguments %r ask for no translation' % argv)
+    for name in NOT_TRANSLATING:
+      if getattr(args, name):
+        raise DaemonError('the daemon only translates; --%s is not supported' % name.replace('_', '-'))
+    return args
+
+  def _object(self, key, ir):
+    path = os.path.join(self._object_dir, pipeline.stage_keys(key)['o'] + '.o')
+    if os.path.exists(path):
+      return path
+    # Built apart and renamed into place, so concurrent requests for the same
+    # object never see half of one.
+    work_dir = tempfile.mkdtemp(dir=self._object_dir)
+    try:
+      base = os.path.join(work_dir, 'program')
+      f = open(base + '.ll', 'w')
+      f.write(ir)
+      f.close()
+      pipeline.compile_object(base)
+      os.rename(base + '.o', path)
+    finally:
+      shutil.rmtree(work_dir)
+    return path
+
+class _Handler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    try:
+      request = json.loads(self.rfile.readline())
+    except ValueError, e:
+      reply = {'error': 'bad request: %s' % e}
+    else:
+      if isinstance(request, dict):
+        reply = self.server.translator.handle(request)
+      else:
+        reply = {'error': 'bad request: not an object'}
+    self.wfile.write(json.dumps(reply) + '\n')
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, path, translator):
+    self.translator = translator
+    SocketServer.UnixStreamServer.__init__(self, path, _Handler)
+
+def connect(path=None):
+  """A socket connected to the daemon; raises socket.error if none listens."""
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    s.connect(path or default_socket())
+  except socket.error:
+    s.close()
+    raise
+  return s
+
+def request(message, s=None, path=None):
+  """Sends message to the daemon, over s if given; returns the reply."""
+  if s is None:
+    s = connect(path)
+  try:
+    f = s.makefile('r+b')
+    f.write(json.dumps(message) + '\n')
+    f.flush()
+    reply = f.readline()
+    f.close()
+  finally:
+    s.close()
+  if not reply:
+    raise DaemonError('the daemon closed the connection without replying')
+  return json.loads(reply)
+
+def main(argv):
+  arg_parser = argparse.ArgumentParser(description='Serve compile-dcpu.py translations on a Unix socket.')
+  arg_parser.add_argument('--socket', default=default_socket(),
+                          help='listen here (default: $DCPU_DAEMON_SOCKET or %(default)s)')
+  arg_parser.add_argument('--object-dir',
+                          help='keep compiled objects here (default: a temporary directory)')
+  arg_parser.add_argument('--cache-dir', default=cache.default_directory(),
+                          help='also keep translations here (default: $DCPU_CACHE_DIR; none if unset)')
+  arg_parser.add_argument('--max-entries', type=int, default=1024,
+                          help='translations to keep in memory (default: %(default)s)')
+  args = arg_parser.parse_args(argv)
+
+  if os.path.exists(args.socket):
+    try:
+      connect(args.socket).close()
+    except socket.error:
+      # Left behind by a daemon that didn't shut down cleanly.
+      os.unlink(args.socket)
+    else:
+      arg_parser.error('a daemon is already listening on %s' % args.socket)
+
+  object_dir = args.object_dir
+  if object_dir is None:
+    object_dir = tempfile.mkdtemp(prefix='dcpu-objects-')
+  elif not os.path.isdir(object_dir):
+    os.makedirs(object_dir)
+  disk_cache = args.cache_dir and cache.Cache(args.cache_dir) or None
+  server = Server(args.socket, Translator(object_dir, disk_cache, args.max_entries))
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  print >>sys.stderr, 'daemon.py: listening on %s' % args.socket
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    os.unlink(args.socket)
+    if args.object_dir is None:
+      shutil.rmtree(object_dir)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
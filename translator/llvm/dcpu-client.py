@@ -0,0 +1,68 @@
+"""A drop-in for compile-dcpu.py that has the translation daemon do the work.
+
+  python dcpu-client.py [compile-dcpu.py arguments] < program.das > program.ll
+
+It takes the same arguments and gives the same output as compile-dcpu.py.
+If no daemon.py is listening, it runs compile-dcpu.py itself.
+"""
+
+import argparse
+import base64
+import os
+import socket
+import sys
+
+import daemon
+import pipeline
+
+def main(argv):
+  arg_parser = argparse.ArgumentParser(
+    description='Translate DCPU-16 assembly on stdin to LLVM IR on stdout through daemon.py; '
+    'other arguments go to compile-dcpu.py.')
+  arg_parser.add_argument('--socket', default=daemon.default_socket(),
+                          help='the daemon\'s socket (default: $DCPU_DAEMON_SOCKET or %(default)s)')
+  arg_parser.add_argument('--path',
+                          help='translate this file, which the daemon reads itself, instead of stdin')
+  arg_parser.add_argument('--object', action='store_true',
+                          help='print the path of the compiled object instead of IR (needs the daemon)')
+  arg_parser.add_argument('--latency', action='store_true',
+                          help='print the daemon\'s request latency percentiles and exit')
+  args, translator_args = arg_parser.parse_known_args(argv)
+
+  try:
+    s = daemon.connect(args.socket)
+  except socket.error, e:
+    if args.object or args.latency:
+      print >>sys.stderr, 'dcpu-client.py: no daemon on %s: %s' % (args.socket, e)
+      sys.exit(1)
+    if args.path:
+      sys.stdin = open(args.path, 'rb')
+      os.dup2(sys.stdin.fileno(), 0)
+    os.execv(sys.executable, [sys.executable, pipeline.COMPILER] + translator_args)
+
+  if args.latency:
+    message = {'stats': True}
+  else:
+    message = {'args': translator_args, 'object': args.object}
+    if args.path:
+      message['path'] = os.path.abspath(args.path)
+    else:
+      message['source_base64'] = base64.b64encode(sys.stdin.read())
+  try:
+    reply = daemon.request(message, s)
+  except (daemon.DaemonError, socket.error), e:
+    reply = {'error': str(e)}
+  if 'error' in reply:
+    print >>sys.stderr, 'dcpu-client.py: %s' % reply['error']
+    sys.exit(1)
+  if args.latency:
+    for kind, summary in sorted(reply['stats'].items()):
+      print '%-6s %6d requests  %s' % (kind, summary['count'], '  '.join(
+        ['p%d %.2fms' % (p, summary['p%d' % p]) for p in daemon.PERCENTILES]))
+  elif args.object:
+    print reply['object']
+  else:
+    sys.stdout.write(reply['ir'])
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
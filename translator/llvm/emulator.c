@@ -1,53 +1,153 @@
 #include <string.h>
+#include <stdarg.h>
 #include <stdio.h>
+#include <stdlib.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#ifdef DCPU_LIBRARY
+#include <setjmp.h>
+#endif
 
 typedef struct {
   unsigned short registers[11];
   unsigned short memory[65536];
   unsigned char pages_accessed[65536 / 8 / 8];
+  /* Only kept by code translated with --count-cycles. */
+  unsigned long long cycles;
+  /* profile_slots of them, with --profile-blocks. */
+  unsigned long long block_counts[];
 } VMState;
 
 extern void runMachine(VMState *state);
 
+/* Only defined by code translated with --profile-blocks: the PC of each
+   counter, in order, and its source line, one per line. */
+extern const unsigned int profile_slots __attribute__((weak));
+extern const unsigned short profile_pcs[] __attribute__((weak));
+extern const char profile_source[] __attribute__((weak));
+
+/* The start of a snapshot; snapshot.py describes the format. */
+typedef struct {
+  char magic[8];
+  unsigned short version;
+  unsigned short registers[11];
+  unsigned long long cycles;
+  unsigned char pages_accessed[65536 / 8 / 8];
+} SnapshotHeader;
+
+#define SNAPSHOT_MAGIC "DCPUSNAP"
+#define SNAPSHOT_VERSION 1
+
+int write_snapshot(VMState *state, const char *path);
+int read_snapshot(VMState *state, const char *path);
+
+#ifdef DCPU_LIBRARY
+/* Built into a shared object (pipeline.build_library()), the emulator has no
+   main. run_machine() runs a program with what it prints going to a buffer
+   of the caller's, so many threads can run at once; see harness.py. */
+typedef struct {
+  char *data;
+  size_t size;
+  size_t length;
+  jmp_buf exit;
+} Run;
+
+static __thread Run *current_run;
+
+/* Runs state's program. Returns how much it printed, of which out holds
+   the first size - 1 bytes and a NUL, or -1 if it jumped to an address that
+   is not a label. */
+long long run_machine(VMState *state, char *out, size_t size) {
+  Run run;
+  run.data = out;
+  run.size = size;
+  run.length = 0;
+  current_run = &run;
+  if (setjmp(run.exit)) {
+    current_run = NULL;
+    return -1;
+  }
+  runMachine(state);
+  current_run = NULL;
+  return run.length;
+}
+
+static void emit(const char *format, ...) {
+  va_list args;
+  size_t start;
+  va_start(args, format);
+  if (!current_run) {
+    vprintf(format, args);
+  } else {
+    start = current_run->length < current_run->size ? current_run->length : current_run->size;
+    current_run->length += vsnprintf(current_run->data + start, current_run->size - start, format, args);
+  }
+  va_end(args);
+}
+#else
+static void write_profile(VMState *state, unsigned int slots);
+
+/* $DCPU_RESTORE names a snapshot to start from (though the program's DAT
+   image is still copied over memory) and $DCPU_SNAPSHOT one to write at the
+   end. */
+
+#define emit printf
+
 int main() {
-  VMState state;
-  memset(&state, 0, sizeof(state));
-  runMachine(&state);
+  unsigned int slots = &profile_slots ? profile_slots : 0;
+  VMState *state = calloc(1, sizeof(VMState) + slots * sizeof(unsigned long long));
+  if (getenv("DCPU_RESTORE") && read_snapshot(state, getenv("DCPU_RESTORE"))) {
+    return 1;
+  }
+  runMachine(state);
+  if (state->cycles) {
+    fprintf(stderr, "cycles: %llu\n", state->cycles);
+  }
+  if (getenv("DCPU_SNAPSHOT") && write_snapshot(state, getenv("DCPU_SNAPSHOT"))) {
+    return 1;
+  }
+  if (slots) {
+    write_profile(state, slots);
+  }
+  free(state);
 
   return 0;
 }
+#endif
 
 void output(unsigned short num) {
-  printf("OUT: %d\n", num);
+  emit("OUT: %d\n", num);
 }
 
 void debug(VMState *state) {
   unsigned int page;
-  printf("DEBUG:\n");
-  printf("  Register A: %d\n", state->registers[0]);
-  printf("  Register B: %d\n", state->registers[1]);
-  printf("  Register C: %d\n", state->registers[2]);
-  printf("  Register X: %d\n", state->registers[3]);
-  printf("  Register Y: %d\n", state->registers[4]);
-  printf("  Register Z: %d\n", state->registers[5]);
-  printf("  Register I: %d\n", state->registers[6]);
-  printf("  Register J: %d\n", state->registers[7]);
-  printf("  Register SP: %d\n", state->registers[8]);
-  printf("  Register PC: %d\n", state->registers[9]);
-  printf("  Register O: %d\n", state->registers[10]);
-  printf("  Memory:\n");
+  emit("DEBUG:\n");
+  emit("  Register A: %d\n", state->registers[0]);
+  emit("  Register B: %d\n", state->registers[1]);
+  emit("  Register C: %d\n", state->registers[2]);
+  emit("  Register X: %d\n", state->registers[3]);
+  emit("  Register Y: %d\n", state->registers[4]);
+  emit("  Register Z: %d\n", state->registers[5]);
+  emit("  Register I: %d\n", state->registers[6]);
+  emit("  Register J: %d\n", state->registers[7]);
+  emit("  Register SP: %d\n", state->registers[8]);
+  emit("  Register PC: %d\n", state->registers[9]);
+  emit("  Register O: %d\n", state->registers[10]);
+  emit("  Memory:\n");
   for (page = 0; page < 65536 / 8; page++) {
     if (state->pages_accessed[page / 8] & (1 << (page % 8))) {
-      printf("    %04X: ", page);
+      emit("    %04X: ", page);
       int word = 0;
       for (word = 0; word < 4; word++) {
-        printf(" %04X", state->memory[page * 8 + word]);
+        emit(" %04X", state->memory[page * 8 + word]);
       }
-      printf(" ");
+      emit(" ");
       for (word = 4; word < 8; word++) {
-        printf(" %04X", state->memory[page * 8 + word]);
+        emit(" %04X", state->memory[page * 8 + word]);
       }
-      printf("\n");
+      emit("\n");
     }
   }
 }
@@ -56,3 +156,190 @@ void memory_referenced(VMState *state, unsigned short index) {
   unsigned short page = index / 8;
   state->pages_accessed[page / 8] |= 1 << (page % 8);
 }
+
+#ifndef DCPU_LIBRARY
+/* The instruction in a profile source, past its line number if it has one.
+   Counters are matched on pc and instruction, so code that only moved to
+   other lines keeps its counts. */
+static const char *skip_line_number(const char *source) {
+  const char *text = source;
+  while (*text >= '0' && *text <= '9') {
+    text++;
+  }
+  if (text != source && text[0] == ':' && text[1] == ' ') {
+    return text + 2;
+  }
+  return source;
+}
+
+/* Adds the counts to the profile in $DCPU_PROFILE (dcpu-profile.txt by
+   default), in the format blockprofile.py describes. Lines for other code
+   are dropped. */
+static void write_profile(VMState *state, unsigned int slots) {
+  const char *path = getenv("DCPU_PROFILE");
+  const char **sources = malloc(slots * sizeof(char *));
+  const char **texts = malloc(slots * sizeof(char *));
+  int *lengths = malloc(slots * sizeof(int));
+  unsigned long long *counts = malloc(slots * sizeof(unsigned long long));
+  const char *source = profile_source;
+  char line[1024];
+  unsigned int slot;
+  FILE *f;
+
+  for (slot = 0; slot < slots; slot++) {
+    sources[slot] = source;
+    source = strchr(source, '\n');
+    lengths[slot] = source - sources[slot];
+    texts[slot] = skip_line_number(sources[slot]);
+    source++;
+    counts[slot] = state->block_counts[slot];
+  }
+
+  if (!path) {
+    path = "dcpu-profile.txt";
+  }
+  f = fopen(path, "r");
+  if (f) {
+    while (fgets(line, sizeof(line), f)) {
+      unsigned long long count;
+      unsigned int pc, low = 0, high = slots;
+      int offset = 0;
+      const char *text;
+      if (line[0] == '#' || sscanf(line, "%llu %x %n", &count, &pc, &offset) < 2 || !offset) {
+        continue;
+      }
+      line[strcspn(line, "\n")] = 0;
+      text = skip_line_number(line + offset);
+      /* profile_pcs is sorted. */
+      while (low < high) {
+        unsigned int middle = (low + high) / 2;
+        if (profile_pcs[middle] < pc) {
+          low = middle + 1;
+        } else {
+          high = middle;
+        }
+      }
+      if (low < slots && profile_pcs[low] == pc &&
+          (int) strlen(text) == lengths[low] - (texts[low] - sources[low]) &&
+          !strncmp(text, texts[low], strlen(text))) {
+        counts[low] += count;
+      }
+    }
+    fclose(f);
+  }
+
+  f = fopen(path, "w");
+  if (!f) {
+    perror(path);
+  } else {
+    fprintf(f, "# count pc source\n");
+    for (slot = 0; slot < slots; slot++) {
+      fprintf(f, "%llu %04x %.*s\n", counts[slot], profile_pcs[slot], lengths[slot], sources[slot]);
+    }
+    fclose(f);
+  }
+  free(sources);
+  free(texts);
+  free(lengths);
+  free(counts);
+}
+#endif
+
+/* Writes the registers, cycle count, pages_accessed and the pages it marks
+   to path. Returns 0, or -1 with a message on stderr. */
+int write_snapshot(VMState *state, const char *path) {
+  SnapshotHeader header;
+  unsigned int page, end;
+  FILE *f = fopen(path, "wb");
+  if (!f) {
+    perror(path);
+    return -1;
+  }
+  memset(&header, 0, sizeof(header));
+  memcpy(header.magic, SNAPSHOT_MAGIC, sizeof(header.magic));
+  header.version = SNAPSHOT_VERSION;
+  memcpy(header.registers, state->registers, sizeof(header.registers));
+  header.cycles = state->cycles;
+  memcpy(header.pages_accessed, state->pages_accessed, sizeof(header.pages_accessed));
+  fwrite(&header, sizeof(header), 1, f);
+  /* Each run of consecutive marked pages goes out in one write. */
+  for (page = 0; page < 65536 / 8; page = end) {
+    for (; page < 65536 / 8 && !(state->pages_accessed[page / 8] & (1 << (page % 8))); page++) {
+    }
+    for (end = page; end < 65536 / 8 && (state->pages_accessed[end / 8] & (1 << (end % 8))); end++) {
+    }
+    if (end > page) {
+      fwrite(&state->memory[page * 8], 8 * sizeof(unsigned short), end - page, f);
+    }
+  }
+  if (fclose(f)) {
+    perror(path);
+    return -1;
+  }
+  return 0;
+}
+
+/* Loads the snapshot at path into state, which should be zeroed, by mapping
+   the file and copying each run of pages in it into place. Returns 0, or -1
+   with a message on stderr. */
+int read_snapshot(VMState *state, const char *path) {
+  const SnapshotHeader *header;
+  const unsigned short *pages;
+  unsigned int page, end, count = 0;
+  struct stat status;
+  void *data;
+  int fd = open(path, O_RDONLY);
+  if (fd < 0 || fstat(fd, &status)) {
+    perror(path);
+    if (fd >= 0) {
+      close(fd);
+    }
+    return -1;
+  }
+  if (status.st_size < (off_t) sizeof(SnapshotHeader)) {
+    fprintf(stderr, "%s: not a snapshot\n", path);
+    close(fd);
+    return -1;
+  }
+  data = mmap(NULL, status.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+  close(fd);
+  if (data == MAP_FAILED) {
+    perror(path);
+    return -1;
+  }
+  header = data;
+  pages = (const unsigned short *) (header + 1);
+  for (page = 0; page < 65536 / 8; page++) {
+    count += (header->pages_accessed[page / 8] >> (page % 8)) & 1;
+  }
+  if (memcmp(header->magic, SNAPSHOT_MAGIC, sizeof(header->magic)) || header->version != SNAPSHOT_VERSION ||
+      status.st_size != (off_t) (sizeof(SnapshotHeader) + count * 8 * sizeof(unsigned short))) {
+    fprintf(stderr, "%s: not a snapshot from this kind of machine\n", path);
+    munmap(data, status.st_size);
+    return -1;
+  }
+  memcpy(state->registers, header->registers, sizeof(state->registers));
+  state->cycles = header->cycles;
+  memcpy(state->pages_accessed, header->pages_accessed, sizeof(state->pages_accessed));
+  for (page = 0; page < 65536 / 8; page = end) {
+    for (; page < 65536 / 8 && !(header->pages_accessed[page / 8] & (1 << (page % 8))); page++) {
+    }
+    for (end = page; end < 65536 / 8 && (header->pages_accessed[end / 8] & (1 << (end % 8))); end++) {
+    }
+    memcpy(&state->memory[page * 8], pages, (end - page) * 8 * sizeof(unsigned short));
+    pages += (end - page) * 8;
+  }
+  munmap(data, status.st_size);
+  return 0;
+}
+
+void unknown_jump(VMState *state, unsigned short target) {
+#ifdef DCPU_LIBRARY
+  if (current_run) {
+    longjmp(current_run->exit, 1);
+  }
+#endif
+  fflush(stdout);
+  fprintf(stderr, "unknown jump target %d from PC %d\n", target, state->registers[9]);
+  exit(1);
+}
@@ -0,0 +1,156 @@
+"""Runs translated programs in this process, many instances at a time.
+
+pipeline.build_library() builds a program into a shared object whose
+run_machine() (see emulator.c) runs it on a VMState and collects what it
+prints. ctypes releases the GIL while run_machine() runs, so instances on
+different threads run in parallel:
+
+  library = harness.Library('program.so')
+  outputs = library.run_many([{'registers': {'A': n}} for n in range(1000)])
+
+Each thread reuses one VMState and one output buffer, clearing them between
+runs, so thousands of runs allocate no more than a handful.
+
+  python harness.py program.das [--instances N] [compile-dcpu.py arguments]
+
+builds program.das and times N runs of it.
+"""
+
+import argparse
+import array
+import ctypes
+import multiprocessing
+import multiprocessing.pool
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import pipeline
+import vmstate
+
+OUTPUT_SIZE = 64 * 1024
+
+class HarnessError(Exception):
+  pass
+
+class Instance(object):
+  """A VMState and output buffer to run a Library's program with.
+
+  After run(), output holds what the program printed (cut at the library's
+  output_size, if truncated is set), or is None if the program jumped to an
+  address that is not a label.
+  """
+  def __init__(self, library):
+    self._run_machine = library._run_machine
+    self._buffer = ctypes.create_string_buffer(library.state_size)
+    self.state = vmstate.VMState.from_buffer(self._buffer)
+    # With room for run_machine()'s NUL.
+    self._output = ctypes.create_string_buffer(library.output_size + 1)
+    self.output = None
+    self.truncated = False
+
+  def reset(self, memory=None, registers=None):
+    """Zeroes the state, then loads memory, a sequence of words stored from
+    address 0, and registers, a dict of values by name.
+
+    The program's own DAT image is still copied over memory when it starts.
+    """
+    ctypes.memset(self._buffer, 0, ctypes.sizeof(self._buffer))
+    if memory is not None:
+      words = array.array('H', memory)
+      if len(words) > vmstate.MEMORY_WORDS:
+        raise HarnessError('%d words of memory do not fit in %d' % (len(words), vmstate.MEMORY_WORDS))
+      ctypes.memmove(ctypes.addressof(self.state.memory), words.buffer_info()[0], len(words) * words.itemsize)
+    if registers:
+      for name, value in registers.items():
+        self.state.registers[vmstate.REGISTER_NAMES.index(name)] = value & 0xffff
+
+  def run(self):
+    """Runs the program on the state as it stands; returns output."""
+    length = self._run_machine(ctypes.byref(self.state), self._output, ctypes.sizeof(self._output))
+    size = ctypes.sizeof(self._output) - 1
+    if length < 0:
+      self.output = None
+      self.truncated = False
+    else:
+      self.truncated = length > size
+      self.output = self._output.raw[:min(length, size)]
+    return self.output
+
+class Library(object):
+  """A program built by pipeline.build_library(), loaded with ctypes."""
+  def __init__(self, path, output_size=OUTPUT_SIZE):
+    self._library = ctypes.CDLL(os.path.abspath(path))
+    self._run_machine = self._library.run_machine
+    self._run_machine.argtypes = [ctypes.POINTER(vmstate.VMState), ctypes.c_char_p, ctypes.c_size_t]
+    self._run_machine.restype = ctypes.c_longlong
+    # Room for --profile-blocks counters; see jit.Machine.run().
+    try:
+      slots = ctypes.c_uint32.in_dll(self._library, 'profile_slots').value
+    except ValueError:
+      slots = 0
+    self.state_size = ctypes.sizeof(vmstate.VMState) + slots * ctypes.sizeof(ctypes.c_uint64)
+    self.output_size = output_size
+
+  def instance(self):
+    return Instance(self)
+
+  def run_many(self, setups, threads=None, collect=None):
+    """Runs an instance for each of setups, dicts of Instance.reset()
+    arguments, on a pool of threads (one per core by default).
+
+    Returns collect(instance) for each setup, in order; by default, the
+    instance's output. collect runs on the instance's thread right after
+    the run, before the instance is reused.
+    """
+    if collect is None:
+      collect = lambda instance: instance.output
+    local = threading.local()
+    def run(setup):
+      instance = getattr(local, 'instance', None)
+      if instance is None:
+        instance = local.instance = Instance(self)
+      instance.reset(**setup)
+      instance.run()
+      return collect(instance)
+    pool = multiprocessing.pool.ThreadPool(threads or multiprocessing.cpu_count())
+    try:
+      return pool.map(run, setups, chunksize=16)
+    finally:
+      pool.close()
+      pool.join()
+
+def main(argv):
+  arg_parser = argparse.ArgumentParser(description='Build a program as a shared object and time many runs of it.')
+  arg_parser.add_argument('program', help='the .das file to build')
+  arg_parser.add_argument('--instances', type=int, default=1000,
+                          help='how many times to run it (default: %(default)s)')
+  arg_parser.add_argument('--threads', type=int, default=multiprocessing.cpu_count(),
+                          help='threads to run them on (default: %(default)s)')
+  args, translator_args = arg_parser.parse_known_args(argv)
+
+  build_dir = tempfile.mkdtemp(prefix='dcpu-harness-')
+  try:
+    path = os.path.join(build_dir, os.path.splitext(os.path.basename(args.program))[0] + '.so')
+    try:
+      pipeline.build_library(args.program, path, translator_args)
+    except pipeline.BuildError, e:
+      print >>sys.stderr, 'harness.py: %s' % e
+      sys.exit(1)
+    library = Library(path)
+    start = time.time()
+    outputs = library.run_many([{}] * args.instances, args.threads)
+    elapsed = time.time() - start
+  finally:
+    shutil.rmtree(build_dir)
+
+  if outputs[0] is not None:
+    sys.stdout.write(outputs[0])
+  print >>sys.stderr, '%d runs on %d threads in %.3fs (%.0f runs/s); %d distinct outputs' % (
+    args.instances, args.threads, elapsed, args.instances / elapsed, len(set(outputs)))
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,397 @@
+"""A reference interpreter that runs a parsed Program directly, without LLVM.
+
+Each instruction is decoded once into a closure that performs it and returns
+the index of the next instruction to run, so the main loop is nothing but
+`index = code[index]()`. Constant operands are folded into the closures and
+the common register/constant forms get their own closures.
+
+Semantics follow the translator and emulator.c: OUT and DBG print exactly
+what the emulator prints, JSR calls and SET PC, POP returns use a hidden call
+stack (as the generated code uses the native one) while still pushing and
+popping the return address, running off the end of the program returns
+without popping, PC reads as the address of the current instruction, and
+a computed SET PC can only go to a label whose address the program uses.
+"""
+
+import array
+import sys
+
+import vmstate
+
+SP = vmstate.REGISTER_NAMES.index('SP')
+PC = vmstate.REGISTER_NAMES.index('PC')
+O = vmstate.REGISTER_NAMES.index('O')
+
+class InterpreterError(Exception):
+  pass
+
+# Each returns (result, O) with the same values the generated code computes.
+def _add(a, b):
+  total = a + b
+  return total & 0xffff, total >> 16
+
+def _sub(a, b):
+  difference = a - b
+  return difference & 0xffff, (difference >> 16) & 0xffff
+
+def _mul(a, b):
+  product = a * b
+  return product & 0xffff, product >> 16
+
+def _div(a, b):
+  if b == 0:
+    return 0, 0
+  quotient = (a << 16) // b
+  return quotient >> 16, quotient & 0xffff
+
+def _mod(a, b):
+  if b == 0:
+    return 0, 0
+  return a % b, 0
+
+def _shl(a, b):
+  shifted = a << b
+  return shifted & 0xffff, (shifted >> 16) & 0xffff
+
+def _shr(a, b):
+  shifted = (a << 16) >> b
+  return (shifted >> 16) & 0xffff, shifted & 0xffff
+
+ARITHMETIC = {
+  'ADD': _add,
+  'SUB': _sub,
+  'MUL': _mul,
+  'DIV': _div,
+  'MOD': _mod,
+  'SHL': _shl,
+  'SHR': _shr,
+}
+
+BITWISE = {
+  'AND': lambda a, b: a & b,
+  'OR': lambda a, b: a | b,
+  'XOR': lambda a, b: a ^ b,
+}
+
+CONDITIONS = {
+  'IFE': lambda a, b: a == b,
+  'IFN': lambda a, b: a != b,
+  'IFG': lambda a, b: a > b,
+  'IFB': lambda a, b: a & b != 0,
+}
+
+class Interpreter(object):
+  """Runs program on its own VM state.
+
+  registers, memory (an array('H') of 65536 words) and pages_accessed have
+  the same layout as VMState, so vmstate.format_debug() works on either.
+  With count_cycles, cycles is the running total of DCPU cycles, as the
+  translator's --count-cycles keeps it.
+  """
+  def __init__(self, program, out=sys.stdout, count_cycles=False):
+    self.registers = [0] * len(vmstate.REGISTER_NAMES)
+    self.cycles = 0
+    self.memory = array.array('H', [0]) * vmstate.MEMORY_WORDS
+    self.pages_accessed = array.array('B', [0]) * (vmstate.PAGES / 8)
+    self._out = out
+    self._program = program
+    self._calls = []
+    # Failing IFs take a cycle more; the branches count them here.
+    self._failed_conditions = count_cycles and [0] or None
+    if program.memory_image():
+      self.memory[:len(program.memory_image())] = array.array('H', program.memory_image())
+
+    instructions = program.instructions()
+    # Computed jumps can go where the translated code's switch can.
+    self._pc_index = dict([(pc, program.label_index(label)) for pc, label in program.jump_targets()])
+    self._code = [self._decode(index, x) for index, x in enumerate(instructions)]
+    self._code.append(self._return())
+    self._costs = None
+    if count_cycles:
+      self._costs = [x.cycles() for x in instructions] + [0]
+
+  def run(self, max_steps=None):
+    """Runs until runMachine returns or max_steps instructions have run.
+
+    Returns the number of instructions run; skipped ones don't count.
+    """
+    code = self._code
+    limit = max_steps is None and -1 or max_steps
+    index = 0
+    steps = 0
+    if self._costs is None:
+      while index >= 0 and steps != limit:
+        index = code[index]()
+        steps += 1
+      return steps
+    # A separate loop keeps the cost out of runs that don't count.
+    costs = self._costs
+    cycles = 0
+    while index >= 0 and steps != limit:
+      cycles += costs[index]
+      index = code[index]()
+      steps += 1
+    self.cycles += cycles + self._failed_conditions[0]
+    self._failed_conditions[0] = 0
+    return steps
+
+  def _operand(self, argument, pc):
+    """Resolves argument to ('constant', value), ('register', offset) or
+    ('memory', address), where address() returns the word it refers to."""
+    registers = self.registers
+    kind = argument.__class__.__name__
+    if kind == 'Number':
+      return 'constant', argument.value() & 0xffff
+    if kind == 'Label':
+      program = self._program
+      return 'constant', program.instructions()[program.label_index(argument.label())].pc()
+    if kind == 'Register':
+      if argument.register() == 'PC':
+        return 'constant', pc
+      return 'register', argument.offset()
+    if kind == 'Dereference':
+      inner = argument.argument()
+      inner_kind = inner.__class__.__name__
+      if inner_kind == 'Number':
+        value = inner.value() & 0xffff
+        return 'memory', lambda: value
+      if inner_kind == 'Register':
+        offset = inner.offset()
+        return 'memory', lambda: registers[offset]
+      if inner_kind == 'Addition':
+        value = inner.number().value()
+        offset = inner.register().offset()
+        return 'memory', lambda: (value + registers[offset]) & 0xffff
+    if kind == 'Pop':
+      def pop():
+        address = registers[SP]
+        registers[SP] = (address + 1) & 0xffff
+        return address
+      return 'memory', pop
+    if kind == 'Peek':
+      return 'memory', lambda: registers[SP]
+    if kind == 'Push':
+      def push():
+        address = registers[SP] = (registers[SP] - 1) & 0xffff
+        return address
+      return 'memory', push
+    raise InterpreterError('cannot interpret argument %s' % argument.to_das())
+
+  def _reader(self, operand):
+    kind, x = operand
+    if kind == 'constant':
+      return lambda: x
+    registers = self.registers
+    if kind == 'register':
+      return lambda: registers[x]
+    memory = self.memory
+    pages = self.pages_accessed
+    def read():
+      address = x()
+      pages[address >> 6] |= 1 << ((address >> 3) & 7)
+      return memory[address]
+    return read
+
+  def _writer(self, operand):
+    kind, x = operand
+    if kind == 'constant':
+      # Writing to a literal is silently ignored.
+      return lambda value: None
+    registers = self.registers
+    if kind == 'register':
+      def write(value):
+        registers[x] = value
+      return write
+    memory = self.memory
+    pages = self.pages_accessed
+    def write(value):
+      address = x()
+      pages[address >> 6] |= 1 << ((address >> 3) & 7)
+      memory[address] = value
+    return write
+
+  def _decode(self, index, instruction):
+    program = self._program
+    registers = self.registers
+    next = index + 1
+    pc = instruction.pc()
+    opcode = instruction.opcode().to_das()
+    operands = [self._operand(x, pc) for x in instruction.arguments()]
+
+    if instruction.jump_label() is not None:
+      target = program.label_index(instruction.jump_label())
+      return lambda: target
+    if instruction.is_return():
+      pop = operands[1][1]
+      return_ = self._return()
+      def pop_return():
+        pop()
+        return return_()
+      return pop_return
+    if opcode == 'JSR':
+      target = program.label_index(instruction.arguments()[0].label())
+      calls = self._calls
+      memory = self.memory
+      pages = self.pages_accessed
+      next_pc = pc + instruction.length()
+      def jsr():
+        address = registers[SP] = (registers[SP] - 1) & 0xffff
+        pages[address >> 6] |= 1 << ((address >> 3) & 7)
+        memory[address] = next_pc
+        calls.append(next)
+        return target
+      return jsr
+    if opcode == 'SET' and instruction.arguments()[0].__class__.__name__ == 'Register' and \
+        instruction.arguments()[0].register() == 'PC':
+      return self._computed_jump(self._reader(operands[1]))
+    if opcode == 'OUT':
+      get = self._reader(operands[0])
+      write = self._out.write
+      def out():
+        write('OUT: %d\n' % get())
+        return next
+      return out
+    if opcode == 'DBG':
+      write = self._out.write
+      def dbg():
+        registers[PC] = pc
+        write(vmstate.format_debug(self))
+        return next
+      return dbg
+    if opcode in CONDITIONS:
+      condition = CONDITIONS[opcode]
+      skip = program.skip_end(index)
+      get_a = self._reader(operands[0])
+      get_b = self._reader(operands[1])
+      failed = self._failed_conditions
+      if failed is not None:
+        def counted_branch():
+          if condition(get_a(), get_b()):
+            return next
+          failed[0] += 1
+          return skip
+        return counted_branch
+      def branch():
+        if condition(get_a(), get_b()):
+          return next
+        return skip
+      return branch
+    if opcode == 'SET':
+      return self._set(operands[0], operands[1], next)
+    if opcode in ARITHMETIC:
+      return self._arithmetic(ARITHMETIC[opcode], operands[0], operands[1], next)
+    if opcode in BITWISE:
+      return self._bitwise(BITWISE[opcode], operands[0], operands[1], next)
+    raise InterpreterError('cannot interpret %s' % instruction.to_das())
+
+  def _set(self, a, b, next):
+    registers = self.registers
+    if a[0] == 'register' and b[0] == 'constant':
+      offset, value = a[1], b[1]
+      def set_constant():
+        registers[offset] = value
+        return next
+      return set_constant
+    if a[0] == 'register' and b[0] == 'register':
+      offset, source = a[1], b[1]
+      def set_register():
+        registers[offset] = registers[source]
+        return next
+      return set_register
+    get = self._reader(b)
+    if a[0] == 'memory':
+      # As on the hardware, PUSH/POP as the destination moves SP before the
+      # source is read.
+      address_of = a[1]
+      memory = self.memory
+      pages = self.pages_accessed
+      def set_memory():
+        address = address_of()
+        value = get()
+        pages[address >> 6] |= 1 << ((address >> 3) & 7)
+        memory[address] = value
+        return next
+      return set_memory
+    put = self._writer(a)
+    def set():
+      put(get())
+      return next
+    return set
+
+  def _arithmetic(self, function, a, b, next):
+    registers = self.registers
+    if a[0] == 'register' and b[0] == 'constant':
+      offset, value = a[1], b[1]
+      def arithmetic_constant():
+        registers[offset], registers[O] = function(registers[offset], value)
+        return next
+      return arithmetic_constant
+    if a[0] == 'register' and b[0] == 'register':
+      offset, source = a[1], b[1]
+      def arithmetic_register():
+        registers[offset], registers[O] = function(registers[offset], registers[source])
+        return next
+      return arithmetic_register
+    get_b = self._reader(b)
+    if a[0] == 'memory':
+      # The address is resolved once, so [SP++]-style operands move SP once.
+      address_of = a[1]
+      memory = self.memory
+      pages = self.pages_accessed
+      def arithmetic_memory():
+        address = address_of()
+        pages[address >> 6] |= 1 << ((address >> 3) & 7)
+        memory[address], registers[O] = function(memory[address], get_b())
+        return next
+      return arithmetic_memory
+    get_a = self._reader(a)
+    put_a = self._writer(a)
+    def arithmetic():
+      result, registers[O] = function(get_a(), get_b())
+      put_a(result)
+      return next
+    return arithmetic
+
+  def _bitwise(self, function, a, b, next):
+    registers = self.registers
+    if a[0] == 'register' and b[0] == 'constant':
+      offset, value = a[1], b[1]
+      def bitwise_constant():
+        registers[offset] = function(registers[offset], value)
+        return next
+      return bitwise_constant
+    get_b = self._reader(b)
+    if a[0] == 'memory':
+      address_of = a[1]
+      memory = self.memory
+      pages = self.pages_accessed
+      def bitwise_memory():
+        address = address_of()
+        pages[address >> 6] |= 1 << ((address >> 3) & 7)
+        memory[address] = function(memory[address], get_b())
+        return next
+      return bitwise_memory
+    get_a = self._reader(a)
+    put_a = self._writer(a)
+    def bitwise():
+      put_a(function(get_a(), get_b()))
+      return next
+    return bitwise
+
+  def _computed_jump(self, get):
+    pc_index = self._pc_index
+    def jump():
+      target = get()
+      if target not in pc_index:
+        raise InterpreterError('jump to %d, which is not the address of a label used as a value' % target)
+      return pc_index[target]
+    return jump
+
+  def _return(self):
+    # Like the generated code, returning leaves PC in the state alone.
+    calls = self._calls
+    def return_():
+      if calls:
+        return calls.pop()
+      return -1
+    return return_
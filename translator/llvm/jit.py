@@ -0,0 +1,121 @@
+"""Runs translated programs in-process with llvmlite instead of llvm-as/opt/llc/gcc."""
+
+import ctypes
+import os
+import re
+import sys
+
+try:
+  import llvmlite.binding as llvm
+except ImportError:
+  llvm = None
+
+import blockprofile
+import vmstate
+
+def upgrade_ir(ir):
+  """Rewrites the LLVM 3.0 syntax compile-dcpu.py emits into what llvmlite's
+  LLVM parses: explicit result types on load/getelementptr and no `metadata`
+  keyword. Only the forms the translator itself produces are handled."""
+  ir = re.sub(r'= load ([^*,\s]+)\* ', r'= load \1, \1* ', ir)
+  ir = re.sub(r'getelementptr ([^*,\s]+)\* ', r'getelementptr \1, \1* ', ir)
+  return ir.replace('metadata !', '!')
+
+OUTPUT = ctypes.CFUNCTYPE(None, ctypes.c_uint16)
+DEBUG = ctypes.CFUNCTYPE(None, ctypes.POINTER(vmstate.VMState))
+MEMORY_REFERENCED = ctypes.CFUNCTYPE(None, ctypes.POINTER(vmstate.VMState), ctypes.c_uint16)
+UNKNOWN_JUMP = ctypes.CFUNCTYPE(None, ctypes.POINTER(vmstate.VMState), ctypes.c_uint16)
+RUN_MACHINE = ctypes.CFUNCTYPE(None, ctypes.POINTER(vmstate.VMState))
+
+_initialized = False
+
+def _initialize():
+  global _initialized
+  if llvm is None:
+    raise ImportError('--run needs llvmlite')
+  if not _initialized:
+    llvm.initialize()
+    llvm.initialize_native_target()
+    llvm.initialize_native_asmprinter()
+    _initialized = True
+
+class Machine(object):
+  """A translated program compiled to native code in this process.
+
+  output(), debug(), memory_referenced() and unknown_jump() are Python
+  callbacks that behave like the ones in emulator.c, writing to `out`. Like
+  emulator.c's, unknown_jump() ends the process, and code translated with
+  --profile-blocks merges its counts into blockprofile.default_path() after
+  each run.
+  """
+  def __init__(self, ir, opt_level=2, out=sys.stdout):
+    _initialize()
+    self._out = out
+
+    # The engine resolves these by name, so they must exist (and stay alive)
+    # before it is created.
+    self._callbacks = [OUTPUT(self._output), DEBUG(self._debug), MEMORY_REFERENCED(self._memory_referenced),
+                       UNKNOWN_JUMP(self._unknown_jump)]
+    for name, callback in zip(['output', 'debug', 'memory_referenced', 'unknown_jump'], self._callbacks):
+      llvm.add_symbol(name, ctypes.cast(callback, ctypes.c_void_p).value)
+
+    target_machine = llvm.Target.from_default_triple().create_target_machine(opt=opt_level)
+    module = llvm.parse_assembly(upgrade_ir(ir))
+    module.triple = target_machine.triple
+    module.data_layout = str(target_machine.target_data)
+    module.verify()
+
+    builder = llvm.create_pass_manager_builder()
+    builder.opt_level = opt_level
+    pass_manager = llvm.create_module_pass_manager()
+    builder.populate(pass_manager)
+    pass_manager.run(module)
+
+    self._engine = llvm.create_mcjit_compiler(module, target_machine)
+    self._engine.finalize_object()
+    self._run_machine = RUN_MACHINE(self._engine.get_function_address('runMachine'))
+
+    # See write_profile() in emulator.c.
+    self._profile_slots = 0
+    try:
+      module.get_global_variable('profile_slots')
+    except NameError:
+      pass
+    else:
+      address = self._engine.get_global_value_address
+      self._profile_slots = ctypes.c_uint32.from_address(address('profile_slots')).value
+      pcs = (ctypes.c_uint16 * self._profile_slots).from_address(address('profile_pcs'))
+      self._profile_counters = zip(list(pcs), ctypes.string_at(address('profile_source')).split('\n'))
+
+  def _output(self, num):
+    self._out.write('OUT: %d\n' % num)
+
+  def _debug(self, state):
+    self._out.write(vmstate.format_debug(state.contents))
+
+  def _memory_referenced(self, state, index):
+    vmstate.mark_page(state.contents, index)
+
+  def _unknown_jump(self, state, target):
+    # The generated code can't continue, and an exception can't unwind
+    # through it.
+    self._out.flush()
+    sys.stderr.write('unknown jump target %d from PC %d\n' % (target, state.contents.registers[9]))
+    os._exit(1)
+
+  def run(self, state=None):
+    """Runs the program on state (a fresh, zeroed VMState by default).
+
+    With --profile-blocks, the counters follow VMState, so a state passed in
+    must have room for them.
+    """
+    if state is None:
+      size = ctypes.sizeof(vmstate.VMState) + self._profile_slots * ctypes.sizeof(ctypes.c_uint64)
+      state = vmstate.VMState.from_buffer(ctypes.create_string_buffer(size))
+    self._run_machine(ctypes.byref(state))
+    if self._profile_slots:
+      counts = (ctypes.c_uint64 * self._profile_slots).from_address(
+        ctypes.addressof(state) + ctypes.sizeof(vmstate.VMState))
+      blockprofile.merge(blockprofile.default_path(),
+                         [(pc, source, count) for (pc, source), count in zip(self._profile_counters, counts)])
+    return state
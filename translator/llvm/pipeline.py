@@ -0,0 +1,293 @@
+"""Runs the Makefile's .das -> native pipeline from Python, timing each stage.
+
+The tools can be overridden through the environment (PYTHON, LLVM_AS, OPT,
+OPT_FLAGS, LLC, CC) in the same spirit as make variables.
+
+Given a cache.Cache, build() reuses the .ll, .bc, .s and .o of an earlier
+build of the same source with the same translator, flags and tools.
+build_incremental() instead keeps an object per DCPU function in a work
+directory and only recompiles the functions whose code changed.
+"""
+
+import imp
+import multiprocessing
+import multiprocessing.pool
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cache
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COMPILER = os.path.join(HERE, 'compile-dcpu.py')
+EMULATOR = os.path.join(HERE, 'emulator.c')
+
+PYTHON = os.environ.get('PYTHON', sys.executable)
+LLVM_AS = os.environ.get('LLVM_AS', 'llvm-as')
+OPT = os.environ.get('OPT', 'opt')
+OPT_FLAGS = os.environ.get('OPT_FLAGS', '-std-compile-opts').split()
+LLC = os.environ.get('LLC', 'llc')
+CC = os.environ.get('CC', 'gcc')
+
+STAGES = ['ll', 'bc', 's', 'o']
+
+_compile_dcpu = None
+
+def translator():
+  """compile-dcpu.py, loaded as a module."""
+  global _compile_dcpu
+  if _compile_dcpu is None:
+    _compile_dcpu = imp.load_source('compile_dcpu', COMPILER)
+  return _compile_dcpu
+
+def _translation_key(source, translator_args):
+  compile_dcpu = translator()
+  options = compile_dcpu.options_from_args(compile_dcpu.arg_parser().parse_args(translator_args))
+  return compile_dcpu.translation_key(source, options)
+
+def cache_keys(das, translator_args=()):
+  """The cache key of each stage's output when building das.
+
+  Each key covers the previous stage's key plus the tools and flags that
+  stage runs, so changing anything upstream changes everything after it.
+  """
+  f = open(das)
+  source = f.read()
+  f.close()
+  return stage_keys(_translation_key(source, list(translator_args)))
+
+def stage_keys(ll_key):
+  """cache_keys() for a translation whose own key is ll_key."""
+  keys = {'ll': ll_key}
+  keys['bc'] = cache.digest('bc', keys['ll'], cache.tool_version(LLVM_AS), cache.tool_version(OPT), ' '.join(OPT_FLAGS))
+  keys['s'] = cache.digest('s', keys['bc'], cache.tool_version(LLC))
+  keys['o'] = cache.digest('o', keys['s'], cache.tool_version(CC))
+  return keys
+
+class BuildError(Exception):
+  pass
+
+def _run(command, stdin=None, stdout=None):
+  """Runs command to completion; returns its peak resident set size in KB."""
+  err = tempfile.TemporaryFile()
+  process = subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=err)
+  _, status, usage = os.wait4(process.pid, 0)
+  process.returncode = status
+  if status != 0:
+    err.seek(0)
+    raise BuildError('%s failed:\n%s' % (' '.join(command), err.read()))
+  return usage.ru_maxrss
+
+def _copy_from_cache(build_cache, key, path):
+  data = build_cache.get(key)
+  if data is None:
+    return False
+  f = open(path, 'wb')
+  f.write(data)
+  f.close()
+  return True
+
+def _store_in_cache(build_cache, key, path):
+  f = open(path, 'rb')
+  build_cache.put(key, f.read())
+  f.close()
+
+def build(das, executable, translator_args=(), build_cache=None):
+  """Builds das into executable.
+
+  Returns the seconds spent in each stage, plus the translator's peak memory.
+  With a cache, also returns how many of the four cacheable stages were
+  reused (cache_hits) and how many had to run (cache_misses); stages before
+  the last one found in the cache are skipped entirely.
+  """
+  base = os.path.splitext(executable)[0]
+  timings = {'translate': 0.0, 'translate_maxrss_kb': 0, 'opt': 0.0, 'llc': 0.0}
+
+  first = 0
+  if build_cache is not None:
+    keys = cache_keys(das, translator_args)
+    for i in reversed(xrange(len(STAGES))):
+      if _copy_from_cache(build_cache, keys[STAGES[i]], base + '.' + STAGES[i]):
+        first = i + 1
+        break
+    timings['cache_hits'] = first
+    timings['cache_misses'] = len(STAGES) - first
+
+  def finish(stage):
+    if build_cache is not None:
+      _store_in_cache(build_cache, keys[stage], base + '.' + stage)
+
+  if first <= 0:
+    start = time.time()
+    with open(das) as f_in:
+      with open(base + '.ll', 'w') as f_out:
+        timings['translate_maxrss_kb'] = _run([PYTHON, COMPILER] + list(translator_args), stdin=f_in, stdout=f_out)
+    timings['translate'] = time.time() - start
+    finish('ll')
+
+  if first <= 1:
+    start = time.time()
+    optimize(base)
+    timings['opt'] = time.time() - start
+    finish('bc')
+
+  if first <= 2:
+    start = time.time()
+    generate_assembly(base)
+    timings['llc'] = time.time() - start
+    finish('s')
+
+  start = time.time()
+  if first <= 3:
+    assemble(base)
+    finish('o')
+  _run([CC, base + '.o', EMULATOR, '-o', executable])
+  timings['link'] = time.time() - start
+
+  return timings
+
+# Each stage reads and writes files named base plus the stage's extension.
+def optimize(base):
+  _run([LLVM_AS, base + '.ll', '-o', base + '.raw.bc'])
+  _run([OPT] + OPT_FLAGS + [base + '.raw.bc', '-o', base + '.bc'])
+
+def generate_assembly(base, flags=()):
+  _run([LLC] + list(flags) + [base + '.bc', '-o', base + '.s'])
+
+def assemble(base):
+  _run([CC, '-c', base + '.s', '-o', base + '.o'])
+
+def compile_object(base):
+  """Compiles base.ll to base.o."""
+  optimize(base)
+  generate_assembly(base)
+  assemble(base)
+
+def _object_key(ir):
+  return cache.digest('function', ir, cache.tool_version(LLVM_AS), cache.tool_version(OPT), ' '.join(OPT_FLAGS),
+                      cache.tool_version(LLC), cache.tool_version(CC))
+
+def _read(path):
+  f = open(path)
+  data = f.read()
+  f.close()
+  return data
+
+def build_incremental(das, executable, work_dir, translator_args=(), jobs=None):
+  """Builds das into executable one function at a time.
+
+  The translator writes one module per function (compile-dcpu.py
+  --split-dir). work_dir/functions keeps each function's object, named
+  after the function, and the key of the IR it was built from. Only modules whose IR
+  changed since the last build in work_dir are compiled, on jobs threads
+  (one per core by default), before everything is linked again.
+
+  Returns the seconds spent translating, compiling (opt, llc and the
+  assembler together) and linking, plus how many modules were compiled
+  (compiled) and reused (reused).
+  """
+  functions_dir = os.path.join(work_dir, 'functions')
+  if not os.path.isdir(functions_dir):
+    os.makedirs(functions_dir)
+  split_dir = os.path.join(work_dir, 'split')
+  if os.path.isdir(split_dir):
+    shutil.rmtree(split_dir)
+  timings = {}
+
+  start = time.time()
+  with open(das) as f_in:
+    timings['translate_maxrss_kb'] = _run([PYTHON, COMPILER, '--split-dir', split_dir] + list(translator_args),
+                                          stdin=f_in)
+  timings['translate'] = time.time() - start
+  names = _read(os.path.join(split_dir, 'modules')).split()
+
+  stale = []
+  for name in names:
+    key = _object_key(_read(os.path.join(split_dir, name + '.ll')))
+    base = os.path.join(functions_dir, name)
+    if not (os.path.exists(base + '.o') and os.path.exists(base + '.key') and _read(base + '.key') == key):
+      stale.append((name, key))
+  def compile_function(task):
+    name, key = task
+    base = os.path.join(functions_dir, name)
+    if os.path.exists(base + '.key'):
+      os.unlink(base + '.key')
+    shutil.copy(os.path.join(split_dir, name + '.ll'), base + '.ll')
+    compile_object(base)
+    f = open(base + '.key', 'w')
+    f.write(key)
+    f.close()
+  start = time.time()
+  if stale:
+    pool = multiprocessing.pool.ThreadPool(min(len(stale), jobs or multiprocessing.cpu_count()))
+    try:
+      pool.map(compile_function, stale)
+    finally:
+      pool.close()
+      pool.join()
+  timings['compile'] = time.time() - start
+  timings['compiled'] = len(stale)
+  timings['reused'] = len(names) - len(stale)
+
+  start = time.time()
+  emulator = os.path.join(work_dir, 'emulator.o')
+  emulator_key = cache.digest('emulator', cache.file_digest(EMULATOR), cache.tool_version(CC))
+  if not (os.path.exists(emulator + '.key') and _read(emulator + '.key') == emulator_key):
+    _run([CC, '-c', EMULATOR, '-o', emulator])
+    f = open(emulator + '.key', 'w')
+    f.write(emulator_key)
+    f.close()
+  _run([CC] + [os.path.join(functions_dir, name + '.o') for name in names] + [emulator, '-o', executable])
+  timings['link'] = time.time() - start
+  return timings
+
+def build_library(das, library, translator_args=()):
+  """Builds das, with emulator.c's callbacks but not its main(), into a
+  shared object that harness.py can load. Returns the seconds spent in each
+  stage, as build() does."""
+  base = os.path.splitext(library)[0]
+  timings = {}
+  start = time.time()
+  with open(das) as f_in:
+    with open(base + '.ll', 'w') as f_out:
+      timings['translate_maxrss_kb'] = _run([PYTHON, COMPILER] + list(translator_args), stdin=f_in, stdout=f_out)
+  timings['translate'] = time.time() - start
+  start = time.time()
+  optimize(base)
+  timings['opt'] = time.time() - start
+  start = time.time()
+  generate_assembly(base, ['-relocation-model=pic'])
+  timings['llc'] = time.time() - start
+  start = time.time()
+  _run([CC, '-shared', '-fPIC', '-DDCPU_LIBRARY', base + '.s', EMULATOR, '-o', library])
+  timings['link'] = time.time() - start
+  return timings
+
+CYCLES_RE = re.compile(r'^cycles: (\d+)\n', re.M)
+
+def run(executable, env=None):
+  """Runs a built program, in env if given; returns (output, seconds)."""
+  start = time.time()
+  output = subprocess.check_output([os.path.abspath(executable)], env=env)
+  return output, time.time() - start
+
+def run_counting_cycles(executable, env=None):
+  """Runs a program translated with --count-cycles, in env if given;
+  returns (output, seconds, the cycle total the emulator reports). Anything
+  else the program writes to stderr is passed on."""
+  start = time.time()
+  process = subprocess.Popen([os.path.abspath(executable)], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=env)
+  output, errors = process.communicate()
+  elapsed = time.time() - start
+  if process.returncode:
+    raise subprocess.CalledProcessError(process.returncode, executable, output)
+  # The emulator only reports a count it kept, and so not one of zero.
+  match = CYCLES_RE.search(errors)
+  sys.stderr.write(CYCLES_RE.sub('', errors))
+  return output, elapsed, match and int(match.group(1)) or 0
@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import interpreter
+import pipeline
+import workloads
+
+# name -> (generator, sizes); each generator takes the size as its only
+# required argument and returns a program that loops long enough to time.
+WORKLOADS = [
+  ('arithmetic', workloads.arithmetic, [16, 128, 1024]),
+  ('memcopy', lambda size: workloads.memcopy(size, 2000), [256, 2048, 16384]),
+  ('calls', workloads.calls, [2, 5, 8]),
+  ('conditions', workloads.conditions, [16, 128, 1024]),
+  ('divmod', workloads.division, [16, 128, 1024]),
+]
+
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=pipeline.HERE,
+                                   stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def interpret(source, max_steps):
+  """Runs source in the reference interpreter; returns steps per second."""
+  program = pipeline.translator().parse(source)
+  machine = interpreter.Interpreter(program, open(os.devnull, 'w'))
+  start = time.time()
+  steps = machine.run(max_steps)
+  return steps / (time.time() - start)
+
+def run_benchmark(name, generator, size, work_dir, translator_args, repeat, interpreter_steps):
+  source = generator(size)
+  das = os.path.join(work_dir, '%s-%d.das' % (name, size))
+  f = open(das, 'w')
+  f.write(source)
+  f.close()
+
+  executable = os.path.splitext(das)[0]
+  timings = pipeline.build(das, executable, translator_args)
+  runtimes = [pipeline.run(executable)[1] for i in range(repeat)]
+  lines = source.count('\n')
+  return {
+    'workload': name,
+    'size': size,
+    'lines': lines,
+    'translate': timings['translate'],
+    'translate_lines_per_second': lines / timings['translate'],
+    'translate_maxrss_kb': timings['translate_maxrss_kb'],
+    'opt': timings['opt'],
+    'llc': timings['llc'],
+    'link': timings['link'],
+    'run': min(runtimes),
+    'interpret_steps_per_second': interpret(source, interpreter_steps),
+  }
+
+COLUMNS = [('translate', 'translate'), ('translate_maxrss_kb', 'peak KB'), ('opt', 'opt'), ('llc', 'llc'),
+           ('run', 'run'), ('interpret_steps_per_second', 'steps/s')]
+
+def print_comparison(results, baseline):
+  old = dict([((x['workload'], x['size']), x) for x in baseline['results']])
+  print ''
+  print 'Compared with %s (new / old):' % (baseline.get('revision') or 'baseline')
+  print '%-12s %6s ' % ('workload', 'size') + ' '.join(['%10s' % x[1] for x in COLUMNS])
+  for result in results:
+    previous = old.get((result['workload'], result['size']))
+    if previous is None:
+      continue
+    ratios = []
+    for column, header in COLUMNS:
+      if previous.get(column):
+        ratios.append('%9.2fx' % (result[column] / float(previous[column])))
+      else:
+        ratios.append('%10s' % '-')
+    print '%-12s %6d ' % (result['workload'], result['size']) + ' '.join(ratios)
+
+def main(argv):
+  arg_parser = argparse.ArgumentParser(description='Benchmark the translator and the code it generates.')
+  arg_parser.add_argument('workloads', nargs='*', help='workloads to run (default: all)')
+  arg_parser.add_argument('--output', help='write results as JSON to this file')
+  arg_parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+  arg_parser.add_argument('--translator-args', default='',
+                          help='extra arguments for compile-dcpu.py, e.g. "--registers local"')
+  arg_parser.add_argument('--sizes', choices=['small', 'all'], default='all',
+                          help='run only the smallest size of each workload, or every size')
+  arg_parser.add_argument('--repeat', type=int, default=3, help='native runs per program; the best is kept')
+  arg_parser.add_argument('--interpreter-steps', type=int, default=1000000,
+                          help='instructions to run in the reference interpreter per program')
+  args = arg_parser.parse_args(argv)
+
+  work_dir = tempfile.mkdtemp()
+  results = []
+  try:
+    print '%-12s %6s %7s %9s %8s %8s %8s %8s %9s' % ('workload', 'size', 'lines', 'lines/s', 'peak KB',
+                                                     'opt s', 'llc s', 'run s', 'steps/s')
+    for name, generator, sizes in WORKLOADS:
+      if args.workloads and name not in args.workloads:
+        continue
+      for size in sizes[:args.sizes == 'small' and 1 or None]:
+        result = run_benchmark(name, generator, size, work_dir, args.translator_args.split(), args.repeat,
+                               args.interpreter_steps)
+        results.append(result)
+        print '%-12s %6d %7d %9.0f %8d %8.3f %8.3f %8.3f %9.0f' % (
+          name, size, result['lines'], result['translate_lines_per_second'], result['translate_maxrss_kb'],
+          result['opt'], result['llc'], result['run'], result['interpret_steps_per_second'])
+        sys.stdout.flush()
+  finally:
+    shutil.rmtree(work_dir)
+
+  report = {
+    'revision': git_revision(),
+    'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'translator_args': args.translator_args,
+    'results': results,
+  }
+  if args.output:
+    f = open(args.output, 'w')
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.close()
+  if args.compare:
+    f = open(args.compare)
+    print_comparison(results, json.load(f))
+    f.close()
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -1,34 +1,304 @@
+import argparse
+import blockprofile
+import cStringIO
+import json
+import multiprocessing
 import os
 import os.path
 import re
-import sys
+import shutil
 import subprocess
+import sys
+import tempfile
 
-tests_dir = os.path.join(os.path.dirname(sys.argv[0]), 'tests')
-tests = []
+import cache
+import interpreter
+import pipeline
+import snapshot
+import vmstate
 
+tests_dir = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), 'tests')
 expected_file_re = re.compile(r'(.+)-expected.txt')
-for f in os.listdir(tests_dir):
-  m = re.match(expected_file_re, f)
-  if m is not None:
-    tests.append(m.group(1))
-
-failures = 0
-for test in tests:
-  print 'Running %s ...' % test
+
+def find_tests():
+  tests = []
+  for f in sorted(os.listdir(tests_dir)):
+    m = re.match(expected_file_re, f)
+    if m is not None:
+      tests.append(m.group(1))
+  return tests
+
+def expected_cycles(test):
+  """The cycle total in tests/<test>-cycles.txt, or None if there is none."""
+  path = os.path.join(tests_dir, test + '-cycles.txt')
+  if not os.path.exists(path):
+    return None
+  f = open(path)
+  cycles = int(f.read())
+  f.close()
+  return cycles
+
+def expected_profile(test):
+  """The path of tests/<test>-profile.txt, or None if there is none."""
+  path = os.path.join(tests_dir, test + '-profile.txt')
+  if not os.path.exists(path):
+    return None
+  return path
+
+def move_profile_lines(path):
+  """Adds one to every line number in the profile at path, as adding a
+  comment line above the code would."""
+  f = open(path)
+  lines = f.readlines()
+  f.close()
+  f = open(path, 'w')
+  for line in lines:
+    f.write(re.sub(r'^(\d+ [0-9a-f]+ )(\d+):', lambda m: '%s%d:' % (m.group(1), int(m.group(2)) + 1), line))
+  f.close()
+
+def interpreted_cycles(das):
+  """The cycles the reference interpreter counts running das."""
+  f = open(das)
+  program = pipeline.translator().parse(f.read())
+  f.close()
+  machine = interpreter.Interpreter(program, cStringIO.StringIO(), count_cycles=True)
+  machine.run()
+  return machine.cycles
+
+def memory_tracking(translator_args):
+  """The --memory-tracking mode translator_args translate with."""
+  parser = argparse.ArgumentParser(add_help=False)
+  parser.add_argument('--memory-tracking', default='call')
+  return parser.parse_known_args(translator_args)[0].memory_tracking
+
+def snapshot_problems(test, executable, das, build_dir, translator_args, native):
+  """How the snapshot the native run of test wrote to native falls short:
+  it must match the interpreter's, survive Snapshot.restore() and
+  snapshot.write() unchanged, show a one-word change as that word alone, and
+  be a state the emulator can start from with $DCPU_RESTORE."""
+  problems = []
+  base = os.path.join(build_dir, test)
+  command = [pipeline.PYTHON, pipeline.COMPILER, '--interpret', '--snapshot', base + '-interpreted.snap']
+  if '--count-cycles' in translator_args:
+    command.append('--count-cycles')
+  f = open(das)
+  try:
+    subprocess.check_output(command, stdin=f, stderr=subprocess.STDOUT)
+  finally:
+    f.close()
+  a = snapshot.Snapshot(native)
+  b = snapshot.Snapshot(base + '-interpreted.snap')
+  problems += ['interpreted: ' + snapshot.format_difference(x) for x in snapshot.diff(a, b)]
+  b.close()
+
+  state = a.restore()
+  snapshot.write(state, base + '-restored.snap')
+  b = snapshot.Snapshot(base + '-restored.snap')
+  problems += ['restored: ' + snapshot.format_difference(x) for x in snapshot.diff(a, b)]
+  b.close()
+  marked = [page for page in xrange(vmstate.PAGES) if vmstate.page_accessed(state, page)]
+  if marked:
+    address = marked[-1] * vmstate.PAGE_WORDS + vmstate.PAGE_WORDS - 1
+    word = state.memory[address]
+    state.memory[address] = word ^ 0xffff
+    snapshot.write(state, base + '-changed.snap')
+    b = snapshot.Snapshot(base + '-changed.snap')
+    differences = snapshot.diff(a, b)
+    if differences != [('memory', address, word, word ^ 0xffff)]:
+      problems.append('one word changed at %04X: %s' % (
+        address, '; '.join([snapshot.format_difference(x) for x in differences]) or 'no differences'))
+    b.close()
+
+  # Started from a snapshot holding one word on a page the program never
+  # touches, it must end as it did before but for that page.
+  page = [x for x in xrange(vmstate.PAGES / 2, vmstate.PAGES) if not vmstate.page_accessed(state, x)][0]
+  start = vmstate.VMState()
+  start.memory[page * vmstate.PAGE_WORDS] = 0x5a5a
+  vmstate.mark_page(start, page * vmstate.PAGE_WORDS)
+  snapshot.write(start, base + '-start.snap')
+  env = dict(os.environ, DCPU_RESTORE=base + '-start.snap', DCPU_SNAPSHOT=base + '-from-start.snap',
+             DCPU_PROFILE=base + '-from-start-profile.txt')
+  subprocess.check_output([os.path.abspath(executable)], stderr=subprocess.STDOUT, env=env)
+  b = snapshot.Snapshot(base + '-from-start.snap')
+  differences = snapshot.diff(a, b)
+  if differences != [('marked', page, False, True)] or b.page(page)[:2] != '\x5a\x5a':
+    problems.append('started from a snapshot with page %04X: %s' % (
+      page, '; '.join([snapshot.format_difference(x) for x in differences]) or 'page lost'))
+  b.close()
+  a.close()
+  return problems
+
+def run_test(job):
+  """Builds and runs one test case; returns its result record."""
+  test, build_dir, translator_args, cache_dir, incremental, snapshots = job
+  result = {'test': test, 'passed': False}
   f = open(os.path.join(tests_dir, test + '-expected.txt'))
   expected = f.read()
   f.close()
+  # Code translated with --count-cycles reports its total on stderr, which
+  # has to match the spec's, as the interpreter's must, when the test has a
+  # -cycles.txt.
+  counting = '--count-cycles' in translator_args
+  cycles = counting and expected_cycles(test) or None
+  # A test with a -profile.txt is built with --profile-blocks and run twice;
+  # the profile the two runs merge must have its counters. It can have
+  # more, as it does when inlining splits blocks. The line numbers are moved
+  # between the runs, which mustn't lose the first run's counts.
+  profile = expected_profile(test)
+  if profile is not None:
+    translator_args = translator_args + ['--profile-blocks']
+  # With --snapshots, every test's final state is snapshotted and checked;
+  # see snapshot_problems(). Code that doesn't mark pages can't match the
+  # interpreter's snapshots.
+  snapshots = snapshots and memory_tracking(translator_args) != 'off'
 
-  actual = subprocess.check_output([os.path.join(tests_dir, test)])
-  if actual != expected:
-    print 'Test case %s failed. Expected:' % test
-    print expected
-    print 'Actual:'
-    print actual
-    print ''
+  try:
+    executable = os.path.join(build_dir, test)
+    das = os.path.join(tests_dir, test + '.das')
+    if incremental:
+      timings = pipeline.build_incremental(das, executable, os.path.join(build_dir, test + '.functions'),
+                                           translator_args, 1)
+      result['functions_compiled'] = timings['compiled']
+      result['functions_reused'] = timings['reused']
+      result['compile'] = timings['compile'] + timings['link']
+    else:
+      build_cache = cache_dir and cache.Cache(cache_dir) or None
+      timings = pipeline.build(das, executable, translator_args, build_cache)
+      if build_cache is not None:
+        result['cache_hits'] = timings['cache_hits']
+        result['cache_misses'] = timings['cache_misses']
+      result['compile'] = timings['opt'] + timings['llc'] + timings['link']
+    result['translate'] = timings['translate']
+    env = None
+    if profile is not None:
+      profile_path = os.path.join(build_dir, test + '-profile.txt')
+      if os.path.exists(profile_path):
+        os.remove(profile_path)
+      env = dict(os.environ, DCPU_PROFILE=profile_path)
+      # The first of the two runs.
+      if counting:
+        pipeline.run_counting_cycles(executable, env)
+      else:
+        pipeline.run(executable, env)
+      move_profile_lines(profile_path)
+    if snapshots:
+      native_snapshot = os.path.join(build_dir, test + '.snap')
+      env = dict(env or os.environ, DCPU_SNAPSHOT=native_snapshot)
+    if not counting:
+      actual, result['execute'] = pipeline.run(executable, env)
+    else:
+      actual, result['execute'], result['cycles'] = pipeline.run_counting_cycles(executable, env)
+      if cycles is not None:
+        result['interpreted_cycles'] = interpreted_cycles(das)
+    if profile is not None:
+      expected_counts = blockprofile.read(profile)
+      actual_counts = blockprofile.read(profile_path)
+      result['profile_mismatches'] = ['%s %04x %s' % (expected_counts[key], key[0], key[1])
+                                      for key in sorted(expected_counts)
+                                      if actual_counts.get(key) != expected_counts[key]]
+      f = open(profile_path)
+      result['profile'] = f.read()
+      f.close()
+    if snapshots:
+      result['snapshot_problems'] = snapshot_problems(test, executable, das, build_dir, translator_args,
+                                                      native_snapshot)
+  except pipeline.BuildError, e:
+    result['error'] = str(e)
+    return result
+  except Exception, e:
+    result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    return result
+
+  result['passed'] = actual == expected
+  if profile is not None and result['profile_mismatches']:
+    result['passed'] = False
+    actual += result['profile']
+    expected += 'counters:\n' + ''.join([x + '\n' for x in result['profile_mismatches']])
+  if snapshots and result['snapshot_problems']:
+    result['passed'] = False
+    actual += ''.join(['snapshot: %s\n' % x for x in result['snapshot_problems']])
+  if cycles is not None and (result['cycles'], result['interpreted_cycles']) != (cycles, cycles):
+    result['passed'] = False
+    actual += 'cycles: %d (interpreter: %d)\n' % (result['cycles'], result['interpreted_cycles'])
+    expected += 'cycles: %d\n' % cycles
+  if not result['passed']:
+    result['expected'] = expected
+    result['actual'] = actual
+  return result
+
+def main(argv):
+  arg_parser = argparse.ArgumentParser(description='Build every test case from source and check its output.')
+  arg_parser.add_argument('tests', nargs='*', help='test names (default: every tests/*-expected.txt)')
+  arg_parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                          help='parallel builds (default: number of cores)')
+  arg_parser.add_argument('--json', help='write per-test results and timings to this file')
+  arg_parser.add_argument('--translator-args', default='',
+                          help='extra arguments for compile-dcpu.py, e.g. "--registers local"; with '
+                          '--count-cycles, cycle totals are checked against tests/*-cycles.txt')
+  arg_parser.add_argument('--snapshots', action='store_true',
+                          help='also snapshot each test\'s final state and check it against the interpreter\'s '
+                          'and through a restore and a rerun (skipped with --memory-tracking off)')
+  arg_parser.add_argument('--build-dir', help='keep build products here instead of a temporary directory')
+  arg_parser.add_argument('--cache-dir', default=cache.default_directory(),
+                          help='reuse build products stored here (default: $DCPU_CACHE_DIR; no caching if unset)')
+  arg_parser.add_argument('--incremental', action='store_true',
+                          help='build one object per function, recompiling only functions that changed since the '
+                          'last run with the same --build-dir (the cache is not used)')
+  args = arg_parser.parse_args(argv)
+
+  tests = args.tests or find_tests()
+  build_dir = args.build_dir or tempfile.mkdtemp()
+  if not os.path.isdir(build_dir):
+    os.makedirs(build_dir)
+  jobs = [(test, build_dir, args.translator_args.split(), args.cache_dir, args.incremental, args.snapshots)
+          for test in tests]
+
+  pool = multiprocessing.Pool(max(1, args.jobs))
+  try:
+    results = []
+    for result in pool.imap(run_test, jobs):
+      results.append(result)
+      if 'error' in result:
+        print '%-20s ERROR' % result['test']
+      else:
+        print '%-20s %-5s translate %6.3fs  compile %6.3fs  execute %6.3fs' % (
+          result['test'], result['passed'] and 'ok' or 'FAIL',
+          result['translate'], result['compile'], result['execute'])
+  finally:
+    pool.close()
+    pool.join()
+    if not args.build_dir:
+      shutil.rmtree(build_dir)
+
+  failures = 0
+  for result in results:
+    if result['passed']:
+      continue
     failures += 1
+    print ''
+    if 'error' in result:
+      print 'Test case %s could not be built or run:' % result['test']
+      print result['error']
+    else:
+      print 'Test case %s failed. Expected:' % result['test']
+      print result['expected']
+      print 'Actual:'
+      print result['actual']
+
+  if args.json:
+    f = open(args.json, 'w')
+    json.dump({'translator_args': args.translator_args, 'results': results}, f, indent=2, sort_keys=True)
+    f.close()
+
+  if args.incremental:
+    print 'functions: %d compiled, %d reused' % (sum([r.get('functions_compiled', 0) for r in results]),
+                                                 sum([r.get('functions_reused', 0) for r in results]))
+  elif args.cache_dir:
+    print 'cache: %d hits, %d misses' % (sum([r.get('cache_hits', 0) for r in results]),
+                                         sum([r.get('cache_misses', 0) for r in results]))
+  print 'Total failures: %d' % failures
+  if failures > 0:
+    sys.exit(1)
 
-print 'Total failures: %d' % failures
-if failures > 0:
-  sys.exit(1)
+if __name__ == '__main__':
+  main(sys.argv[1:])
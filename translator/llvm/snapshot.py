@@ -0,0 +1,215 @@
+"""Binary snapshots of a machine: registers, cycle count and the pages marked
+in pages_accessed, and nothing else.
+
+A snapshot is, in the byte order of the machine that wrote it:
+
+  char   magic[8]             "DCPUSNAP"
+  uint16 version              1
+  uint16 registers[11]        A B C X Y Z I J SP PC O
+  uint64 cycles
+  uint8  pages_accessed[1024] as in VMState
+  uint16 pages[n][8]          each marked page, in address order
+
+emulator.c writes one at exit if $DCPU_SNAPSHOT names a file and starts
+from $DCPU_RESTORE; compile-dcpu.py --snapshot writes one after --run or
+--interpret. Pages that were never accessed are not kept, so regression
+jobs should compare snapshots translated with the same --memory-tracking.
+
+  python snapshot.py A B
+
+prints how snapshots A and B differ and exits 1 if they do;
+`python snapshot.py A` prints A as DBG would.
+"""
+
+import array
+import bisect
+import ctypes
+import mmap
+import struct
+import sys
+
+import vmstate
+
+MAGIC = 'DCPUSNAP'
+VERSION = 1
+HEADER = struct.Struct('=8sH%dHQ' % len(vmstate.REGISTER_NAMES))
+REGISTERS_OFFSET = struct.calcsize('=8sH')
+BITMAP_BYTES = vmstate.PAGES / 8
+PAGE_BYTES = vmstate.PAGE_WORDS * 2
+PAGES_OFFSET = HEADER.size + BITMAP_BYTES
+# diff() compares this many pages at a time before looking at single pages.
+CHUNK_PAGES = 64
+
+class SnapshotError(Exception):
+  pass
+
+def _marked_runs(bitmap):
+  """(first page, end page) of each run of pages marked in bitmap."""
+  runs = []
+  start = None
+  for byte_index in xrange(BITMAP_BYTES):
+    byte = ord(bitmap[byte_index])
+    if byte == 0 and start is None:
+      continue
+    if byte == 0xff and start is not None:
+      continue
+    for bit in xrange(8):
+      page = byte_index * 8 + bit
+      if byte & (1 << bit):
+        if start is None:
+          start = page
+      elif start is not None:
+        runs.append((start, page))
+        start = None
+  if start is not None:
+    runs.append((start, vmstate.PAGES))
+  return runs
+
+def write(state, path):
+  """Writes a snapshot of state, a vmstate.VMState or an
+  interpreter.Interpreter, to path."""
+  # Straight from the VMState (or the interpreter's array) without a copy.
+  memory = buffer(state.memory)
+  bitmap = ''.join([chr(x) for x in state.pages_accessed])
+  f = open(path, 'wb')
+  f.write(HEADER.pack(MAGIC, VERSION, *(list(state.registers) + [state.cycles])))
+  f.write(bitmap)
+  for start, end in _marked_runs(bitmap):
+    f.write(memory[start * PAGE_BYTES:end * PAGE_BYTES])
+  f.close()
+
+class Snapshot(object):
+  """A snapshot file, mapped into memory.
+
+  registers and cycles are as saved; pages_accessed is the bitmap as a
+  string. page(n) is the words of marked page n as a string of bytes.
+  """
+  def __init__(self, path):
+    self.path = path
+    f = open(path, 'rb')
+    try:
+      self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    except (EnvironmentError, ValueError), e:
+      raise SnapshotError('%s: cannot map: %s' % (path, e))
+    finally:
+      f.close()
+    if len(self._data) < PAGES_OFFSET:
+      raise SnapshotError('%s: not a snapshot' % path)
+    fields = HEADER.unpack_from(self._data)
+    if fields[0] != MAGIC or fields[1] != VERSION:
+      raise SnapshotError('%s: not a snapshot from this kind of machine' % path)
+    self.registers = fields[2:-1]
+    self.cycles = fields[-1]
+    self.pages_accessed = self._data[HEADER.size:PAGES_OFFSET]
+    self._runs = _marked_runs(self.pages_accessed)
+    self._starts = [start for start, end in self._runs]
+    self._offsets = []
+    offset = PAGES_OFFSET
+    for start, end in self._runs:
+      self._offsets.append(offset)
+      offset += (end - start) * PAGE_BYTES
+    if offset != len(self._data):
+      raise SnapshotError('%s: %d bytes of pages for %d marked pages' % (
+        path, len(self._data) - PAGES_OFFSET, (offset - PAGES_OFFSET) / PAGE_BYTES))
+
+  def marked(self, page):
+    return bool(ord(self.pages_accessed[page / 8]) & (1 << (page % 8)))
+
+  def page(self, page):
+    run = bisect.bisect_right(self._starts, page) - 1
+    if run < 0 or page >= self._runs[run][1]:
+      return None
+    offset = self._offsets[run] + (page - self._runs[run][0]) * PAGE_BYTES
+    return self._data[offset:offset + PAGE_BYTES]
+
+  def restore(self, state=None):
+    """Loads the snapshot into state (a new, zeroed vmstate.VMState by
+    default) and returns it; each run of pages is one copy out of the
+    mapping."""
+    if state is None:
+      state = vmstate.VMState()
+    base = ctypes.addressof(ctypes.c_char.from_buffer(self._data))
+    ctypes.memmove(state.registers, base + REGISTERS_OFFSET, ctypes.sizeof(state.registers))
+    state.cycles = self.cycles
+    ctypes.memmove(state.pages_accessed, base + HEADER.size, BITMAP_BYTES)
+    memory = ctypes.addressof(state.memory)
+    for (start, end), offset in zip(self._runs, self._offsets):
+      ctypes.memmove(memory + start * PAGE_BYTES, base + offset, (end - start) * PAGE_BYTES)
+    return state
+
+  def close(self):
+    self._data.close()
+
+def diff(a, b):
+  """How snapshots a and b differ, as a list of tuples:
+
+    ('register', name, a's value, b's value)
+    ('cycles', a's count, b's count)
+    ('marked', page, marked in a, marked in b)
+    ('memory', address, a's word, b's word)
+
+  Words are only compared in pages both snapshots have.
+  """
+  differences = []
+  for name, x, y in zip(vmstate.REGISTER_NAMES, a.registers, b.registers):
+    if x != y:
+      differences.append(('register', name, x, y))
+  if a.cycles != b.cycles:
+    differences.append(('cycles', a.cycles, b.cycles))
+  if a.pages_accessed == b.pages_accessed:
+    # The usual case: compare all the pages at once, then find the words.
+    if a._data[PAGES_OFFSET:] == b._data[PAGES_OFFSET:]:
+      return differences
+    pages = []
+    for (start, end), offset in zip(a._runs, a._offsets):
+      for chunk in xrange(start, end, CHUNK_PAGES):
+        chunk_offset = offset + (chunk - start) * PAGE_BYTES
+        chunk_end = chunk_offset + min(CHUNK_PAGES, end - chunk) * PAGE_BYTES
+        if a._data[chunk_offset:chunk_end] != b._data[chunk_offset:chunk_end]:
+          pages.extend(xrange(chunk, min(chunk + CHUNK_PAGES, end)))
+  else:
+    pages = []
+    for page in xrange(vmstate.PAGES):
+      if a.marked(page) != b.marked(page):
+        differences.append(('marked', page, a.marked(page), b.marked(page)))
+      elif a.marked(page):
+        pages.append(page)
+  for page in pages:
+    x, y = a.page(page), b.page(page)
+    if x != y:
+      x, y = array.array('H', x), array.array('H', y)
+      for word in xrange(vmstate.PAGE_WORDS):
+        if x[word] != y[word]:
+          differences.append(('memory', page * vmstate.PAGE_WORDS + word, x[word], y[word]))
+  return differences
+
+def format_difference(difference):
+  kind = difference[0]
+  if kind == 'register':
+    return 'register %s: %d != %d' % difference[1:]
+  if kind == 'cycles':
+    return 'cycles: %d != %d' % difference[1:]
+  if kind == 'marked':
+    return 'page %04X: accessed in %s only' % (difference[1], difference[2] and 'the first' or 'the second')
+  return 'memory %04X: %04X != %04X' % difference[1:]
+
+def main(argv):
+  if len(argv) not in (1, 2):
+    print >>sys.stderr, 'usage: snapshot.py SNAPSHOT [OTHER]'
+    sys.exit(2)
+  try:
+    snapshots = [Snapshot(x) for x in argv]
+  except (SnapshotError, EnvironmentError), e:
+    print >>sys.stderr, 'snapshot.py: %s' % e
+    sys.exit(2)
+  if len(snapshots) == 1:
+    sys.stdout.write(vmstate.format_debug(snapshots[0].restore()))
+    return
+  differences = diff(*snapshots)
+  for difference in differences:
+    print format_difference(difference)
+  if differences:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
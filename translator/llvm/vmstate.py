@@ -0,0 +1,41 @@
+"""The VMState struct shared by emulator.c and the generated code, in Python."""
+
+import ctypes
+
+REGISTER_NAMES = ['A', 'B', 'C', 'X', 'Y', 'Z', 'I', 'J', 'SP', 'PC', 'O']
+MEMORY_WORDS = 65536
+PAGE_WORDS = 8
+PAGES = MEMORY_WORDS / PAGE_WORDS
+
+class VMState(ctypes.Structure):
+  _fields_ = [
+    ('registers', ctypes.c_uint16 * len(REGISTER_NAMES)),
+    ('memory', ctypes.c_uint16 * MEMORY_WORDS),
+    ('pages_accessed', ctypes.c_uint8 * (PAGES / 8)),
+    # Only kept by code translated with --count-cycles.
+    ('cycles', ctypes.c_uint64),
+    # Code translated with --profile-blocks also keeps one c_uint64 counter per
+    # block after the end of the structure; see jit.Machine.run().
+  ]
+
+def mark_page(state, index):
+  # Same as memory_referenced() in emulator.c.
+  page = index / PAGE_WORDS
+  state.pages_accessed[page / 8] |= 1 << (page % 8)
+
+def page_accessed(state, page):
+  return bool(state.pages_accessed[page / 8] & (1 << (page % 8)))
+
+def format_debug(state):
+  """The text debug() in emulator.c prints for state."""
+  lines = ['DEBUG:']
+  for name, value in zip(REGISTER_NAMES, state.registers):
+    lines.append('  Register %s: %d' % (name, value))
+  lines.append('  Memory:')
+  memory = state.memory
+  for page in xrange(PAGES):
+    if page_accessed(state, page):
+      words = memory[page * PAGE_WORDS:(page + 1) * PAGE_WORDS]
+      lines.append('    %04X:  %s  %s' % (page, ' '.join(['%04X' % x for x in words[:4]]),
+                                         ' '.join(['%04X' % x for x in words[4:]])))
+  return '\n'.join(lines) + '\n'
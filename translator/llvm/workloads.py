@@ -0,0 +1,155 @@
+"""Generators for synthetic DCPU-16 assembly programs used by the benchmarks."""
+
+import random
+import string
+
+def label_name(prefix, n):
+  # The assembler only accepts letters in labels, so spell n in base 26.
+  letters = []
+  while True:
+    letters.append(string.ascii_lowercase[n % 26])
+    n //= 26
+    if n == 0:
+      break
+  return prefix + ''.join(reversed(letters))
+
+REGISTERS = ['A', 'B', 'C', 'X', 'Y', 'Z', 'I', 'J']
+ARITHMETIC = ['SET', 'ADD', 'SUB', 'MUL', 'DIV', 'MOD', 'SHL', 'SHR', 'AND', 'OR', 'XOR']
+CONDITIONS = ['IFE', 'IFN', 'IFG', 'IFB']
+
+def _operand(rng):
+  kind = rng.randrange(5)
+  if kind == 0:
+    return rng.choice(REGISTERS)
+  elif kind == 1:
+    return '0x%X' % rng.randrange(0x10000)
+  elif kind == 2:
+    return str(rng.randrange(0x20))
+  elif kind == 3:
+    return '[0x%X+%s]' % (rng.randrange(0x1000, 0x8000), rng.choice(REGISTERS))
+  else:
+    return '[%s]' % rng.choice(REGISTERS)
+
+def mixed(lines, seed=0, block=16):
+  """Straight-line arithmetic, memory traffic, conditionals and forward jumps.
+
+  Every `block` lines start a new label; jumps only go forward, so the program
+  always terminates (at the final DBG).
+  """
+  rng = random.Random(seed)
+  out = []
+  blocks = max(1, lines // block)
+  for b in range(blocks):
+    for i in range(block):
+      prefix = ':%s ' % label_name('blk', b) if i == 0 else '    '
+      r = rng.randrange(10)
+      if r == 0:
+        target = label_name('blk', min(blocks, b + 1 + rng.randrange(3)))
+        out.append('%s%s %s, %s' % (prefix, rng.choice(CONDITIONS), rng.choice(REGISTERS), _operand(rng)))
+        out.append('      SET PC, %s ; forward jump' % target)
+      elif r == 1:
+        out.append('%sOUT %s' % (prefix, rng.choice(REGISTERS)))
+      else:
+        opcode = rng.choice(ARITHMETIC)
+        if opcode in ('SHL', 'SHR'):
+          # Shifting an i32 by 32 or more is undefined in LLVM; keep the counts small.
+          operand = str(rng.randrange(16))
+        else:
+          operand = _operand(rng)
+        out.append('%s%s %s, %s' % (prefix, opcode, rng.choice(REGISTERS + ['[0x1000]']), operand))
+  out.append(':%s DBG' % label_name('blk', blocks))
+  return '\n'.join(out) + '\n'
+
+def loops(labels, iterations=3):
+  """One small counted loop per label, reached both by falling through and
+  from a dispatch chain at the top, so every label is pending at once."""
+  out = []
+  for k in range(labels):
+    out.append('    IFE A, %d' % k)
+    out.append('      SET PC, %s' % label_name('loop', k))
+  for k in range(labels):
+    out.append(':%s SUB I, 1' % label_name('loop', k))
+    out.append('    IFN I, 0')
+    out.append('      SET PC, %s' % label_name('loop', k))
+    out.append('    SET I, %d' % iterations)
+  out.append('    DBG')
+  return '\n'.join(out) + '\n'
+
+def memcopy(words, passes):
+  """The copy loop from sample.das, scaled up: copies `words` words from
+  0x1000 to 0x4000, `passes` times."""
+  return '\n'.join([
+    '      SET J, %d' % passes,
+    ':outer SET I, %d' % words,
+    ':copy SET [0x4000+I], [0x1000+I]',
+    '      SUB I, 1',
+    '      IFN I, 0',
+    '        SET PC, copy',
+    '      SUB J, 1',
+    '      IFN J, 0',
+    '        SET PC, outer',
+    '      OUT J',
+  ]) + '\n'
+
+def _repeat(body, iterations, result='A'):
+  # Runs body `iterations` times using J as the counter, then prints a register.
+  return '\n'.join(['      SET J, %d' % iterations, ':outer ' + body[0].strip()] +
+                   body[1:] +
+                   ['      SUB J, 1', '      IFN J, 0', '        SET PC, outer', '      OUT %s' % result]) + '\n'
+
+def arithmetic(size, iterations=50000, seed=0):
+  """A loop around a chain of `size` register-only arithmetic instructions."""
+  rng = random.Random(seed)
+  body = ['      ADD A, J']
+  for i in range(size):
+    opcode = rng.choice(['ADD', 'SUB', 'MUL', 'XOR', 'SHL', 'SHR'])
+    if opcode in ('SHL', 'SHR'):
+      operand = str(rng.randrange(1, 4))
+    elif opcode == 'MUL':
+      operand = str(rng.randrange(3, 0x20, 2))
+    elif rng.randrange(2):
+      operand = rng.choice(REGISTERS[:-1])
+    else:
+      operand = '0x%X' % rng.randrange(1, 0x10000)
+    body.append('      %s %s, %s' % (opcode, rng.choice(REGISTERS[:-1]), operand))
+  return _repeat(body, iterations)
+
+def calls(depth, iterations=20000):
+  """A complete binary tree of subroutines `depth` levels deep, called from a loop."""
+  count = 2 ** (depth + 1) - 1
+  out = ['      SET J, %d' % iterations,
+         ':outer JSR %s' % label_name('fn', 0),
+         '      SUB J, 1',
+         '      IFN J, 0',
+         '        SET PC, outer',
+         '      SET PC, end']
+  for k in range(count):
+    out.append(':%s ADD X, 1' % label_name('fn', k))
+    if 2 * k + 2 < count:
+      out.append('      JSR %s' % label_name('fn', 2 * k + 1))
+      out.append('      JSR %s' % label_name('fn', 2 * k + 2))
+    out.append('      SET PC, POP')
+  out.append(':end OUT X')
+  return '\n'.join(out) + '\n'
+
+def conditions(size, iterations=50000, seed=0):
+  """`size` chains of one to three IFs, each guarding an arithmetic instruction."""
+  rng = random.Random(seed)
+  body = ['      ADD A, 0x3B']
+  for i in range(size):
+    for j in range(rng.randrange(1, 4)):
+      body.append('      %s %s, %s' % (rng.choice(CONDITIONS), rng.choice(['A', 'B', 'C']),
+                                       rng.choice(['A', 'B', 'C', str(rng.randrange(0x20))])))
+    body.append('      %s %s, %d' % (rng.choice(['ADD', 'SUB', 'XOR']), rng.choice(['A', 'B', 'C']),
+                                     rng.randrange(1, 0x100)))
+  return _repeat(body, iterations)
+
+def division(size, iterations=50000, seed=0):
+  """A loop around `size` DIV/MOD instructions, some by zero."""
+  rng = random.Random(seed)
+  body = ['      SET A, J', '      MUL A, 0x9E37']
+  for i in range(size):
+    operand = rng.choice(['B', 'C', 'X', str(rng.randrange(0x20)), '0x%X' % rng.randrange(0x10000)])
+    body.append('      %s %s, %s' % (rng.choice(['DIV', 'MOD']), rng.choice(['A', 'B', 'C', 'X']), operand))
+    body.append('      ADD %s, J' % rng.choice(['A', 'B', 'C', 'X']))
+  return _repeat(body, iterations)